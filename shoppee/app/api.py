@@ -0,0 +1,205 @@
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from .categories import get_tree
+from .images import thumbnail_url
+from .models import Product
+from .pagination import PAGE_SIZE, InvalidCursor, keyset_paginate
+from .views import listing_query
+
+# Read-only JSON catalog API. Product lists take the same query parameters as the listing pages
+# (category, province, price, discount, sort, after, before), plus fields= and limit=.
+
+MAX_LIMIT = 100
+EXPORT_CHUNK_SIZE = 500
+
+# field name -> (model columns it needs, how to read it from a product)
+PRODUCT_FIELDS = {
+    'id': (('id',), lambda product: product.id),
+    'name': (('name',), lambda product: product.name),
+    'price': (('price',), lambda product: product.price),
+    'discount': (('discount',), lambda product: product.discount),
+    'effective_price': (('effective_price',), lambda product: product.effective_price),
+    'address': (('address',), lambda product: product.address),
+    'digital': (('digital',), lambda product: product.digital),
+    'detail': (('detail',), lambda product: product.detail),
+    'sub_category': (('sub_category',), lambda product: product.sub_category_id),
+    'updated_at': (('updated_at',), lambda product: product.updated_at),
+    'image': (('image', 'image_variants'), lambda product: thumbnail_url(product, 300)),
+    'url': (('id',), lambda product: product.get_absolute_url()),
+}
+DEFAULT_PRODUCT_FIELDS = ('id', 'name', 'price', 'discount', 'effective_price', 'image', 'url')
+CATEGORY_FIELDS = ('id', 'name', 'slug', 'path', 'depth', 'parent', 'image')
+DEFAULT_CATEGORY_FIELDS = ('id', 'name', 'slug', 'parent', 'image')
+
+
+class FieldError(ValueError):
+    pass
+
+
+def requested_fields(request, known, default):
+    # """
+    # Parses ?fields=a,b,c against the known field names.
+    # """
+    if not request.GET.get('fields'):
+        return list(default)
+    fields = [name.strip() for name in request.GET['fields'].split(',') if name.strip()]
+    unknown = [name for name in fields if name not in known]
+    if unknown:
+        raise FieldError('unknown fields: %s (available: %s)' % (', '.join(unknown), ', '.join(known)))
+    return list(dict.fromkeys(fields))
+
+
+def product_serializer(fields):
+    getters = [(name, PRODUCT_FIELDS[name][1]) for name in fields]
+    return lambda product: {name: get(product) for name, get in getters}
+
+
+def product_queryset(request, fields, ordering=()):
+    # Only loads the columns of the requested fields (and the sort columns, for the cursors).
+    products, default_ordering = listing_query(request.GET, get_tree())
+    ordering = list(ordering or default_ordering)
+    columns = {column for name in fields for column in PRODUCT_FIELDS[name][0]}
+    columns.update(field.lstrip('-') for field in ordering)
+    return products.only(*columns), ordering
+
+
+def field_error(error):
+    return JsonResponse({'error': str(error)}, status=400)
+
+
+@require_GET
+def products(request):
+    # """
+    # Returns one cursor-paginated page of products as JSON.
+
+    # Input:
+    # - request: The HTTP request object. The listing filters, 'fields' (comma-separated, see PRODUCT_FIELDS),
+    #   'limit' (at most 100) and the 'after'/'before' cursors of a previous response.
+    #   A malformed cursor is answered with 400.
+
+    # Output:
+    # - {"results": [...], "next": cursor or null, "prev": cursor or null}
+    # """
+    try:
+        fields = requested_fields(request, PRODUCT_FIELDS, DEFAULT_PRODUCT_FIELDS)
+    except FieldError as error:
+        return field_error(error)
+    try:
+        limit = max(1, min(MAX_LIMIT, int(request.GET.get('limit', PAGE_SIZE))))
+    except ValueError:
+        limit = PAGE_SIZE
+    queryset, ordering = product_queryset(request, fields)
+    try:
+        page = keyset_paginate(queryset, ordering, after=request.GET.get('after'), before=request.GET.get('before'),
+                               size=limit, strict=True)
+    except InvalidCursor as error:
+        return field_error(error)
+    serialize = product_serializer(fields)
+    return JsonResponse({
+        'results': [serialize(product) for product in page],
+        'next': page.next_cursor,
+        'prev': page.prev_cursor,
+    })
+
+
+@require_GET
+def product(request, pk):
+    # """
+    # Returns one product as JSON, with the fields chosen by 'fields'.
+    # """
+    try:
+        fields = requested_fields(request, PRODUCT_FIELDS, DEFAULT_PRODUCT_FIELDS)
+    except FieldError as error:
+        return field_error(error)
+    columns = {column for name in fields for column in PRODUCT_FIELDS[name][0]}
+    found = Product.objects.only(*columns).filter(pk=pk).first()
+    if found is None:
+        return JsonResponse({'error': 'not found'}, status=404)
+    return JsonResponse(product_serializer(fields)(found))
+
+
+@require_GET
+def categories(request):
+    # """
+    # Returns every category as JSON, parents before children, from the cached category tree.
+    # """
+    try:
+        fields = requested_fields(request, CATEGORY_FIELDS, DEFAULT_CATEGORY_FIELDS)
+    except FieldError as error:
+        return field_error(error)
+    results = []
+
+    def walk(nodes, parent):
+        for node in nodes:
+            values = dict(node, parent=parent, image=node['ImageURL'])
+            results.append({name: values[name] for name in fields})
+            walk(node['children'], node['id'])
+
+    walk(get_tree()['roots'], None)
+    return JsonResponse({'results': results})
+
+
+def stream_products(queryset, serialize, chunk_size=EXPORT_CHUNK_SIZE):
+    # """
+    # Yields a JSON array of the queryset, a chunk of rows at a time, reading it with a server-side
+    # iterator. Memory stays flat however large the catalog is.
+    # """
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    yield '['
+    chunk = []
+    first = True
+    for item in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(encoder.encode(serialize(item)))
+        if len(chunk) == chunk_size:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+
+async def astream_products(queryset, serialize, chunk_size=EXPORT_CHUNK_SIZE):
+    # Same as stream_products for ASGI servers. Django would read a sync iterator into a list before
+    # sending the first byte (StreamingHttpResponse.__aiter__), so the rows come from aiterator() instead.
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    yield '['
+    chunk = []
+    first = True
+    async for item in queryset.aiterator(chunk_size=chunk_size):
+        chunk.append(encoder.encode(serialize(item)))
+        if len(chunk) == chunk_size:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+
+@require_GET
+def export_products(request):
+    # """
+    # Streams every product matching the listing filters as one JSON array, ordered by id.
+
+    # Input:
+    # - request: The HTTP request object, with the listing filters and 'fields'. Cursors and 'limit' are ignored.
+
+    # Output:
+    # - A StreamingHttpResponse (application/json) built from chunks of EXPORT_CHUNK_SIZE rows,
+    #   from an async iterator when served over ASGI.
+    # """
+    try:
+        fields = requested_fields(request, PRODUCT_FIELDS, DEFAULT_PRODUCT_FIELDS)
+    except FieldError as error:
+        return field_error(error)
+    queryset, ordering = product_queryset(request, fields, ordering=['id'])
+    stream = astream_products if isinstance(request, ASGIRequest) else stream_products
+    response = StreamingHttpResponse(
+        stream(queryset.order_by(*ordering), product_serializer(fields)),
+        content_type='application/json; charset=utf-8',
+    )
+    response['Content-Disposition'] = 'inline; filename="products.json"'
+    return response
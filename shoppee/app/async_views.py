@@ -0,0 +1,115 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import Http404
+from django.shortcuts import render
+from .models import Product
+from .categories import get_tree
+from .conditional import conditional_page
+from .pagecache import anonymous_page_cache
+from .pagination import akeyset_paginate
+from .search import search_ids
+from .views import PRODUCT_SORTS, listing_query, listing_validators, product_validators
+from . import facets
+
+# Async versions of the read-heavy catalog views, used instead of the ones in views.py when
+# settings.ASYNC_VIEWS is on (off by default, as they measure slower; see the README). They take the same
+# query parameters and render the same templates; independent work of one request runs concurrently.
+
+
+async def run(func, *args):
+    # """
+    # Runs sync code (raw SQL, cached helpers, the session) in its own worker thread, so several
+    # calls can overlap. The thread's database connection is closed afterwards, as at the end of a request.
+    # """
+    def call():
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+    return await sync_to_async(call, thread_sensitive=False)()
+
+
+def load_cart(request):
+    # Loads the cart count and total here, so the context processor doesn't query while rendering.
+    return request.cart.cart_totals
+
+
+async def product_listing(request, tree):
+    products, ordering = listing_query(request.GET, tree)
+    return await akeyset_paginate(products, ordering, after=request.GET.get('after'), before=request.GET.get('before'), params=request.GET)
+
+
+async def render_async(request, template, context):
+    return await sync_to_async(render)(request, template, context)
+
+
+@conditional_page(listing_validators)
+@anonymous_page_cache('listings')
+async def home(request):
+    # """
+    # Async version of views.home: the product page, the facet counts and the cart load concurrently.
+    # """
+    tree = await run(get_tree)
+    page, summary, _ = await asyncio.gather(
+        product_listing(request, tree),
+        run(facets.summary, request.GET),
+        run(load_cart, request),
+    )
+    context = {'page': page, 'categories': tree['roots'], 'facets': summary, 'sort': request.GET.get('sort', '')}
+    return await render_async(request, 'app/home.html', context)
+
+
+@conditional_page(listing_validators)
+@anonymous_page_cache('listings')
+async def category(request):
+    # """
+    # Async version of views.category.
+    # """
+    if not request.GET.get('category'):
+        raise Http404('No category given.')
+    tree = await run(get_tree)
+    page, _ = await asyncio.gather(product_listing(request, tree), run(load_cart, request))
+    context = {
+        'active_category': request.GET.get('category', ''),
+        'page': page,
+        'sort': request.GET.get('sort', ''),
+    }
+    return await render_async(request, 'app/category.html', context)
+
+
+async def product_detail(pk):
+    product = await Product.objects.filter(id=pk).afirst()
+    if product is None:
+        raise Http404('No product matches the given query.')
+    return [product]
+
+
+@conditional_page(product_validators)
+@anonymous_page_cache(lambda request, pk: 'product:%s' % pk)
+async def detail(request, pk):
+    # """
+    # Async version of views.detail.
+    # """
+    products, _ = await asyncio.gather(product_detail(pk), run(load_cart, request))
+    return await render_async(request, 'app/detail.html', {'products': products})
+
+
+async def search_cards(query, ordering):
+    ids = await run(search_ids, query)
+    if ordering:
+        return [product async for product in Product.objects.cards().filter(id__in=ids).order_by(*ordering)]
+    products = await Product.objects.cards().ain_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
+
+
+async def search(request):
+    # """
+    # Async version of views.search.
+    # """
+    searched = request.POST.get('searched') or request.GET.get('searched', '')
+    keys, _ = await asyncio.gather(
+        search_cards(searched, PRODUCT_SORTS.get(request.GET.get('sort'))),
+        run(load_cart, request),
+    )
+    return await render_async(request, 'app/search.html', {'searched': searched, 'keys': keys, 'sort': request.GET.get('sort', '')})
@@ -0,0 +1,147 @@
+import bisect
+import logging
+import threading
+import time
+from django.db import connections
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+from django.urls import reverse
+from .models import Category, Product
+from .search import fold
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_LIMIT = 8
+# Prefixes up to this length match too many names to rank per keystroke, so their top
+# suggestions are precomputed when the index is built.
+SHORT_PREFIX = 3
+# Rebuild at least this often, to pick up changes saved by other worker processes.
+MAX_AGE = 300
+
+
+def _normalize(text):
+    return ' '.join(fold(text).split())
+
+
+class PrefixIndex:
+    # """
+    # An in-process, sorted-array prefix index over product and category names.
+
+    # Every word position of a folded name is a key, so "ao hoodie" finds "Áo hoodie nam" and
+    # "hoodie" finds it too. Lookups are a binary search plus a bounded scan, with no database access.
+
+    # Outputs:
+    #     lookup(prefix, limit): Up to limit suggestions, most popular first.
+    #     invalidate(): Marks the index stale; the next lookup rebuilds it in the background.
+    #     warm(): Builds the index in the background, e.g. at worker startup.
+    # """
+    def __init__(self):
+        self._keys = []
+        self._entries = []
+        self._top = {}
+        self._built_at = None
+        self._stale = True
+        self._lock = threading.Lock()
+        self._building = False
+
+    def build(self):
+        entries = []
+        keys = []
+        products = Product.objects.annotate(
+            popularity=Coalesce(Sum('orderitem__quantity'), 0)).values_list('id', 'name', 'popularity')
+        categories = Category.objects.annotate(
+            popularity=Count('product')).values_list('slug', 'name', 'popularity')
+        category_url = reverse('category')
+        for pk, name, popularity in products.iterator():
+            entries.append({'type': 'product', 'label': name, 'url': reverse('product', args=[pk])})
+            keys.extend(self._keys_for(name, popularity, len(entries) - 1))
+        for slug, name, popularity in categories.iterator():
+            entries.append({'type': 'category', 'label': name, 'url': f'{category_url}?category={slug}'})
+            keys.extend(self._keys_for(name, popularity, len(entries) - 1))
+        keys.sort()
+        top = {}
+        for key, rank, index in keys:
+            for length in range(1, min(len(key), SHORT_PREFIX) + 1):
+                top.setdefault(key[:length], []).append((rank, index))
+        for prefix, matches in top.items():
+            top[prefix] = self._best(matches, SUGGESTION_LIMIT)
+        with self._lock:
+            self._keys, self._entries, self._top = keys, entries, top
+            self._built_at = time.monotonic()
+        return len(entries)
+
+    def _keys_for(self, name, popularity, index):
+        words = _normalize(name).split(' ')
+        for position in range(len(words)):
+            key = ' '.join(words[position:])
+            if key:
+                yield (key, -popularity, index)
+
+    def _best(self, matches, limit):
+        seen = set()
+        best = []
+        for rank, index in sorted(matches):
+            if index not in seen:
+                seen.add(index)
+                best.append(index)
+                if len(best) == limit:
+                    break
+        return best
+
+    def lookup(self, prefix, limit=SUGGESTION_LIMIT):
+        prefix = _normalize(prefix)
+        if not prefix:
+            return []
+        self._ensure_fresh()
+        with self._lock:
+            keys, entries, top = self._keys, self._entries, self._top
+        if len(prefix) <= SHORT_PREFIX:
+            indexes = top.get(prefix, [])[:limit]
+        else:
+            start = bisect.bisect_left(keys, (prefix,))
+            matches = []
+            for key, rank, index in keys[start:]:
+                if not key.startswith(prefix):
+                    break
+                matches.append((rank, index))
+            indexes = self._best(matches, limit)
+        return [entries[index] for index in indexes]
+
+    def invalidate(self):
+        self._stale = True
+
+    def warm(self):
+        self._stale = True
+        self._rebuild_in_background()
+
+    def _ensure_fresh(self):
+        expired = self._built_at is None or time.monotonic() - self._built_at > MAX_AGE
+        if not (self._stale or expired):
+            return
+        if self._built_at is None:
+            # Nothing to serve yet, so the first lookup builds in the request.
+            self._stale = False
+            self.build()
+        else:
+            self._rebuild_in_background()
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+            self._stale = False
+        threading.Thread(target=self._background_build, daemon=True).start()
+
+    def _background_build(self):
+        try:
+            self.build()
+        except Exception:
+            self._stale = True
+            logger.exception('Could not build the autocomplete index')
+        finally:
+            self._building = False
+            connections.close_all()
+
+
+index = PrefixIndex()
@@ -0,0 +1,306 @@
+import uuid
+from django.core import signing
+from django.db import IntegrityError
+from django.db.models import F, Subquery
+from django.utils.functional import cached_property
+from . import writequeue
+from .models import Order, OrderItem, Product, ShippingAddress
+
+CART_SESSION_KEY = 'cart_order_id'
+# The anonymous cart lives in this signed cookie as {product id: quantity}, so browsing and filling a cart
+# costs no database writes and no session; it is merged into the user's order on login (see merge_into).
+# The page cache and conditional responses already treat a request with this cookie as personal.
+COOKIE_NAME = 'cart'
+COOKIE_SALT = 'app.cart'
+COOKIE_MAX_AGE = 30 * 24 * 3600
+# Keeps the cookie well under the 4 KB browsers accept.
+MAX_COOKIE_LINES = 50
+
+
+class Cart:
+    # """
+    # A lazy, request-scoped view of the current user's open order, or of the anonymous cart cookie.
+    # Nothing is read from the database until a property is accessed, and the
+    # Order row is only created when a logged-in user adds an item.
+
+    # Inputs:
+    #     request (HttpRequest): The request the cart belongs to.
+
+    # Outputs:
+    #     order_id: The id of the open order, remembered in the session after the first lookup.
+    #     items: The order items of the open order, with their products (unsaved ones for an anonymous cart).
+    #     get_cart_items / get_cart_total: Same names as on Order, so templates can use either.
+    #     get_or_create_order(): Returns the open Order, creating it when needed.
+    #     apply(deltas): Applies {product id: quantity change} to the order in one transaction (see writequeue.py).
+    #     state(): The cart lines and totals as a JSON-ready dict.
+    #     checkout(key, shipping): Completes the open order once per idempotency key.
+    #     merge_into(user): Moves the anonymous cart into the user's open order.
+    #     save(response): Writes the anonymous cart cookie when it changed (see middleware.CartMiddleware).
+    # """
+    def __init__(self, request):
+        self.request = request
+        self.changed = False
+
+    @property
+    def user(self):
+        return self.request.user
+
+    @cached_property
+    def order_id(self):
+        if not self.user.is_authenticated:
+            return None
+        order_id = self.request.session.get(CART_SESSION_KEY)
+        if order_id is None:
+            order_id = Order.objects.filter(customer=self.user, complete=False).values_list('id', flat=True).first()
+            if order_id is not None:
+                self.request.session[CART_SESSION_KEY] = order_id
+        return order_id
+
+    @cached_property
+    def lines(self):
+        # The anonymous cart, {product id: quantity}; empty when the cookie is missing, forged or expired.
+        value = self.request.COOKIES.get(COOKIE_NAME)
+        if not value:
+            return {}
+        try:
+            data = signing.loads(value, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+            return {int(pk): int(quantity) for pk, quantity in data.items() if int(quantity) > 0}
+        except (signing.BadSignature, ValueError, TypeError, AttributeError):
+            return {}
+
+    @cached_property
+    def items(self):
+        if not self.user.is_authenticated:
+            products = Product.objects.select_related('sub_category').in_bulk(list(self.lines))
+            return [
+                OrderItem(product=products[pk], quantity=quantity)
+                for pk, quantity in self.lines.items() if pk in products
+            ]
+        if self.order_id is None:
+            return OrderItem.objects.none()
+        items = list(self.open_lines().select_related('product__sub_category'))
+        if not items and self.refresh_order():
+            items = list(self.open_lines().select_related('product__sub_category'))
+        return items
+
+    @cached_property
+    def cart_totals(self):
+        if not self.user.is_authenticated:
+            items = self.items if self.lines else []
+            return {'items': sum(item.quantity for item in items), 'total': sum(item.get_total for item in items)}
+        if self.order_id is None:
+            return {'items': 0, 'total': 0}
+        totals = self.open_lines().totals()
+        if not totals['items'] and self.refresh_order():
+            totals = self.open_lines().totals()
+        return totals
+
+    def open_lines(self):
+        # The lines of the remembered order, as long as it is still this user's open order: it may have been
+        # checked out from another session since it was remembered in this one.
+        return OrderItem.objects.filter(order_id=self.order_id, order__customer=self.user, order__complete=False)
+
+    def refresh_order(self):
+        # """
+        # Looks the open order up again when the remembered one shows no lines, and returns whether it changed.
+        # Only an empty cart pays for the extra query.
+        # """
+        order_id = Order.objects.filter(customer=self.user, complete=False).values_list('id', flat=True).first()
+        if order_id == self.order_id:
+            return False
+        if order_id is None:
+            self.request.session.pop(CART_SESSION_KEY, None)
+        else:
+            self.request.session[CART_SESSION_KEY] = order_id
+        self.order_id = order_id
+        return order_id is not None
+
+    @property
+    def get_cart_items(self):
+        return self.cart_totals['items']
+
+    @property
+    def get_cart_total(self):
+        return self.cart_totals['total']
+
+    def get_or_create_order(self):
+        order = open_order(self.user.id, self.order_id)
+        self.remember(order.id)
+        return order
+
+    def remember(self, order_id):
+        if order_id != self.order_id:
+            self.request.session[CART_SESSION_KEY] = order_id
+            self.order_id = order_id
+        self.invalidate()
+
+    def apply(self, deltas):
+        # """
+        # Applies {product id: quantity change} to the open order, creating it when needed; see apply_deltas.
+        # """
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        if not self.user.is_authenticated:
+            self.apply_to_cookie(deltas)
+            return
+        self.remember(writequeue.run(apply_deltas, self.user.id, self.order_id, deltas))
+
+    def apply_to_cookie(self, deltas):
+        # Same rules as apply_deltas, on the cookie: unknown products are skipped, lines at zero are dropped,
+        # and new lines beyond MAX_COOKIE_LINES are ignored.
+        lines = dict(self.lines)
+        for pk in Product.objects.filter(id__in=deltas).values_list('id', flat=True):
+            if pk not in lines and len(lines) >= MAX_COOKIE_LINES:
+                continue
+            quantity = lines.get(pk, 0) + deltas[pk]
+            if quantity > 0:
+                lines[pk] = quantity
+            else:
+                lines.pop(pk, None)
+        self.lines = lines
+        self.changed = True
+        self.invalidate()
+
+    def merge_into(self, user):
+        # """
+        # Adds the anonymous cart to the user's open order, in one upsert (see merge_lines), and empties it.
+        # Called right after login, when request.user is already the user.
+        # """
+        if not self.lines:
+            return
+        order_id = writequeue.run(merge_lines, user.id, self.lines)
+        if self.request.user == user:
+            self.request.session[CART_SESSION_KEY] = order_id
+            self.order_id = order_id
+        self.lines = {}
+        self.changed = True
+        self.invalidate()
+
+    def save(self, response):
+        if not self.changed:
+            return
+        if self.lines:
+            value = signing.dumps({str(pk): quantity for pk, quantity in self.lines.items()}, salt=COOKIE_SALT)
+            response.set_cookie(COOKIE_NAME, value, max_age=COOKIE_MAX_AGE, httponly=True, samesite='Lax',
+                                secure=self.request.is_secure())
+        else:
+            response.delete_cookie(COOKIE_NAME, samesite='Lax')
+
+    def state(self):
+        lines = [
+            {
+                'productId': item.product_id,
+                'name': item.product.name,
+                'price': item.product.price,
+                'quantity': item.quantity,
+                'total': item.get_total,
+            }
+            for item in self.items if item.product_id
+        ]
+        return {
+            'items': lines,
+            'cartItems': sum(line['quantity'] for line in lines),
+            'cartTotal': sum(line['total'] for line in lines),
+        }
+
+    def checkout(self, key, shipping):
+        # """
+        # Completes the open order: freezes its totals, sets transaction_id and saves the shipping address,
+        # all in one short transaction. Repeating a checkout with the same key returns the order it completed
+        # instead of completing another one.
+
+        # Input:
+        #     key (str): The client-supplied idempotency key.
+        #     shipping (dict): Cleaned ShippingAddressForm fields.
+
+        # Output:
+        #     The completed Order, or None when there is no open order with items.
+        # """
+        done = Order.objects.filter(customer=self.user, idempotency_key=key, complete=True).first()
+        if done is not None:
+            return done
+        if self.order_id is None:
+            return None
+        if not self.open_lines().filter(quantity__gt=0).exists():
+            if not self.refresh_order() or not self.open_lines().filter(quantity__gt=0).exists():
+                return None
+        order_id = self.order_id
+        try:
+            writequeue.run(complete_order, self.user.id, order_id, key, shipping)
+        except IntegrityError:
+            pass
+        self.forget_order()
+        # Lost a race with a retry of the same checkout: return what that request completed.
+        return Order.objects.filter(customer=self.user, idempotency_key=key, complete=True).first()
+
+    def forget_order(self):
+        self.request.session.pop(CART_SESSION_KEY, None)
+        self.order_id = None
+        self.invalidate()
+
+    def invalidate(self):
+        self.__dict__.pop('items', None)
+        self.__dict__.pop('cart_totals', None)
+
+
+# The writes, as plain functions of ids, so that writequeue can run them on its writer thread.
+
+def open_order(user_id, order_id=None):
+    order = None
+    if order_id is not None:
+        order = Order.objects.filter(id=order_id, customer_id=user_id, complete=False).first()
+    if order is None:
+        order, created = Order.objects.get_or_create(customer_id=user_id, complete=False)
+    return order
+
+
+def apply_deltas(user_id, order_id, deltas):
+    # """
+    # Changes line quantities with database-side increments, so concurrent clicks never lose an
+    # update. Missing lines are inserted first (ignoring the unique (order, product) conflict),
+    # and lines that drop to zero or below are deleted. Unknown product ids are skipped.
+    # Returns the id of the open order.
+    # """
+    order = open_order(user_id, order_id)
+    product_ids = set(Product.objects.filter(id__in=deltas).values_list('id', flat=True))
+    OrderItem.objects.bulk_create(
+        [OrderItem(order=order, product_id=pk, quantity=0) for pk in product_ids],
+        ignore_conflicts=True,
+    )
+    for pk in product_ids:
+        OrderItem.objects.filter(order=order, product_id=pk).update(quantity=F('quantity') + deltas[pk])
+    OrderItem.objects.filter(order=order, quantity__lte=0).delete()
+    return order.id
+
+
+def merge_lines(user_id, lines):
+    # """
+    # Adds {product id: quantity} to the user's open order, creating it when needed: the new quantities
+    # are computed from the existing lines and written with one INSERT ... ON CONFLICT DO UPDATE.
+    # Unknown product ids are skipped. Returns the id of the open order.
+    # """
+    order = open_order(user_id)
+    existing = dict(OrderItem.objects.filter(order=order, product_id__in=lines).values_list('product_id', 'quantity'))
+    product_ids = Product.objects.filter(id__in=lines).values_list('id', flat=True)
+    OrderItem.objects.bulk_create(
+        [OrderItem(order=order, product_id=pk, quantity=(existing.get(pk) or 0) + lines[pk]) for pk in product_ids],
+        update_conflicts=True,
+        unique_fields=['order', 'product'],
+        update_fields=['quantity'],
+    )
+    return order.id
+
+
+def complete_order(user_id, order_id, key, shipping):
+    # Totals are computed inside the UPDATE so they match the lines at commit time.
+    sums = OrderItem.objects.filter(order_id=order_id).per_order()
+    completed = Order.objects.filter(id=order_id, customer_id=user_id, complete=False).update(
+        complete=True,
+        transaction_id=uuid.uuid4().hex,
+        idempotency_key=key,
+        total_items=Subquery(sums.values('items')),
+        total=Subquery(sums.values('total')),
+    )
+    if completed:
+        ShippingAddress.objects.create(customer_id=user_id, order_id=order_id, **shipping)
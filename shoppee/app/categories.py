@@ -0,0 +1,61 @@
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from .models import Category
+from .images import thumbnail_url
+
+TREE_CACHE_KEY = 'category_tree'
+NAV_CACHE_KEY = 'category_nav'
+
+
+def build_tree():
+    # """
+    # Loads every category in one query, ordered by materialized path so parents come before children.
+
+    # Output:
+    #     A dict with 'roots' (the top-level category nodes) and 'by_slug' (every node by slug).
+    #     Nodes are plain dicts (id, name, slug, path, depth, ImageURL, children) so they cache well;
+    #     ImageURL is the 150px variant of the category image when it has been built.
+    # """
+    nodes = {}
+    roots = []
+    for category in Category.objects.order_by('path'):
+        node = {
+            'id': category.id,
+            'name': category.name,
+            'slug': category.slug,
+            'path': category.path,
+            'depth': category.depth,
+            'ImageURL': thumbnail_url(category, 150),
+            'children': [],
+        }
+        nodes[category.id] = node
+        parent = nodes.get(category.sub_category_id)
+        if parent is not None:
+            parent['children'].append(node)
+        else:
+            roots.append(node)
+    return {'roots': roots, 'by_slug': {node['slug']: node for node in nodes.values()}}
+
+
+def get_tree():
+    tree = cache.get(TREE_CACHE_KEY)
+    if tree is None:
+        tree = build_tree()
+        cache.set(TREE_CACHE_KEY, tree, None)
+    return tree
+
+
+def get_nav_html():
+    # """
+    # Returns the rendered category menu of base.html (app/category_nav.html).
+    # It only depends on the tree, so every page and worker shares one copy until a category changes.
+    # """
+    html = cache.get(NAV_CACHE_KEY)
+    if html is None:
+        html = render_to_string('app/category_nav.html', {'categories': get_tree()['roots']})
+        cache.set(NAV_CACHE_KEY, html, None)
+    return html
+
+
+def invalidate_tree():
+    cache.delete_many([TREE_CACHE_KEY, NAV_CACHE_KEY])
@@ -0,0 +1,78 @@
+import hashlib
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from . import pagecache
+
+
+def make_etag(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def viewer_key(request):
+    # """
+    # The part of a page that depends on who is asking: nothing for anonymous visitors,
+    # otherwise the user and the cart count and total shown in the header.
+    # """
+    if not pagecache.bypass(request):
+        return 'anonymous'
+    totals = request.cart.cart_totals
+    return 'user:%s:%s:%s' % (request.user.id, totals['items'], totals['total'])
+
+
+def conditional_page(validators):
+    # """
+    # Answers conditional GETs (If-None-Match / If-Modified-Since) with 304 before the view runs,
+    # and adds ETag and Last-Modified to the pages it renders. Works on sync and async views.
+
+    # Input:
+    # - validators(request, *args, **kwargs): Returns (etag, last_modified datetime) of the page,
+    #   or None when the page has none (e.g. it is a 404). It is called in a worker thread for async views.
+
+    # Output:
+    # - The decorated view. Pages seen by a logged-in user or with a cart are marked private.
+    # """
+    def check(request, result):
+        # A flash message is shown once, so such a page is never "not modified".
+        if result is None or request.method not in ('GET', 'HEAD') or 'messages' in request.COOKIES:
+            return None, None
+        etag, last_modified = result
+        found = {
+            'etag': quote_etag(etag),
+            'timestamp': int(last_modified.timestamp()) if last_modified else None,
+            'private': pagecache.bypass(request),
+        }
+        return get_conditional_response(request, etag=found['etag'], last_modified=found['timestamp']), found
+
+    def finish(response, found):
+        if found and response.status_code in (200, 304):
+            response.headers.setdefault('ETag', found['etag'])
+            if found['timestamp']:
+                response.headers.setdefault('Last-Modified', http_date(found['timestamp']))
+            # Always revalidate; the revalidation is what is cheap now.
+            if found['private']:
+                patch_cache_control(response, no_cache=True, private=True)
+            else:
+                patch_cache_control(response, no_cache=True)
+        return response
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                response, found = await sync_to_async(
+                    lambda: check(request, validators(request, *args, **kwargs)))()
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                return finish(response, found)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response, found = check(request, validators(request, *args, **kwargs))
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return finish(response, found)
+        return wrapper
+    return decorator
@@ -0,0 +1,14 @@
+def cart(request):
+    # """
+    # Exposes the request's lazy cart and the login flags used by base.html.
+    # The cart only queries the database when the template reads it.
+    # """
+    if request.user.is_authenticated:
+        user_login, user_not_login = "show", "hidden"
+    else:
+        user_login, user_not_login = "hidden", "show"
+    return {
+        'cart': getattr(request, 'cart', None),
+        'user_login': user_login,
+        'user_not_login': user_not_login,
+    }
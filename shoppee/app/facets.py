@@ -0,0 +1,156 @@
+from collections import Counter
+from django.db import transaction
+from django.db.models import F, Q
+from .models import FacetCount, Product, Province
+from .categories import get_tree
+
+# (value, lowest price, highest price) of the price bands, on the discounted price.
+PRICE_BANDS = (
+    ('0-10', 0, 10),
+    ('10-50', 10, 50),
+    ('50-200', 50, 200),
+    ('200-1000', 200, 1000),
+    ('1000+', 1000, None),
+)
+# A product with a 25% discount counts towards "10% or more" and "20% or more".
+DISCOUNT_STEPS = (10, 20, 30, 50)
+
+
+def price_band(price):
+    for value, low, high in PRICE_BANDS:
+        if price >= low and (high is None or price < high):
+            return value
+    return None
+
+
+def _path_ids(path):
+    return [int(segment) for segment in path.split('/') if segment]
+
+
+def facets_for(ids):
+    # """
+    # Returns {product id: set of (facet, value)} for those of the given products that exist.
+    # Category values include every ancestor, matching the descendant-aware category listings.
+    # """
+    ids = list(ids)
+    result = {}
+    if not ids:
+        return result
+    rows = Product.objects.filter(id__in=ids).values_list(
+        'id', 'address', 'effective_price', 'discount', 'sub_category__path')
+    for pk, address, price, discount, sub_path in rows:
+        values = result[pk] = set()
+        if address:
+            values.add(('province', address))
+        band = price_band(price)
+        if band:
+            values.add(('price', band))
+        values.update(('discount', str(step)) for step in DISCOUNT_STEPS if discount >= step)
+        values.update(('category', str(category_id)) for category_id in _path_ids(sub_path or ''))
+    links = Product.category.through.objects.filter(product_id__in=ids).values_list('product_id', 'category__path')
+    for pk, path in links:
+        if pk in result:
+            result[pk].update(('category', str(category_id)) for category_id in _path_ids(path or ''))
+    return result
+
+
+def apply_changes(old, new):
+    # """
+    # Applies the difference between two facets_for() results to the FacetCount table.
+    # """
+    delta = Counter()
+    for pk in set(old) | set(new):
+        before, after = old.get(pk, set()), new.get(pk, set())
+        delta.update(after - before)
+        delta.subtract(before - after)
+    delta = {key: change for key, change in delta.items() if change}
+    if not delta:
+        return
+    with transaction.atomic():
+        FacetCount.objects.bulk_create(
+            [FacetCount(facet=facet, value=value) for (facet, value), change in delta.items() if change > 0],
+            ignore_conflicts=True,
+        )
+        for (facet, value), change in delta.items():
+            FacetCount.objects.filter(facet=facet, value=value).update(count=F('count') + change)
+
+
+def rebuild(batch_size=2000):
+    # """
+    # Recounts every facet from the product table and replaces the FacetCount rows.
+    # """
+    totals = Counter()
+    ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(ids), batch_size):
+        for values in facets_for(ids[start:start + batch_size]).values():
+            totals.update(values)
+    with transaction.atomic():
+        FacetCount.objects.all().delete()
+        FacetCount.objects.bulk_create(
+            [FacetCount(facet=facet, value=value, count=count) for (facet, value), count in totals.items()],
+            batch_size=batch_size,
+        )
+    return len(ids)
+
+
+def counts():
+    result = {}
+    for facet, value, count in FacetCount.objects.filter(count__gt=0).values_list('facet', 'value', 'count'):
+        result.setdefault(facet, {})[value] = count
+    return result
+
+
+def filter_products(queryset, params):
+    # """
+    # Narrows a product queryset by the facet filters in a query string.
+
+    # Input:
+    #     params (QueryDict): 'province', 'price' (price band) and 'discount' (minimum %), all repeatable.
+    # """
+    provinces = [value for value in params.getlist('province') if value]
+    if provinces:
+        queryset = queryset.filter(address__in=provinces)
+    bands = [band for band in PRICE_BANDS if band[0] in params.getlist('price')]
+    if bands:
+        condition = Q()
+        for value, low, high in bands:
+            band = Q(effective_price__gte=low)
+            if high is not None:
+                band &= Q(effective_price__lt=high)
+            condition |= band
+        queryset = queryset.filter(condition)
+    steps = [int(value) for value in params.getlist('discount') if value.isdigit()]
+    if steps:
+        queryset = queryset.filter(discount__gte=min(steps))
+    return queryset
+
+
+def summary(params):
+    # """
+    # Returns the facet values with their product counts and whether each one is selected,
+    # as {'province': [...], 'price': [...], 'discount': [...], 'category': [...]}.
+    # """
+    totals = counts()
+    provinces = params.getlist('province')
+    prices = params.getlist('price')
+    discounts = params.getlist('discount')
+    category = params.get('category', '')
+
+    def entry(facet, value, label, selected):
+        return {'value': value, 'label': label, 'count': totals.get(facet, {}).get(value, 0), 'selected': selected}
+
+    return {
+        'province': [
+            entry('province', name, name, name in provinces)
+            for name in Province.objects.order_by('id').values_list('name', flat=True)
+        ],
+        'price': [entry('price', value, value, value in prices) for value, low, high in PRICE_BANDS],
+        'discount': [
+            entry('discount', str(step), '%s%%+' % step, str(step) in discounts)
+            for step in DISCOUNT_STEPS
+        ],
+        'category': [
+            entry('category', str(node['id']), node['name'], node['slug'] == category)
+            for node in get_tree()['roots']
+        ],
+    }
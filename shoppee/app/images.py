@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.dispatch import Signal
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+VARIANT_WIDTHS = (150, 300, 600)
+# (key in image_variants, Pillow format, file extension, MIME type)
+VARIANT_FORMATS = (
+    ('webp', 'WEBP', 'webp', 'image/webp'),
+    ('jpeg', 'JPEG', 'jpg', 'image/jpeg'),
+)
+VARIANT_DIR = 'derivatives'
+QUALITY = 80
+
+# Sent with sender=model and pk after new variants are stored (by an UPDATE, so post_save does not fire).
+variants_built = Signal()
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'IMAGE_VARIANT_WORKERS', 2), thread_name_prefix='image-variants')
+
+
+def build_variants(image):
+    # """
+    # Writes resized WebP and JPEG copies of an uploaded image and returns their description.
+
+    # Input:
+    #     image (FieldFile): The model's image.
+
+    # Output:
+    #     {'source': name, 'hash': content hash, 'width': original width,
+    #      'webp': [[width, name], ...], 'jpeg': [[width, name], ...]}
+    #     File names contain the content hash, so they never change and can be cached forever.
+    # """
+    with image.open('rb') as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem = posixpath.splitext(posixpath.basename(image.name))[0]
+    original = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    widths = [width for width in VARIANT_WIDTHS if width < original.width] or [original.width]
+    variants = {'source': image.name, 'hash': digest, 'width': original.width}
+    for key, fmt, extension, mime in VARIANT_FORMATS:
+        variants[key] = []
+        for width in widths:
+            name = f'{VARIANT_DIR}/{stem}-{digest}-{width}.{extension}'
+            if not default_storage.exists(name):
+                resized = original.copy()
+                resized.thumbnail((width, width * 10), Image.LANCZOS)
+                if fmt == 'JPEG' and resized.mode != 'RGB':
+                    background = Image.new('RGB', resized.size, 'white')
+                    rgba = resized.convert('RGBA')
+                    background.paste(rgba, mask=rgba.getchannel('A'))
+                    resized = background
+                buffer = BytesIO()
+                resized.save(buffer, fmt, quality=QUALITY)
+                default_storage.save(name, ContentFile(buffer.getvalue()))
+            variants[key].append([width, name])
+    return variants
+
+
+def needs_variants(instance):
+    return (instance.image.name or '') != (instance.image_variants or {}).get('source', '')
+
+
+def generate(model, pk):
+    # """
+    # Builds the variants of one object's image and stores them, unless the image changed meanwhile.
+    # """
+    obj = model.objects.filter(pk=pk).only('image').first()
+    if obj is None:
+        return
+    variants = build_variants(obj.image) if obj.image else {}
+    if model.objects.filter(pk=pk, image=obj.image.name or '').update(image_variants=variants):
+        variants_built.send(sender=model, pk=pk)
+
+
+def _run(model, pk):
+    try:
+        generate(model, pk)
+    except Exception:
+        logger.exception('Could not build image variants for %s %s', model.__name__, pk)
+    finally:
+        connections.close_all()
+
+
+def schedule(model, pk):
+    # Off the request path: the worker pool picks it up once the saving transaction commits.
+    transaction.on_commit(lambda: _executor.submit(_run, model, pk))
+
+
+def srcset(variants, key):
+    return ', '.join(f'{default_storage.url(name)} {width}w' for width, name in variants.get(key, []))
+
+
+def thumbnail_url(obj, width, fmt='webp'):
+    # """
+    # Returns the URL of the smallest variant (WebP, or fmt='jpeg') at least width pixels wide, or the original image.
+    # """
+    variants = (obj.image_variants or {}).get(fmt, [])
+    for variant_width, name in variants:
+        if variant_width >= width:
+            return default_storage.url(name)
+    if variants:
+        return default_storage.url(variants[-1][1])
+    return obj.ImageURL
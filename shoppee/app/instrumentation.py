@@ -0,0 +1,222 @@
+import bisect
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates
+
+# Per-request instrumentation: SQL queries (count, time, repeated statements), template render time and
+# view time. A sampled request gets a Server-Timing header and one JSON line on the 'app.requests' logger,
+# and its timings are added to per-route histograms in the cache, shared by every worker (see stats).
+# Unsampled requests only pay for one random() call.
+
+logger = logging.getLogger('app.requests')
+
+# A statement run at least this many times in one request is reported as repeated (likely an N+1).
+REPEATED_QUERIES = 3
+# Histogram bucket upper bounds in milliseconds: 25% apart from 1 ms to about 70 s.
+BUCKETS = [round(1.25 ** index, 2) for index in range(51)]
+PERCENTILES = (50, 90, 95, 99)
+IN_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+
+current = ContextVar('request_metrics', default=None)
+
+
+class Metrics:
+    # """
+    # What one request spent its time on. Queries may be recorded from several threads at once
+    # (the async views run their queries concurrently), hence the lock.
+    # """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.template_ms = 0.0
+        self.view_ms = None
+        self.statements = Counter()
+        self.rendering = 0
+        self.lock = threading.Lock()
+
+    def record_query(self, sql, elapsed):
+        with self.lock:
+            self.queries += 1
+            self.sql_ms += elapsed
+            self.statements[IN_LIST.sub('%s...', sql)] += 1
+
+    def repeated(self):
+        return [
+            {'fingerprint': hashlib.md5(sql.encode()).hexdigest()[:12], 'count': times, 'sql': sql[:300]}
+            for sql, times in self.statements.most_common() if times >= REPEATED_QUERIES
+        ]
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.record_query(sql, (time.perf_counter() - started) * 1000)
+
+
+def install(connection, **kwargs):
+    # Every connection gets the wrapper for good; it does nothing outside a sampled request.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install, dispatch_uid='app.instrumentation.install')
+
+
+def sample_rate():
+    return getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 0)
+
+
+def sampled():
+    rate = sample_rate()
+    return bool(rate) and random.random() < rate
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '-'
+    return match.view_name or match.route
+
+
+def finish(metrics, request, response):
+    # """
+    # Adds the Server-Timing header, logs the request as one JSON line and updates the route's histogram.
+    # """
+    total_ms = (time.perf_counter() - metrics.started) * 1000
+    repeated = metrics.repeated()
+    timings = ['total;dur=%.1f' % total_ms]
+    if metrics.view_ms is not None:
+        timings.append('view;dur=%.1f' % metrics.view_ms)
+    timings.append('db;dur=%.1f;desc="%d queries"' % (metrics.sql_ms, metrics.queries))
+    timings.append('tpl;dur=%.1f' % metrics.template_ms)
+    if repeated:
+        timings.append('repeated;desc="%d statements"' % len(repeated))
+    response['Server-Timing'] = ', '.join(timings)
+    route = route_name(request)
+    logger.info(json.dumps({
+        'ts': round(time.time(), 3),
+        'method': request.method,
+        'path': request.path,
+        'route': route,
+        'status': response.status_code,
+        'total_ms': round(total_ms, 2),
+        'view_ms': round(metrics.view_ms, 2) if metrics.view_ms is not None else None,
+        'db_ms': round(metrics.sql_ms, 2),
+        'queries': metrics.queries,
+        'template_ms': round(metrics.template_ms, 2),
+        'repeated': repeated,
+        'sample_rate': sample_rate(),
+    }, ensure_ascii=False))
+    observe(route, total_ms, metrics.queries, metrics.sql_ms)
+
+
+def increment(key, amount=1):
+    if not cache.add(key, amount, None):
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            pass
+
+
+def observe(route, total_ms, queries, sql_ms):
+    routes = cache.get('instrumentation:routes', set())
+    if route not in routes:
+        cache.set('instrumentation:routes', routes | {route}, None)
+    prefix = 'instrumentation:%s:' % route
+    increment(prefix + 'bucket:%d' % min(bisect.bisect_left(BUCKETS, total_ms), len(BUCKETS) - 1))
+    increment(prefix + 'requests')
+    increment(prefix + 'queries', queries)
+    # incr() only takes integers, so SQL time is kept in microseconds.
+    increment(prefix + 'sql_us', int(sql_ms * 1000))
+
+
+def stat_keys(route):
+    prefix = 'instrumentation:%s:' % route
+    return [prefix + 'requests', prefix + 'queries', prefix + 'sql_us'] + [
+        prefix + 'bucket:%d' % index for index in range(len(BUCKETS))]
+
+
+def stats():
+    # """
+    # Per-route request count, latency percentiles (bucket upper bounds, so within 25%) and mean queries
+    # and SQL time, over the sampled requests since the last reset.
+    # """
+    routes = sorted(cache.get('instrumentation:routes', set()))
+    values = cache.get_many([key for route in routes for key in stat_keys(route)])
+    result = {}
+    for route in routes:
+        prefix = 'instrumentation:%s:' % route
+        requests = values.get(prefix + 'requests', 0)
+        if not requests:
+            continue
+        counts = [values.get(prefix + 'bucket:%d' % index, 0) for index in range(len(BUCKETS))]
+        entry = {'requests': requests}
+        for percentile in PERCENTILES:
+            wanted = sum(counts) * percentile / 100
+            seen = 0
+            for index, count in enumerate(counts):
+                seen += count
+                if seen >= wanted:
+                    entry['p%d_ms' % percentile] = BUCKETS[index]
+                    break
+        entry['mean_queries'] = round(values.get(prefix + 'queries', 0) / requests, 2)
+        entry['mean_sql_ms'] = round(values.get(prefix + 'sql_us', 0) / requests / 1000, 2)
+        result[route] = entry
+    return {'sample_rate': sample_rate(), 'routes': result}
+
+
+def reset_stats():
+    routes = cache.get('instrumentation:routes', set())
+    cache.delete_many([key for route in routes for key in stat_keys(route)] + ['instrumentation:routes'])
+
+
+class InstrumentedTemplate:
+    # """
+    # Wraps a backend template to add its render time to the request's metrics. Templates rendered while
+    # another one renders (e.g. the cached category menu) are part of the outer one's time.
+    # """
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = current.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        metrics.rendering += 1
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.rendering -= 1
+            if not metrics.rendering:
+                metrics.template_ms += (time.perf_counter() - started) * 1000
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    # """
+    # The Django template backend, timing every render for the request instrumentation.
+    # """
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name))
@@ -0,0 +1,92 @@
+import asyncio
+import importlib
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+from django.urls import clear_url_caches
+
+DEFAULT_URLS = ['/', '/category/', '/product/1/', '/search/?searched=a']
+
+
+def use_urlconf(async_views):
+    # The URLconf picks the sync or async catalog views at import time, so re-import it.
+    with override_settings(ASYNC_VIEWS=async_views):
+        importlib.reload(importlib.import_module('app.urls'))
+        importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Compares requests/sec and latency of the sync views under the WSGI handler with '
+            'the async views under the ASGI handler, in process.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*', default=DEFAULT_URLS)
+        parser.add_argument('--requests', type=int, default=200, help='Requests per URL and handler.')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--page-cache', action='store_true', help='Leave the anonymous page cache on.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        results = []
+        timeout = settings.PAGE_CACHE_TIMEOUT if options['page_cache'] else 0
+        with override_settings(PAGE_CACHE_TIMEOUT=timeout, ALLOWED_HOSTS=['*']):
+            try:
+                for url in options['urls']:
+                    use_urlconf(False)
+                    results.append(dict(url=url, handler='wsgi', **self.run_wsgi(url, options)))
+                    use_urlconf(True)
+                    results.append(dict(url=url, handler='asgi', **asyncio.run(self.run_asgi(url, options))))
+            finally:
+                use_urlconf(settings.ASYNC_VIEWS)
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'url':<32} {'handler':<8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for row in results:
+            self.stdout.write(f"{row['url']:<32} {row['handler']:<8} {row['rps']:>8} {row['p50_ms']:>8} {row['p99_ms']:>8}")
+
+    def run_wsgi(self, url, options):
+        def fetch(_):
+            started = time.perf_counter()
+            response = Client().get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} returned {response.status_code}')
+            return time.perf_counter() - started
+
+        Client().get(url)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            latencies = list(pool.map(fetch, range(options['requests'])))
+        return summarize(latencies, time.perf_counter() - started)
+
+    async def run_asgi(self, url, options):
+        client = AsyncClient()
+        limit = asyncio.Semaphore(options['concurrency'])
+
+        async def fetch():
+            async with limit:
+                started = time.perf_counter()
+                response = await client.get(url)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{url} returned {response.status_code}')
+                return time.perf_counter() - started
+
+        await client.get(url)
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(fetch() for _ in range(options['requests'])))
+        return summarize(latencies, time.perf_counter() - started)
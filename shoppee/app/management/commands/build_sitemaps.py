@@ -0,0 +1,20 @@
+import time
+from django.core.management.base import BaseCommand
+from app import sitemaps
+
+
+class Command(BaseCommand):
+    help = ('Writes sitemap.xml, its segment sitemaps and the merchant product feed to SITEMAP_ROOT. '
+            'Only the segments whose products changed since the last run are rewritten.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Rewrite every segment.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        result = sitemaps.generate(force=options['force'])
+        elapsed = time.monotonic() - started
+        for segment in result['removed']:
+            self.stdout.write(f'Removed segment {segment}: no products left.')
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {len(result['written'])} segments, kept {len(result['unchanged'])} unchanged in {elapsed:.2f}s."))
@@ -0,0 +1,232 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils._os import safe_join
+from django.utils.text import slugify
+from app import autocomplete, facets, pagecache, search
+from app.models import Category, Product, Province
+
+# Columns of a CSV row, or keys of a JSONL object: name, price, discount, detail, province, digital,
+# image, categories, sub_category. Only name and price are required.
+#   categories: category slugs, separated by "|" in CSV or a list in JSONL
+#   sub_category: one category slug; province (or address): a province name, matched without diacritics
+#   image: a file name under MEDIA_ROOT, or under --image-dir to be copied there
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+
+class MalformedRow:
+    # A JSONL line that is not a JSON object; it still counts as a row, so checkpoints stay in step.
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def read_rows(path, fmt):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield MalformedRow(f'invalid JSON ({error})')
+                continue
+            yield row if isinstance(row, dict) else MalformedRow('not a JSON object')
+
+
+def write_checkpoint(path, state):
+    # Replaced atomically, so an interruption never leaves half a checkpoint.
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary, path)
+
+
+class Command(BaseCommand):
+    help = ('Imports products from a CSV or JSON Lines file in batches with bulk inserts. '
+            'Progress is checkpointed after every batch, so an interrupted import resumes where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--image-dir', help='Directory to copy image files from when they are not in MEDIA_ROOT yet.')
+        parser.add_argument('--create-categories', action='store_true',
+                            help='Create unknown category slugs as top-level categories instead of skipping them.')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f'{path} does not exist.')
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.batch_size = max(1, options['batch_size'])
+        self.image_dir = options['image_dir']
+        self.create_categories = options['create_categories']
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.provinces = {search.fold(name).strip(): name for name in Province.objects.values_list('name', flat=True)}
+        self.images = {}
+        self.warnings = {
+            'rows skipped': 0, 'malformed rows': 0, 'unknown categories': 0, 'unknown provinces': 0, 'missing images': 0,
+        }
+
+        checkpoint_path = path + '.checkpoint'
+        done = self.resume(checkpoint_path, path) if not options['restart'] else 0
+        if done:
+            self.stdout.write(f'Resuming after row {done}.')
+        rows = islice(read_rows(path, fmt), done, None)
+        started = time.monotonic()
+        imported = 0
+        line = done
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            products = []
+            links = []
+            for row in batch:
+                line += 1
+                try:
+                    product = self.build(row, line)
+                    if product is not None:
+                        links.append(self.category_ids(row))
+                        products.append(product)
+                except (AttributeError, TypeError, ValueError) as error:
+                    # A value of the wrong type, e.g. a number where a name or slug should be.
+                    self.malformed(line, f'unreadable value ({error})')
+                except SuspiciousFileOperation as error:
+                    # An image name like "../settings.py", outside MEDIA_ROOT or --image-dir.
+                    self.skip(line, f'unsafe image name ({error})')
+            with transaction.atomic():
+                Product.objects.bulk_create(products)
+                through = Product.category.through
+                through.objects.bulk_create([
+                    through(product_id=product.id, category_id=category_id)
+                    for product, category_ids in zip(products, links) for category_id in category_ids
+                ], ignore_conflicts=True)
+                ids = [product.id for product in products]
+                search.index_products(ids)
+                facets.apply_changes({}, facets.facets_for(ids))
+                # Written before the commit, with the last id to tell whether the commit happened.
+                write_checkpoint(checkpoint_path, {
+                    'source': os.path.abspath(path), 'rows': line, 'previous': line - len(batch),
+                    'last_id': ids[-1] if ids else None,
+                })
+            imported += len(products)
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'{line} rows read, {imported} imported, {imported / elapsed:.0f} rows/s')
+
+        autocomplete.index.invalidate()
+        pagecache.invalidate('listings')
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        elapsed = time.monotonic() - started
+        for name, count in self.warnings.items():
+            if count:
+                self.stdout.write(self.style.WARNING(f'{count} {name}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} products in {elapsed:.2f}s ({imported / elapsed if elapsed else 0:.0f} rows/s). '
+            'Run build_image_variants to resize their images.'))
+
+    def resume(self, checkpoint_path, path):
+        if not os.path.exists(checkpoint_path):
+            return 0
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        if state.get('source') != os.path.abspath(path):
+            raise CommandError(f'{checkpoint_path} belongs to another file; use --restart.')
+        # The last batch was interrupted before its commit: redo it.
+        if state.get('last_id') and not Product.objects.filter(id=state['last_id']).exists():
+            return state['previous']
+        return state['rows']
+
+    def skip(self, line, reason):
+        self.warnings['rows skipped'] += 1
+        self.stderr.write(f'Row {line}: {reason}')
+        return None
+
+    def malformed(self, line, reason):
+        self.warnings['malformed rows'] += 1
+        return self.skip(line, reason)
+
+    def build(self, row, line):
+        if isinstance(row, MalformedRow):
+            return self.malformed(line, row.reason)
+        name = (row.get('name') or '').strip()
+        if not name:
+            return self.skip(line, 'no name')
+        try:
+            price = float(row.get('price'))
+            discount = int(row.get('discount') or 0)
+        except (TypeError, ValueError):
+            return self.skip(line, 'price and discount must be numbers')
+        sub_category = None
+        if row.get('sub_category'):
+            sub_category = self.category_id(row['sub_category'])
+        product = Product(
+            name=name,
+            price=price,
+            discount=discount,
+            detail=row.get('detail') or None,
+            address=self.province(row.get('province') or row.get('address')),
+            digital=str(row.get('digital', '')).strip().lower() in TRUE_VALUES,
+            image=self.image(row.get('image')),
+            sub_category_id=sub_category,
+        )
+        return product
+
+    def category_id(self, slug):
+        slug = slug.strip()
+        if slug not in self.categories:
+            # A name whose slug exists, e.g. "Áo nam" for ao-nam, is that category.
+            normalized = slugify(slug) or slug
+            if normalized in self.categories:
+                self.categories[slug] = self.categories[normalized]
+                return self.categories[slug]
+            if not self.create_categories:
+                self.warnings['unknown categories'] += 1
+                return None
+            # get_or_create, as another import may have created it since the slugs were loaded.
+            category, created = Category.objects.get_or_create(slug=normalized, defaults={'name': slug})
+            self.categories[slug] = self.categories[normalized] = category.id
+        return self.categories[slug]
+
+    def category_ids(self, row):
+        slugs = row.get('categories') or []
+        if isinstance(slugs, str):
+            slugs = slugs.split('|')
+        ids = (self.category_id(slug) for slug in slugs if slug.strip())
+        return list(dict.fromkeys(pk for pk in ids if pk is not None))
+
+    def province(self, name):
+        if not name:
+            return None
+        found = self.provinces.get(search.fold(name).strip())
+        if found is None:
+            self.warnings['unknown provinces'] += 1
+            return name.strip()
+        return found
+
+    def image(self, name):
+        if not name:
+            return None
+        name = name.strip()
+        if name not in self.images:
+            if default_storage.exists(name):
+                self.images[name] = name
+            elif self.image_dir and os.path.isfile(safe_join(self.image_dir, name)):
+                with open(safe_join(self.image_dir, name), 'rb') as f:
+                    self.images[name] = default_storage.save(os.path.basename(name), File(f))
+            else:
+                self.warnings['missing images'] += 1
+                self.images[name] = None
+        return self.images[name]
@@ -0,0 +1,43 @@
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def copy_database(source, target):
+    # """
+    # Copies the SQLite database at source into target with the online backup API. Connections to either
+    # file may stay open: readers of the target see the old or the new copy, never a mix of both.
+    # """
+    primary = sqlite3.connect(source)
+    replica = sqlite3.connect(target)
+    try:
+        primary.backup(replica)
+    finally:
+        replica.close()
+        primary.close()
+
+
+class Command(BaseCommand):
+    help = ('Copies the primary SQLite database into every replica in DATABASE_REPLICAS. '
+            'With --interval, keeps doing so every that many seconds.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help='Seconds between copies; copies once when omitted.')
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES['default']
+        targets = [settings.DATABASES[alias] for alias in settings.DATABASE_REPLICAS]
+        if not targets:
+            raise CommandError('No replicas in DATABASE_REPLICAS; set SHOPPEE_REPLICA=1.')
+        if any(db['ENGINE'] != 'django.db.backends.sqlite3' for db in [primary, *targets]):
+            raise CommandError('sync_replica only copies SQLite databases; use the database\'s own replication.')
+        while True:
+            started = time.monotonic()
+            for target in targets:
+                copy_database(str(primary['NAME']), str(target['NAME']))
+            elapsed = time.monotonic() - started
+            self.stdout.write(self.style.SUCCESS(f'Copied the primary to {len(targets)} replicas in {elapsed:.2f}s.'))
+            if not options['interval']:
+                return
+            time.sleep(max(0, options['interval'] - elapsed))
@@ -0,0 +1,248 @@
+import threading
+import time
+from urllib.parse import urlsplit
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+from . import instrumentation, profiling, routers, staticfiles
+from .cart import Cart
+
+
+class CartMiddleware:
+    # """
+    # Attaches a lazy Cart to every request as request.cart, and writes the anonymous cart cookie
+    # when the request changed it.
+    # Must come after AuthenticationMiddleware, since the cart belongs to request.user.
+    # """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.cart = Cart(request)
+        response = self.get_response(request)
+        request.cart.save(response)
+        return response
+
+    async def __acall__(self, request):
+        request.cart = Cart(request)
+        response = await self.get_response(request)
+        request.cart.save(response)
+        return response
+
+
+class StaticFilesMiddleware:
+    # """
+    # Serves STATIC_URL and MEDIA_URL without DEBUG, before the session, auth and cart middleware run.
+    # Static files come from STATIC_ROOT (run collectstatic first); see staticfiles.serve for the headers.
+    # """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        self.prefixes = [
+            (self.url_path(settings.STATIC_URL), 'static'),
+            (self.url_path(settings.MEDIA_URL), 'media'),
+        ]
+
+    @staticmethod
+    def url_path(url):
+        return '/' + urlsplit(url).path.lstrip('/') if url else None
+
+    def match(self, request):
+        for prefix, root in self.prefixes:
+            if prefix and prefix != '/' and request.path_info.startswith(prefix):
+                return request.path_info[len(prefix):], root
+        return None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        target = self.match(request)
+        if target:
+            return staticfiles.serve(request, *target)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        target = self.match(request)
+        if not target:
+            return await self.get_response(request)
+        response = await sync_to_async(staticfiles.serve, thread_sensitive=False)(request, *target)
+        if response.streaming:
+            response.streaming_content = staticfiles.async_chunks(response.streaming_content)
+        return response
+
+
+class ProfilingMiddleware:
+    # """
+    # Runs a request under the profiler when it carries a staff profiling token; see profiling.py.
+    # Place it right after StaticFilesMiddleware, so the profile covers the rest of the middleware too.
+    # """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = profiling.requested(request)
+        if token is None:
+            return self.get_response(request)
+        if profiling.token_user(token) is None:
+            return self.rejected(self.get_response(request))
+        # A cached page would profile the cache lookup, not the view.
+        request.profiling = True
+        profile = profiling.RequestProfile(request, profiling.mode(request), {threading.get_ident()})
+        profile.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.stop()
+        response['X-Profile'] = profile.save(response)
+        return response
+
+    async def __acall__(self, request):
+        token = profiling.requested(request)
+        if token is None:
+            return await self.get_response(request)
+        if await sync_to_async(profiling.token_user)(token) is None:
+            return self.rejected(await self.get_response(request))
+        request.profiling = True
+        profile = profiling.RequestProfile(request, profiling.mode(request))
+        profile.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profile.stop()
+        response['X-Profile'] = await sync_to_async(profile.save, thread_sensitive=False)(response)
+        return response
+
+    @staticmethod
+    def rejected(response):
+        response['X-Profile'] = 'invalid or expired token'
+        return response
+
+
+class DatabaseRoutingMiddleware:
+    # """
+    # Lets GET and HEAD requests read the catalog from the replicas (see routers.py). After a request writes
+    # to the catalog, a cookie keeps that browser on the primary for REPLICA_PIN_SECONDS.
+    # Place it before the session middleware.
+    # """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing = routers.start(request)
+        return self.pin(routing, self.get_response(request))
+
+    async def __acall__(self, request):
+        routing = routers.start(request)
+        return self.pin(routing, await self.get_response(request))
+
+    @staticmethod
+    def pin(routing, response):
+        routers.state.set(None)
+        if routing.wrote:
+            response.set_cookie(routers.PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                                samesite='Lax')
+        return response
+
+
+class InstrumentationMiddleware:
+    # """
+    # Records the SQL, template and view time of a sample of requests (settings.INSTRUMENTATION_SAMPLE_RATE)
+    # and reports it in a Server-Timing header, a JSON log line and the per-route stats; see instrumentation.py.
+    # Place it before the session middleware so its time is included, and ViewTimingMiddleware last.
+    # """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not instrumentation.sampled():
+            return self.get_response(request)
+        # This thread's connections may predate the connection_created hook.
+        instrumentation.install(connection)
+        metrics = instrumentation.Metrics()
+        token = instrumentation.current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            instrumentation.current.reset(token)
+        instrumentation.finish(metrics, request, response)
+        return response
+
+    async def __acall__(self, request):
+        if not instrumentation.sampled():
+            return await self.get_response(request)
+        metrics = instrumentation.Metrics()
+        token = instrumentation.current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            instrumentation.current.reset(token)
+        await sync_to_async(instrumentation.finish, thread_sensitive=False)(metrics, request, response)
+        return response
+
+
+class ViewTimingMiddleware:
+    # """
+    # Times the URL resolving, view and template response rendering for InstrumentationMiddleware.
+    # Must be the last middleware.
+    # """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = instrumentation.current.get()
+        if metrics is None:
+            return self.get_response(request)
+        started = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            metrics.view_ms = (time.perf_counter() - started) * 1000
+
+    async def __acall__(self, request):
+        metrics = instrumentation.current.get()
+        if metrics is None:
+            return await self.get_response(request)
+        started = time.perf_counter()
+        try:
+            return await self.get_response(request)
+        finally:
+            metrics.view_ms = (time.perf_counter() - started) * 1000
@@ -0,0 +1,56 @@
+import unicodedata
+
+from django.db import migrations
+
+# Self-contained: the table name and fold() are copied from app/search.py as they were when this migration
+# was written, so later changes to the app's code or models don't change what it does.
+SEARCH_TABLE = 'app_product_search'
+
+
+def fold(text):
+    if not text:
+        return ''
+    text = text.lower().replace('đ', 'd')
+    text = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+        f"USING fts5(name, detail, categories, tokenize='unicode61 remove_diacritics 2')"
+    )
+    # Each product's document: its folded name and detail, and the names of its categories and sub-category.
+    schema_editor.connection.ensure_connection()
+    schema_editor.connection.connection.create_function('migration_fold', 1, fold, deterministic=True)
+    schema_editor.execute(f"""
+        INSERT INTO {SEARCH_TABLE} (rowid, name, detail, categories)
+        SELECT product.id, migration_fold(product.name), migration_fold(product.detail), migration_fold((
+            SELECT group_concat(name, ' ') FROM (
+                SELECT DISTINCT category.name FROM app_category category
+                WHERE category.name IS NOT NULL AND category.name != ''
+                AND (category.id = product.sub_category_id OR category.id IN (
+                    SELECT category_id FROM app_product_category WHERE product_id = product.id))
+                ORDER BY category.name
+            )
+        ))
+        FROM app_product product
+    """)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_province'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:41
+
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def count_facets(apps, schema_editor):
+    # Same rules as facets.facets_for(), on the historical models.
+    Product = apps.get_model('app', 'Product')
+    FacetCount = apps.get_model('app', 'FacetCount')
+    bands = ((0, 10, '0-10'), (10, 50, '10-50'), (50, 200, '50-200'), (200, 1000, '200-1000'), (1000, None, '1000+'))
+    totals = Counter()
+    values = {}
+    for pk, address, price, discount, sub_path in Product.objects.values_list(
+            'id', 'address', 'price', 'discount', 'sub_category__path'):
+        facets = values[pk] = set()
+        if address:
+            facets.add(('province', address))
+        total = price * (100 - discount) / 100
+        facets.update(('price', name) for low, high, name in bands if total >= low and (high is None or total < high))
+        facets.update(('discount', str(step)) for step in (10, 20, 30, 50) if discount >= step)
+        facets.update(('category', str(int(segment))) for segment in (sub_path or '').split('/') if segment)
+    for pk, path in Product.category.through.objects.values_list('product_id', 'category__path'):
+        values[pk].update(('category', str(int(segment))) for segment in (path or '').split('/') if segment)
+    for facets in values.values():
+        totals.update(facets)
+    FacetCount.objects.bulk_create(
+        [FacetCount(facet=facet, value=value, count=count) for (facet, value), count in totals.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_category_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=20)),
+                ('value', models.CharField(max_length=200)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('facet', 'value'), name='unique_facet_value')],
+            },
+        ),
+        migrations.RunPython(count_facets, migrations.RunPython.noop),
+    ]
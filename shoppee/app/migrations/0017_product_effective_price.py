@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:42
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_effective_price(apps, schema_editor):
+    # Same as Product.get_total().
+    Product = apps.get_model('app', 'Product')
+    Product.objects.filter(discount=0).update(effective_price=F('price'))
+    Product.objects.exclude(discount=0).update(effective_price=F('price') * (100 - F('discount')) / 100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_facetcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['effective_price', 'id'], name='product_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['discount', 'id'], name='product_discount_idx'),
+        ),
+        migrations.RunPython(fill_effective_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:43
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # Folds repeated (order, product) lines into the oldest one before the constraint is added.
+    OrderItem = apps.get_model('app', 'OrderItem')
+    duplicates = (OrderItem.objects.filter(order__isnull=False, product__isnull=False)
+                  .values('order', 'product').annotate(lines=Count('id'), quantity=Sum('quantity'))
+                  .filter(lines__gt=1))
+    for duplicate in duplicates:
+        lines = OrderItem.objects.filter(order=duplicate['order'], product=duplicate['product']).order_by('id')
+        keep = lines.first()
+        lines.exclude(id=keep.id).delete()
+        OrderItem.objects.filter(id=keep.id).update(quantity=duplicate['quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_product_effective_price'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'product'), name='unique_order_product'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+# A plain column can't be altered into a generated one, so the column (and its index) is dropped and added back.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_price_idx',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='effective_price',
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=models.Case(
+                    models.When(discount=0, then=models.F('price')),
+                    default=models.F('price') * (100 - models.F('discount')) / 100,
+                ),
+                output_field=models.FloatField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['effective_price', 'id'], name='product_price_idx'),
+        ),
+    ]
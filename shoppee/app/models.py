@@ -1,6 +1,12 @@
-from django.db import models
+from django.db import models, transaction
+from django.core.exceptions import ValidationError
+from django.db.models import Case, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Concat, Substr
+from django.urls import reverse
+from django.utils.functional import cached_property
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
+from django import forms
 
 # Create your models here.
 #Change form register
@@ -31,17 +37,53 @@ class Category(models.Model):
     #     name (models.CharField): The name of the category.
     #     slug (models.SlugField): The slug for the category, used in URLs.
     #     image (models.ImageField): An optional image for the category.
+    #     image_variants (models.JSONField): Resized copies of the image, written by images.py.
+    #     path (models.CharField): Materialized path of the category in the tree, e.g. "000002/000003/".
+    #                              Maintained by save(); a category's descendants are the rows whose path
+    #                              starts with its own.
+    #     depth (models.PositiveSmallIntegerField): Number of ancestors, 0 for top-level categories.
         
     # Outputs:
     #     The string representation of the category name.
+    #     descendant_lookup(path, prefix): Filter kwargs matching a path and everything below it.
     # """
     sub_category=models.ForeignKey('self',on_delete=models.CASCADE,related_name='sub_categories',null=True,blank=True)
     is_sub=models.BooleanField(default=False)
     name = models.CharField(max_length=200,null=True)
     slug = models.SlugField(max_length=200,unique=True)
     image = models.ImageField(null=True,blank=True)
+    image_variants = models.JSONField(default=dict,blank=True,editable=False)
+    path = models.CharField(max_length=255,db_index=True,editable=False,default='')
+    depth = models.PositiveSmallIntegerField(default=0,editable=False)
     def __str__(self):
         return self.name
+    @staticmethod
+    def descendant_lookup(path, prefix=''):
+        # A range instead of startswith, so the path index is used on every backend:
+        # '/' sorts just before '0', so "000002/..." lies in ["000002/", "0000020").
+        return {prefix + 'path__gte': path, prefix + 'path__lt': path[:-1] + '0'}
+    def build_path(self):
+        parent_path = self.sub_category.path if self.sub_category_id else ''
+        return parent_path + '%06d/' % self.pk
+    def clean(self):
+        parent = self.sub_category
+        if parent is not None and self.pk and (parent.pk == self.pk or (self.path and parent.path.startswith(self.path))):
+            raise ValidationError({'sub_category': 'A category cannot be placed under itself or its descendants.'})
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            old_path, old_depth = self.path, self.depth
+            path = self.build_path()
+            if path == old_path:
+                return
+            depth = path.count('/') - 1
+            Category.objects.filter(pk=self.pk).update(path=path, depth=depth)
+            if old_path:
+                Category.objects.filter(**Category.descendant_lookup(old_path)).exclude(pk=self.pk).update(
+                    path=Concat(Value(path), Substr('path', len(old_path) + 1)),
+                    depth=F('depth') + (depth - old_depth),
+                )
+            self.path, self.depth = path, depth
     @property
     def ImageURL(self):
         try:
@@ -68,6 +110,22 @@ class SubCategory(models.Model):
         return self.name
     def get_all_sub_categories(self):
         return self.name
+class ProductQuerySet(models.QuerySet):
+    # """
+    # Query helpers for product listings.
+
+    # Output:
+    #     cards(): Only loads the columns a product card renders, leaving out large fields such as detail.
+    #     in_category(path): Products under a category, including its descendants, in one query.
+    # """
+    CARD_FIELDS = ('id', 'name', 'price', 'discount', 'effective_price', 'image', 'image_variants')
+    def cards(self):
+        return self.only(*self.CARD_FIELDS)
+    def in_category(self, path):
+        # Products in the category with this materialized path or any of its descendants.
+        through = self.model.category.through
+        linked = through.objects.filter(**Category.descendant_lookup(path, 'category__')).values('product_id')
+        return self.filter(Q(id__in=linked) | Q(**Category.descendant_lookup(path, 'sub_category__')))
 class Product(models.Model):
     # """
     # The Product class represents a product entity in the system.
@@ -79,13 +137,19 @@ class Product(models.Model):
     #     price (models.FloatField): The price of the product.
     #     digital (models.BooleanField): Indicates whether the product is digital or not.
     #     image (models.ImageField): The image of the product.
+    #     image_variants (models.JSONField): Resized copies of the image, written by images.py.
     #     detail (models.TextField): The detailed description of the product.
     #     discount (models.IntegerField): The discount percentage applied to the product.
     #     address (models.CharField): The address of the product.
+    #     effective_price (models.GeneratedField): The price after discount (get_total()), computed and stored
+    #                                              by the database, so it stays right after update() and
+    #                                              bulk writes, and listings can sort and filter on it with an index.
+    #     updated_at (models.DateTimeField): When the product last changed; the Last-Modified/ETag of its pages.
 
     # Output:
     #     __str__(): Returns the name of the product.
     #     ImageURL: Returns the URL of the product image.
+    #     get_absolute_url(): Returns the canonical URL of the product page.
     #     get_total(): Calculates the total price of the product after applying the discount.
     # """
     category = models.ManyToManyField(Category,related_name="product")
@@ -94,11 +158,35 @@ class Product(models.Model):
     price = models.FloatField()
     digital = models.BooleanField(default=False,null=True,blank=False)
     image = models.ImageField(null=True,blank=True)
+    image_variants = models.JSONField(default=dict,blank=True,editable=False)
     detail =models.TextField(null=True,blank=True)
     discount = models.IntegerField(default=0)
     address = models.CharField(max_length=200,null=True)
+    # Same arithmetic as get_total(), so both give the same float.
+    effective_price = models.GeneratedField(
+        expression=Case(
+            When(discount=0, then=F('price')),
+            default=F('price') * (100 - F('discount')) / 100,
+        ),
+        output_field=models.FloatField(),
+        db_persist=True,
+    )
+    updated_at = models.DateTimeField(auto_now=True,db_index=True)
+    objects = ProductQuerySet.as_manager()
+    class Meta:
+        indexes = [
+            models.Index(fields=['effective_price', 'id'], name='product_price_idx'),
+            models.Index(fields=['discount', 'id'], name='product_discount_idx'),
+        ]
     def __str__(self):
         return self.name
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'updated_at'}
+        super().save(*args, **kwargs)
+    def get_absolute_url(self):
+        return reverse('product', args=[self.id])
     @property
     def ImageURL(self):
         try:
@@ -120,9 +208,14 @@ class Order(models.Model):
     #     date_order (models.DateTimeField): The date and time the order was placed.
     #     complete (models.BooleanField): Indicates whether the order is complete or not.
     #     transaction_id (models.CharField): The unique identifier for the order transaction.
+    #     idempotency_key (models.CharField): The client-supplied key of the checkout that completed the order,
+    #                                         so a retried checkout returns the same order.
+    #     total_items / total: The item count and price total frozen at checkout.
 
     # Output:
     #     __str__(): Returns the order ID.
+    #     cart_totals: Item count and price total of the order, computed in one aggregate query
+    #                  and cached on the instance for the rest of the request; frozen totals once complete.
     #     get_cart_items: Calculates the total number of items in the order.
     #     get_cart_total: Calculates the total price of the items in the order.
     # """
@@ -130,18 +223,45 @@ class Order(models.Model):
     date_order = models.DateTimeField(auto_now_add=True)
     complete = models.BooleanField(default=False,null=True,blank=False)
     transaction_id = models.CharField(max_length=200,null=True)
+    idempotency_key = models.CharField(max_length=64,null=True,blank=True)
+    total_items = models.IntegerField(null=True,blank=True)
+    total = models.FloatField(null=True,blank=True)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'idempotency_key'], name='unique_customer_checkout_key'),
+        ]
     def __str__(self):
         return str(self.id)
+    @cached_property
+    def cart_totals(self):
+        if self.complete and self.total is not None:
+            return {'items': self.total_items, 'total': self.total}
+        return self.orderitem_set.totals()
     @property
     def get_cart_items(self):
-        orderitems = self.orderitem_set.all()
-        total = sum([item.quantity for item in orderitems])
-        return total
+        return self.cart_totals['items']
     @property
     def get_cart_total(self):
-        orderitems = self.orderitem_set.all()
-        total = sum([item.get_total for item in orderitems])
-        return total
+        return self.cart_totals['total']
+class OrderItemQuerySet(models.QuerySet):
+    # """
+    # Aggregates over order items.
+
+    # Output:
+    #     totals(): A dict with the summed quantity ('items') and the discounted price total ('total')
+    #               of the items in the queryset, computed by the database in a single query.
+    #     per_order(): The same sums grouped by order, e.g. for use as a subquery.
+    # """
+    def _sums(self):
+        line_total = F('quantity') * F('product__price') * (100 - F('product__discount')) / 100
+        return {
+            'items': Coalesce(Sum('quantity'), 0),
+            'total': Coalesce(Sum(line_total, output_field=FloatField()), Value(0.0)),
+        }
+    def totals(self):
+        return self.aggregate(**self._sums())
+    def per_order(self):
+        return self.values('order').annotate(**self._sums())
 class OrderItem(models.Model):
     # """
     # The OrderItem class represents an item in a customer order.
@@ -159,6 +279,11 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order,on_delete=models.SET_NULL,null=True,blank=True)
     quantity=models.IntegerField(default=0,null=True,blank=True)
     date_added = models.DateTimeField(auto_now_add=True)
+    objects = OrderItemQuerySet.as_manager()
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'product'], name='unique_order_product'),
+        ]
     @property
     def get_total(self):
         total =  self.product.price * self.quantity * (100-self.product.discount) /100
@@ -189,6 +314,13 @@ class ShippingAddress(models.Model):
     
     def __str__(self):
         return self.address
+class ShippingAddressForm(forms.ModelForm):
+    # """
+    # Validates the shipping fields posted by the checkout page.
+    # """
+    class Meta:
+        model = ShippingAddress
+        fields = ['address', 'city', 'state', 'mobile']
 
 class Province(models.Model):
     # """
@@ -210,4 +342,29 @@ class Province(models.Model):
 
     def get_all_sub_categories(self):
         return self.name
-    
\ No newline at end of file
+    
+class FacetCount(models.Model):
+    # """
+    # The FacetCount class stores how many products carry each filter value, so listing pages can show
+    # facet counts without counting products per checkbox. Rows are kept up to date by the product
+    # signals (see facets.py) and can be rebuilt with the rebuild_facets command.
+
+    # Input:
+    #     facet (models.CharField): The facet name: 'province', 'price', 'discount' or 'category'.
+    #     value (models.CharField): The facet value, e.g. a province name, price band or category id.
+    #     count (models.IntegerField): The number of products with that value.
+
+    # Output:
+    #     __str__(): Returns "facet=value: count".
+    # """
+    facet = models.CharField(max_length=20)
+    value = models.CharField(max_length=200)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['facet', 'value'], name='unique_facet_value'),
+        ]
+
+    def __str__(self):
+        return '%s=%s: %s' % (self.facet, self.value, self.count)
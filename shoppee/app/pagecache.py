@@ -0,0 +1,146 @@
+import hashlib
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+# Cookies that mean the page may be personal: the anonymous cart and pending flash messages.
+BYPASS_COOKIES = ('cart', 'messages')
+# Query parameters that never change the page (analytics tags).
+IGNORED_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid', 'gclid')
+STATS = ('hit', 'miss', 'bypass')
+
+
+def normalized_query(query):
+    # Same page for ?b=2&a=1, ?a=1&b=2&a= and ?a=1&b=2&utm_source=x.
+    pairs = sorted((key, value) for key, values in query.lists() for value in values
+                   if value != '' and key not in IGNORED_PARAMS)
+    return urlencode(pairs)
+
+
+def versions(*scopes):
+    # The current version of each scope, e.g. for an ETag that must change with the cached pages.
+    found = cache.get_many(['pagecache:version:%s' % scope for scope in scopes])
+    return [found.get('pagecache:version:%s' % scope, 0) for scope in scopes]
+
+
+def invalidate(*scopes):
+    # """
+    # Drops every cached page of the given scopes, by bumping their version instead of deleting keys.
+    # 'site' covers every page; 'listings' the product lists; 'product:<id>' one product's detail page.
+    # """
+    for scope in scopes:
+        key = 'pagecache:version:%s' % scope
+        if not cache.add(key, 1, None):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, None)
+
+
+def count(stat):
+    key = 'pagecache:stats:%s' % stat
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+
+def stats():
+    values = cache.get_many(['pagecache:stats:%s' % stat for stat in STATS])
+    result = {stat: values.get('pagecache:stats:%s' % stat, 0) for stat in STATS}
+    lookups = result['hit'] + result['miss']
+    result['hit_rate'] = round(result['hit'] / lookups, 4) if lookups else None
+    return result
+
+
+def reset_stats():
+    cache.delete_many(['pagecache:stats:%s' % stat for stat in STATS])
+
+
+def bypass(request):
+    if request.method not in ('GET', 'HEAD') or getattr(request, 'profiling', False):
+        return True
+    if any(name in request.COOKIES for name in BYPASS_COOKIES):
+        return True
+    # Only a request with a session can be logged in; don't load one when there is none.
+    return settings.SESSION_COOKIE_NAME in request.COOKIES and request.user.is_authenticated
+
+
+def anonymous_page_cache(*scopes):
+    # """
+    # Caches a view's whole page for anonymous visitors, keyed by path and normalized query string.
+    # Works on sync and async views.
+
+    # Input:
+    # - scopes: The invalidation scopes the page depends on (see invalidate), besides 'site'.
+    #   A callable gets the view's arguments and returns a scope, e.g. the product of a detail page.
+
+    # Output:
+    # - The decorated view. Responses carry X-Page-Cache: HIT, MISS or BYPASS, and the same counts
+    #   are kept in the cache (see stats). Timeout is settings.PAGE_CACHE_TIMEOUT seconds.
+    # """
+    def version_keys(request, args, kwargs):
+        names = ['site'] + [scope(request, *args, **kwargs) if callable(scope) else scope for scope in scopes]
+        return ['pagecache:version:%s' % name for name in names]
+
+    def page_key(request, keys, versions):
+        digest = hashlib.md5(('%s?%s' % (request.path, normalized_query(request.GET))).encode()).hexdigest()
+        return 'pagecache:page:%s:%s' % ('.'.join(str(versions.get(key, 0)) for key in keys), digest)
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if await sync_to_async(bypass)(request):
+                    await sync_to_async(count)('bypass')
+                    return mark(await view(request, *args, **kwargs), 'BYPASS')
+                keys = version_keys(request, args, kwargs)
+                key = page_key(request, keys, await cache.aget_many(keys))
+                cached = await cache.aget(key)
+                if cached is not None:
+                    await sync_to_async(count)('hit')
+                    return mark(HttpResponse(cached[0], content_type=cached[1]), 'HIT')
+                await sync_to_async(count)('miss')
+                response = await view(request, *args, **kwargs)
+                if cacheable(request, response):
+                    await cache.aset(key, (response.content, response['Content-Type']), timeout())
+                return mark(response, 'MISS')
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if bypass(request):
+                count('bypass')
+                return mark(view(request, *args, **kwargs), 'BYPASS')
+            keys = version_keys(request, args, kwargs)
+            key = page_key(request, keys, cache.get_many(keys))
+            cached = cache.get(key)
+            if cached is not None:
+                count('hit')
+                return mark(HttpResponse(cached[0], content_type=cached[1]), 'HIT')
+            count('miss')
+            response = view(request, *args, **kwargs)
+            if cacheable(request, response):
+                cache.set(key, (response.content, response['Content-Type']), timeout())
+            return mark(response, 'MISS')
+        return wrapper
+    return decorator
+
+
+def cacheable(request, response):
+    # Pages that used the CSRF token embed it, so they are not the same for everyone.
+    return (response.status_code == 200 and not response.streaming and not response.cookies
+            and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE'))
+
+
+def timeout():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', 300)
+
+
+def mark(response, state):
+    response['X-Page-Cache'] = state
+    return response
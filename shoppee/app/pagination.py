@@ -0,0 +1,152 @@
+import base64
+import binascii
+import json
+import math
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+PAGE_SIZE = 20
+# SQLite integers are signed 64-bit; a larger cursor value would fail when bound to the query.
+MIN_INTEGER, MAX_INTEGER = -2 ** 63, 2 ** 63 - 1
+INTEGER_FIELDS = ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField', 'PositiveIntegerField',
+                  'SmallIntegerField', 'PositiveSmallIntegerField')
+TEXT_FIELDS = ('CharField', 'SlugField', 'TextField')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    data = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def valid_value(model, field, value):
+    # Whether a decoded cursor value has the type of its ordering column. Cursors come from the client,
+    # so anything else (a string for an id, a list, null) must not reach the query.
+    kind = model._meta.get_field(field.lstrip('-')).get_internal_type()
+    if isinstance(value, bool):
+        return False
+    if kind in INTEGER_FIELDS:
+        return isinstance(value, int) and MIN_INTEGER <= value <= MAX_INTEGER
+    if kind == 'FloatField':
+        return isinstance(value, (int, float)) and math.isfinite(value)
+    if kind in TEXT_FIELDS:
+        return isinstance(value, str)
+    return False
+
+
+def cursor_values(queryset, ordering, cursor, strict=False):
+    # """
+    # Decodes a cursor for the ordering: one value per column, each of the column's type.
+    # Returns None when there is no cursor. A bad cursor is ignored, or raises InvalidCursor when strict.
+    # """
+    if not cursor:
+        return None
+    values = decode_cursor(cursor)
+    if (values is None or len(values) != len(ordering)
+            or not all(valid_value(queryset.model, field, value) for field, value in zip(ordering, values))):
+        if strict:
+            raise InvalidCursor('invalid cursor')
+        return None
+    return values
+
+
+def _seek_filter(ordering, values, forward):
+    # Builds (a > x) OR (a = x AND b > y) OR ... for the ordering columns,
+    # flipping the comparison for descending columns and for backward paging.
+    condition = Q()
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        ascending = (not field.startswith('-')) == forward
+        condition |= equal & Q(**{name + ('__gt' if ascending else '__lt'): value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+class KeysetPage:
+    # """
+    # One page of a keyset (cursor) paginated queryset.
+
+    # Outputs:
+    #     items: The objects on this page.
+    #     next_cursor / prev_cursor: Opaque cursors for the neighbouring pages, or None.
+    #     next_query / prev_query: The current query string with the cursor swapped in, for links.
+    # """
+    def __init__(self, items, ordering, has_next, has_prev, params=None):
+        self.items = items
+        self.ordering = ordering
+        self.next_cursor = self._cursor(items[-1]) if has_next and items else None
+        self.prev_cursor = self._cursor(items[0]) if has_prev and items else None
+        self.next_query = self._query(params, 'after', self.next_cursor)
+        self.prev_query = self._query(params, 'before', self.prev_cursor)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cursor(self, obj):
+        return encode_cursor([getattr(obj, field.lstrip('-')) for field in self.ordering])
+
+    def _query(self, params, key, cursor):
+        if cursor is None or params is None:
+            return None
+        params = params.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        params[key] = cursor
+        return params.urlencode()
+
+
+def keyset_paginate(queryset, ordering, after=None, before=None, size=PAGE_SIZE, params=None, strict=False):
+    # """
+    # Returns a KeysetPage of the queryset without OFFSET, so deep pages cost the same as the first.
+
+    # Input:
+    #     ordering (list): Columns to order by, e.g. ['-id'] or ['effective_price', 'id'].
+    #                      The last column must be unique and no column may be NULL.
+    #     after / before (str): Cursor of the row to page forward from / backward from.
+    #     params (QueryDict): The request's query string, used to build next/prev links.
+    #     strict (bool): Raise InvalidCursor for a malformed cursor instead of showing the first page.
+    # """
+    query, make_page = plan_page(queryset, ordering, after, before, size, params, strict)
+    return make_page(list(query))
+
+
+async def akeyset_paginate(queryset, ordering, after=None, before=None, size=PAGE_SIZE, params=None, strict=False):
+    # Same as keyset_paginate, with the page fetched through the async ORM.
+    query, make_page = plan_page(queryset, ordering, after, before, size, params, strict)
+    return make_page([row async for row in query])
+
+
+def plan_page(queryset, ordering, after=None, before=None, size=PAGE_SIZE, params=None, strict=False):
+    # Returns the query of one page (size + 1 rows, to see whether there is another one)
+    # and the function that turns its rows into the KeysetPage.
+    ordering = list(ordering)
+    after_values = cursor_values(queryset, ordering, after, strict)
+    before_values = cursor_values(queryset, ordering, before, strict)
+    if before_values is not None:
+        reverse = [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+        query = queryset.filter(_seek_filter(ordering, before_values, False)).order_by(*reverse)[:size + 1]
+        return query, lambda rows: KeysetPage(
+            rows[:size][::-1], ordering, has_next=True, has_prev=len(rows) > size, params=params)
+    if after_values is not None:
+        queryset = queryset.filter(_seek_filter(ordering, after_values, True))
+    query = queryset.order_by(*ordering)[:size + 1]
+    return query, lambda rows: KeysetPage(
+        rows[:size], ordering, has_next=len(rows) > size, has_prev=after_values is not None, params=params)
@@ -0,0 +1,175 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.utils.text import slugify
+
+# On-demand profiling of single requests, for staff. A staff user gets a signed token from profiling/token/
+# and sends it with the request to profile, as an X-Profile header or a _profile query parameter:
+#     curl -H "X-Profile: <token>" https://shop.example.com/
+# The request then runs under a sampling profiler (or cProfile with X-Profile-Mode / _profile_mode=cprofile)
+# and its profile is written to PROFILE_ROOT; the response's X-Profile header names the files:
+#   <name>.collapsed   stacks in the collapsed format of flamegraph.pl, speedscope and inferno (sampling)
+#   <name>.prof        pstats data, e.g. for snakeviz (cprofile)
+#   <name>.txt         the top functions by own and cumulative time
+# Requests without a token only pay for a header and a query string lookup.
+
+HEADER = 'HTTP_X_PROFILE'
+PARAMETER = '_profile'
+SALT = 'app.profiling'
+TOP = 40
+
+
+def requested(request):
+    if HEADER in request.META:
+        return request.META[HEADER]
+    if PARAMETER + '=' in request.META.get('QUERY_STRING', ''):
+        return request.GET.get(PARAMETER)
+    return None
+
+
+def make_token(user):
+    return signing.TimestampSigner(salt=SALT).sign(str(user.pk))
+
+
+def token_user(token):
+    # The staff user who requested the token, or None when it is forged, expired or its user lost staff.
+    try:
+        pk = signing.TimestampSigner(salt=SALT).unsign(token, max_age=settings.PROFILE_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    return User.objects.filter(pk=pk, is_staff=True, is_active=True).first()
+
+
+def mode(request):
+    value = request.META.get('HTTP_X_PROFILE_MODE') or request.GET.get('_profile_mode', '')
+    return 'cprofile' if value == 'cprofile' else 'sampling'
+
+
+def frame_label(code):
+    filename = code.co_filename
+    for prefix in sorted({str(settings.BASE_DIR), *sys.path}, key=len, reverse=True):
+        if prefix and filename.startswith(prefix + os.sep):
+            filename = filename[len(prefix) + 1:]
+            break
+    return '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+
+
+class Sampler(threading.Thread):
+    # """
+    # Records the Python stack of the given threads (all others when None) every interval seconds.
+    # stacks counts each distinct stack, outermost frame first.
+    # """
+    def __init__(self, thread_ids=None, interval=0.001):
+        super().__init__(name='request-profiler', daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.done = threading.Event()
+        self.labels = {}
+
+    def label(self, code):
+        if code not in self.labels:
+            self.labels[code] = frame_label(code)
+        return self.labels[code]
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.done.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+def sampling_summary(stacks):
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    samples = sum(stacks.values()) or 1
+    lines = ['%8s %6s  %s' % ('own', '%', 'function')]
+    lines += ['%8d %5.1f%%  %s' % (count, 100 * count / samples, frame) for frame, count in own.most_common(TOP)]
+    lines += ['', '%8s %6s  %s' % ('total', '%', 'function')]
+    lines += ['%8d %5.1f%%  %s' % (count, 100 * count / samples, frame) for frame, count in total.most_common(TOP)]
+    return '\n'.join(lines)
+
+
+class RequestProfile:
+    # """
+    # Profiles what runs between start() and stop(), then save() writes the files to PROFILE_ROOT.
+
+    # Input:
+    #     request (HttpRequest): The profiled request, to name the files.
+    #     mode (str): 'sampling' or 'cprofile'.
+    #     thread_ids (set or None): Threads to sample; None samples every thread (used for async requests,
+    #                               whose work moves between the event loop and worker threads).
+    # """
+    def __init__(self, request, mode='sampling', thread_ids=None):
+        self.request = request
+        self.mode = mode
+        self.thread_ids = thread_ids
+        self.profiler = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = Sampler(self.thread_ids, settings.PROFILE_INTERVAL)
+            self.profiler.start()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+        self.elapsed_ms = (time.perf_counter() - self.started) * 1000
+
+    def save(self, response):
+        # """
+        # Writes the profile and returns the base name of its files.
+        # """
+        os.makedirs(settings.PROFILE_ROOT, exist_ok=True)
+        name = '%s-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), slugify(self.request.path) or 'root', os.urandom(3).hex())
+        path = os.path.join(settings.PROFILE_ROOT, name)
+        # The path only: the query string may hold the token.
+        header = '%s %s -> %s in %.1f ms (%s)\n\n' % (
+            self.request.method, self.request.path, response.status_code, self.elapsed_ms, self.mode)
+        if self.mode == 'cprofile':
+            self.profiler.dump_stats(path + '.prof')
+            output = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=output).strip_dirs()
+            stats.sort_stats('tottime').print_stats(TOP)
+            stats.sort_stats('cumulative').print_stats(TOP)
+            summary = output.getvalue()
+        else:
+            with open(path + '.collapsed', 'w') as f:
+                for stack, count in self.profiler.stacks.most_common():
+                    f.write('%s %d\n' % (stack, count))
+            header += '%d samples every %.1f ms\n\n' % (self.profiler.samples, settings.PROFILE_INTERVAL * 1000)
+            summary = sampling_summary(self.profiler.stacks)
+        with open(path + '.txt', 'w') as f:
+            f.write(header + summary + '\n')
+        return name
@@ -0,0 +1,69 @@
+import random
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+
+# Primary/replica routing. Every write, and every read outside a request, goes to 'default'. During GET and
+# HEAD requests, reads of the catalog tables go to one of settings.DATABASE_REPLICAS, until the request
+# writes to one of those tables: from then on it reads from the primary, and so do the same browser's
+# requests for the next REPLICA_PIN_SECONDS (see middleware.DatabaseRoutingMiddleware), while the replicas
+# catch up. Replicas are kept up to date by the sync_replica command.
+
+# Tables the catalog pages read: the models below, and Product.category's through table.
+CATALOG_MODELS = ('category', 'subcategory', 'product', 'product_category', 'province', 'facetcount')
+PIN_COOKIE = 'primary_pin'
+
+state = ContextVar('database_routing', default=None)
+
+
+class RequestRouting:
+    # """
+    # The routing state of one request: whether it may read from a replica, and whether it wrote
+    # to a replicated table.
+    # """
+    def __init__(self, replica):
+        self.replica = replica
+        self.wrote = False
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def is_catalog(model):
+    return model._meta.app_label == 'app' and model._meta.model_name in CATALOG_MODELS
+
+
+def start(request):
+    # """
+    # Returns the routing state for a request, bound to the current context.
+    # """
+    routing = RequestRouting(
+        bool(replicas()) and request.method in ('GET', 'HEAD') and PIN_COOKIE not in request.COOKIES)
+    state.set(routing)
+    return routing
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = state.get()
+        if routing is None or not routing.replica or not is_catalog(model):
+            return 'default'
+        # Reads inside a transaction must see its writes.
+        if connections['default'].in_atomic_block:
+            return 'default'
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        routing = state.get()
+        if routing is not None and is_catalog(model):
+            routing.replica = False
+            routing.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary, schema included.
+        return db == 'default'
@@ -0,0 +1,127 @@
+import re
+import unicodedata
+from django.db import connections, router
+from .models import Product
+
+SEARCH_TABLE = 'app_product_search'
+SEARCH_LIMIT = 60
+# bm25 weights for the name, detail and categories columns.
+RANK_WEIGHTS = (10.0, 1.0, 4.0)
+
+
+def fold(text):
+    # """
+    # Lower-cases text and strips Vietnamese diacritics, so "Điện Thoại" becomes "dien thoai".
+    # """
+    if not text:
+        return ''
+    text = text.lower().replace('đ', 'd')
+    text = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def reader():
+    # The search table is read from the same database as the products (a replica on catalog pages).
+    return connections[router.db_for_read(Product)]
+
+
+def writer():
+    return connections[router.db_for_write(Product)]
+
+
+def is_available():
+    return reader().vendor == 'sqlite'
+
+
+def _document(product):
+    names = {category.name for category in product.category.all() if category.name}
+    if product.sub_category is not None and product.sub_category.name:
+        names.add(product.sub_category.name)
+    return (product.id, fold(product.name), fold(product.detail), fold(' '.join(sorted(names))))
+
+
+def _documents(queryset):
+    queryset = queryset.select_related('sub_category').prefetch_related('category').only(
+        'id', 'name', 'detail', 'sub_category__name')
+    for product in queryset.iterator(chunk_size=2000):
+        yield _document(product)
+
+
+def remove_products(ids):
+    ids = list(ids)
+    if not ids or not is_available():
+        return
+    with writer().cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [(pk,) for pk in ids])
+
+
+def index_products(ids):
+    # """
+    # Re-indexes the given products; ids that no longer exist are just removed from the index.
+    # """
+    ids = list(ids)
+    if not ids or not is_available():
+        return
+    remove_products(ids)
+    rows = list(_documents(Product.objects.filter(id__in=ids)))
+    with writer().cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, detail, categories) VALUES (%s, %s, %s, %s)', rows)
+
+
+def rebuild(batch_size=2000):
+    # """
+    # Rebuilds the whole index from the product table and returns the number of indexed products.
+    # """
+    if not is_available():
+        return 0
+    count = 0
+    batch = []
+    with writer().cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        insert = f'INSERT INTO {SEARCH_TABLE} (rowid, name, detail, categories) VALUES (%s, %s, %s, %s)'
+        for row in _documents(Product.objects.all()):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cursor.executemany(insert, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(insert, batch)
+            count += len(batch)
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+    return count
+
+
+def match_expression(query):
+    # Every term must match, each as a prefix: "dien tho" -> "dien"* "tho"*
+    terms = re.findall(r'\w+', fold(query))
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_ids(query, limit=SEARCH_LIMIT):
+    # """
+    # Returns the ids of the products matching query, best match first.
+    # """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    if not is_available():
+        return list(Product.objects.filter(name__icontains=query).values_list('id', flat=True)[:limit])
+    weights = ', '.join(str(weight) for weight in RANK_WEIGHTS)
+    with reader().cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+            f'ORDER BY bm25({SEARCH_TABLE}, {weights}) LIMIT %s', [expression, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_products(query, limit=SEARCH_LIMIT, ordering=None):
+    # """
+    # Returns the product cards matching query, ordered by relevance unless an ordering is given.
+    # """
+    ids = search_ids(query, limit)
+    if ordering:
+        return list(Product.objects.cards().filter(id__in=ids).order_by(*ordering))
+    products = Product.objects.cards().in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
@@ -0,0 +1,137 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Category, Product, Province
+from . import autocomplete, facets, images, pagecache, search
+from .categories import invalidate_tree
+
+
+@receiver(pre_save, sender=Product)
+def product_saving(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._old_facets = facets.facets_for([instance.pk]) if instance.pk else {}
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_products([instance.id])
+        autocomplete.index.invalidate()
+        facets.apply_changes(getattr(instance, '_old_facets', {}), facets.facets_for([instance.id]))
+        if images.needs_variants(instance):
+            images.schedule(Product, instance.id)
+        product_pages_changed(instance.id)
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleting(sender, instance, **kwargs):
+    instance._old_facets = facets.facets_for([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    search.remove_products([instance.id])
+    autocomplete.index.invalidate()
+    facets.apply_changes(getattr(instance, '_old_facets', {}), {instance.id: set()})
+    product_pages_changed(instance.id)
+
+
+@receiver(images.variants_built, sender=Product)
+def product_variants_built(sender, pk, **kwargs):
+    # The page now shows the new image, so it is modified (see Product.updated_at).
+    Product.objects.filter(pk=pk).update(updated_at=timezone.now())
+    product_pages_changed(pk)
+
+
+def product_pages_changed(pk):
+    # Cached pages are dropped once the change is visible, or a request in between would re-cache the old page.
+    transaction.on_commit(lambda: pagecache.invalidate('listings', 'product:%s' % pk))
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def product_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if not reverse:
+            ids = [instance.id]
+        elif pk_set is not None:
+            ids = list(pk_set)
+        else:
+            ids = list(instance.product.values_list('id', flat=True))
+        instance._facet_product_ids = ids
+        instance._old_facets = facets.facets_for(ids)
+        return
+    ids = getattr(instance, '_facet_product_ids', [])
+    Product.objects.filter(id__in=ids).update(updated_at=timezone.now())
+    search.index_products(ids)
+    facets.apply_changes(getattr(instance, '_old_facets', {}), facets.facets_for(ids))
+    transaction.on_commit(lambda: pagecache.invalidate('listings'))
+
+
+@receiver(pre_save, sender=Category)
+def category_saving(sender, instance, raw=False, **kwargs):
+    # Moving a category changes the category facets of every product below it.
+    instance._moved_product_ids = []
+    if raw or not instance.path:
+        return
+    path_ids = [int(segment) for segment in instance.path.split('/') if segment]
+    old_parent = path_ids[-2] if len(path_ids) > 1 else None
+    if old_parent != instance.sub_category_id:
+        ids = list(Product.objects.in_category(instance.path).values_list('id', flat=True))
+        instance._moved_product_ids = ids
+        instance._old_facets = facets.facets_for(ids)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, raw=False, **kwargs):
+    # Category.save() rewrites paths after post_save, so drop the tree once that has committed.
+    transaction.on_commit(invalidate_tree)
+    transaction.on_commit(lambda: pagecache.invalidate('site'))
+    if raw:
+        return
+    if images.needs_variants(instance):
+        images.schedule(Category, instance.id)
+    moved = getattr(instance, '_moved_product_ids', [])
+    if moved:
+        old = instance._old_facets
+        transaction.on_commit(lambda: facets.apply_changes(old, facets.facets_for(moved)))
+    autocomplete.index.invalidate()
+    if created:
+        return
+    ids = set(instance.product.values_list('id', flat=True))
+    ids.update(instance.sub_products.values_list('id', flat=True))
+    search.index_products(ids)
+
+
+@receiver(images.variants_built, sender=Category)
+def category_variants_built(sender, pk, **kwargs):
+    # The cached tree and menu carry the category thumbnail URLs.
+    invalidate_tree()
+    pagecache.invalidate('site')
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, **kwargs):
+    # The category's m2m rows are gone by post_delete, so remember its products now.
+    instance._search_product_ids = list(instance.product.values_list('id', flat=True))
+    instance._facet_product_ids = list(Product.objects.in_category(instance.path).values_list('id', flat=True))
+    instance._old_facets = facets.facets_for(instance._facet_product_ids)
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_tree)
+    transaction.on_commit(lambda: pagecache.invalidate('site'))
+    search.index_products(getattr(instance, '_search_product_ids', []))
+    autocomplete.index.invalidate()
+    # Products deleted along with the category are uncounted by their own post_delete.
+    remaining = facets.facets_for(getattr(instance, '_facet_product_ids', []))
+    old = {pk: values for pk, values in getattr(instance, '_old_facets', {}).items() if pk in remaining}
+    facets.apply_changes(old, remaining)
+
+
+@receiver(post_save, sender=Province)
+@receiver(post_delete, sender=Province)
+def province_changed(sender, **kwargs):
+    # Province names show up in the facets of every listing.
+    transaction.on_commit(lambda: pagecache.invalidate('site'))
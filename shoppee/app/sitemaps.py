@@ -0,0 +1,235 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+from django.conf import settings
+from django.db.models import Count, ExpressionWrapper, F, IntegerField, Max, Min, Sum
+from django.urls import reverse
+from django.utils.xmlutils import SimplerXMLGenerator
+from .categories import get_tree
+from .images import thumbnail_url
+from .models import Category, Product
+
+# Sitemaps and the merchant product feed, written to SITEMAP_ROOT in segments of SEGMENT_SIZE product ids:
+#   sitemap.xml                     index of the segment sitemaps
+#   sitemap-pages.xml               home page and category listings
+#   sitemap-products-<n>.xml        product pages with ids (n * SEGMENT_SIZE, (n + 1) * SEGMENT_SIZE]
+#   feed-products-<n>.xml           the same products as an RSS 2.0 merchant feed (g: namespace)
+#   feed.json                       list of the feed segments
+#   manifest.json                   signature of every segment at the last run
+# Each file gets a .gz copy. A segment is only rewritten when its signature changes.
+
+SEGMENT_SIZE = 50000
+CHUNK_SIZE = 2000
+SEGMENT_FILE = re.compile(r'(?:sitemap|feed)-products-(\d+)\.xml(?:\.gz)?')
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+GOOGLE_NS = 'http://base.google.com/ns/1.0'
+
+
+def site_url(path):
+    return settings.SITE_URL.rstrip('/') + path
+
+
+def output_path(name):
+    return os.path.join(settings.SITEMAP_ROOT, name)
+
+
+class SegmentFile:
+    # """
+    # Writes one XML file through a temporary file, renamed into place (with its .gz copy) on close,
+    # so readers never see a half-written segment.
+    # """
+    def __init__(self, name):
+        self.path = output_path(name)
+        self.file = open(self.path + '.tmp', 'w', encoding='utf-8')
+        self.xml = SimplerXMLGenerator(self.file, 'utf-8', short_empty_elements=True)
+        self.xml.startDocument()
+
+    def element(self, name, text, attrs=None):
+        self.xml.addQuickElement(name, text, attrs or {})
+
+    def close(self):
+        self.xml.endDocument()
+        self.file.close()
+        with open(self.path + '.tmp', 'rb') as source, gzip.open(self.path + '.gz.tmp', 'wb', compresslevel=6) as target:
+            while chunk := source.read(1 << 20):
+                target.write(chunk)
+        os.replace(self.path + '.gz.tmp', self.path + '.gz')
+        os.replace(self.path + '.tmp', self.path)
+
+
+def category_labels():
+    # id -> "Parent > Child" for every category, from the cached tree.
+    labels = {}
+
+    def walk(nodes, prefix):
+        for node in nodes:
+            labels[node['id']] = prefix + node['name']
+            walk(node['children'], labels[node['id']] + ' > ')
+
+    walk(get_tree()['roots'], '')
+    return labels
+
+
+def categories_signature():
+    rows = Category.objects.order_by('id').values_list('id', 'name', 'path')
+    return hashlib.md5(repr(list(rows)).encode()).hexdigest()
+
+
+def segment_signatures():
+    # """
+    # One aggregate query: per segment of ids, the product count, id sum and latest updated_at.
+    # Edits move updated_at, and inserts and deletes change the count or the id sum.
+    # """
+    segment = ExpressionWrapper((F('id') - 1) / SEGMENT_SIZE, output_field=IntegerField())
+    rows = (Product.objects.annotate(segment=segment).values('segment')
+            .annotate(count=Count('id'), ids=Sum('id'), last=Max('updated_at')).order_by('segment'))
+    return {row['segment']: row for row in rows}
+
+
+def segment_products(segment, fields):
+    low, high = segment * SEGMENT_SIZE, (segment + 1) * SEGMENT_SIZE
+    return (Product.objects.filter(id__gt=low, id__lte=high).order_by('id')
+            .only(*fields).iterator(chunk_size=CHUNK_SIZE))
+
+
+def write_product_sitemap(segment):
+    out = SegmentFile('sitemap-products-%d.xml' % segment)
+    out.xml.startElement('urlset', {'xmlns': SITEMAP_NS})
+    for product in segment_products(segment, ('id', 'updated_at')):
+        out.xml.startElement('url', {})
+        out.element('loc', site_url(product.get_absolute_url()))
+        out.element('lastmod', product.updated_at.date().isoformat())
+        out.xml.endElement('url')
+    out.xml.endElement('urlset')
+    out.close()
+
+
+def write_product_feed(segment, labels):
+    low, high = segment * SEGMENT_SIZE, (segment + 1) * SEGMENT_SIZE
+    # Products without a sub-category are filed under their first category, looked up once per segment.
+    first_category = dict(Product.category.through.objects.filter(product_id__gt=low, product_id__lte=high)
+                          .values('product_id').annotate(first=Min('category_id')).values_list('product_id', 'first'))
+    out = SegmentFile('feed-products-%d.xml' % segment)
+    out.xml.startElement('rss', {'version': '2.0', 'xmlns:g': GOOGLE_NS})
+    out.xml.startElement('channel', {})
+    out.element('title', 'Shoppee products %d' % segment)
+    out.element('link', site_url('/'))
+    fields = ('id', 'name', 'price', 'discount', 'detail', 'image', 'image_variants', 'sub_category', 'updated_at')
+    for product in segment_products(segment, fields):
+        out.xml.startElement('item', {})
+        out.element('g:id', str(product.id))
+        out.element('title', product.name or '')
+        out.element('description', product.detail or product.name or '')
+        out.element('link', site_url(product.get_absolute_url()))
+        # JPEG, which every merchant center accepts.
+        image = thumbnail_url(product, 600, 'jpeg')
+        if image:
+            out.element('g:image_link', site_url(image) if image.startswith('/') else image)
+        out.element('g:price', '%.2f' % product.price)
+        if product.discount:
+            out.element('g:sale_price', '%.2f' % product.get_total())
+        label = labels.get(product.sub_category_id or first_category.get(product.id))
+        if label:
+            out.element('g:product_type', label)
+        out.element('g:availability', 'in_stock')
+        out.xml.endElement('item')
+    out.xml.endElement('channel')
+    out.xml.endElement('rss')
+    out.close()
+
+
+def write_pages_sitemap(tree):
+    out = SegmentFile('sitemap-pages.xml')
+    out.xml.startElement('urlset', {'xmlns': SITEMAP_NS})
+    out.xml.startElement('url', {})
+    out.element('loc', site_url(reverse('home')))
+    out.xml.endElement('url')
+    category_url = reverse('category')
+    for slug in tree['by_slug']:
+        out.xml.startElement('url', {})
+        out.element('loc', site_url('%s?category=%s' % (category_url, slug)))
+        out.xml.endElement('url')
+    out.xml.endElement('urlset')
+    out.close()
+
+
+def write_index(segments, signatures):
+    out = SegmentFile('sitemap.xml')
+    out.xml.startElement('sitemapindex', {'xmlns': SITEMAP_NS})
+    out.xml.startElement('sitemap', {})
+    out.element('loc', site_url(reverse('sitemap_file', args=['sitemap-pages.xml'])))
+    out.xml.endElement('sitemap')
+    for segment in segments:
+        out.xml.startElement('sitemap', {})
+        out.element('loc', site_url(reverse('sitemap_file', args=['sitemap-products-%d.xml' % segment])))
+        out.element('lastmod', signatures[segment]['last'].date().isoformat())
+        out.xml.endElement('sitemap')
+    out.xml.endElement('sitemapindex')
+    out.close()
+    with open(output_path('feed.json.tmp'), 'w') as f:
+        json.dump([site_url(reverse('sitemap_file', args=['feed-products-%d.xml' % segment])) for segment in segments], f)
+    os.replace(output_path('feed.json.tmp'), output_path('feed.json'))
+
+
+def remove(name):
+    for path in (output_path(name), output_path(name) + '.gz'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def written_segments():
+    # The segments that have files in SITEMAP_ROOT, whether or not the manifest lists them.
+    found = set()
+    for name in os.listdir(settings.SITEMAP_ROOT):
+        match = SEGMENT_FILE.fullmatch(name)
+        if match:
+            found.add(int(match.group(1)))
+    return found
+
+
+def generate(force=False):
+    # """
+    # Brings SITEMAP_ROOT up to date with the catalog.
+
+    # Input:
+    #     force (bool): Rewrite every segment, even unchanged ones.
+
+    # Output:
+    #     {'written': [segments rewritten], 'unchanged': [segments skipped], 'removed': [segments without products]}
+    # """
+    os.makedirs(settings.SITEMAP_ROOT, exist_ok=True)
+    manifest_path = output_path('manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    tree = get_tree()
+    labels = category_labels()
+    categories = categories_signature()
+    signatures = segment_signatures()
+    result = {'written': [], 'unchanged': [], 'removed': []}
+    previous = manifest.get('segments', {})
+    segments = {}
+    for segment, row in signatures.items():
+        signature = '%s:%s:%s:%s' % (row['count'], row['ids'], row['last'].isoformat(), categories)
+        segments[str(segment)] = signature
+        if previous.get(str(segment)) == signature and os.path.exists(output_path('feed-products-%d.xml' % segment)):
+            result['unchanged'].append(segment)
+            continue
+        write_product_sitemap(segment)
+        write_product_feed(segment, labels)
+        result['written'].append(segment)
+    # From the directory too: a forced run ignores the manifest, and a lost manifest must not leave segments behind.
+    for segment in sorted(written_segments() | {int(segment) for segment in previous}):
+        if str(segment) not in segments:
+            remove('sitemap-products-%d.xml' % segment)
+            remove('feed-products-%d.xml' % segment)
+            result['removed'].append(segment)
+    write_pages_sitemap(tree)
+    write_index(sorted(signatures), signatures)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'segment_size': SEGMENT_SIZE, 'segments': segments}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return result
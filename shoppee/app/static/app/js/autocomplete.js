@@ -0,0 +1,29 @@
+// Fills the search box suggestions from the autocomplete endpoint while the user types.
+var searchInput = document.querySelector('input[list="search-suggestions"]');
+var suggestionList = document.getElementById("search-suggestions");
+var suggestionTimer = null;
+
+if (searchInput) {
+  searchInput.addEventListener("input", function () {
+    clearTimeout(suggestionTimer);
+    var query = searchInput.value.trim();
+    if (!query) {
+      suggestionList.innerHTML = "";
+      return;
+    }
+    suggestionTimer = setTimeout(function () {
+      fetch(searchInput.dataset.endpoint + "?q=" + encodeURIComponent(query))
+        .then((response) => {
+          return response.json();
+        })
+        .then((data) => {
+          suggestionList.innerHTML = "";
+          data.results.forEach(function (result) {
+            var option = document.createElement("option");
+            option.value = result.label;
+            suggestionList.appendChild(option);
+          });
+        });
+    }, 150);
+  });
+}
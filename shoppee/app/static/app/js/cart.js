@@ -1,42 +1,96 @@
-var updateBtns = document.getElementsByClassName("update-cart");
-var sortProducts = document.getElementsByClassName("update-cart");
+var sortProducts = document.getElementsByClassName("sort");
 
-for (i = 0; i < updateBtns.length; i++) {
-  updateBtns[i].addEventListener("click", function () {
-    var productId = this.dataset.product;
-    var action = this.dataset.action;
-    console.log(productId, "productId", action, "action");
-    console.log("user:", user);
-    if (user === "AnonymousUser") {
-      console.log("user not logged in");
-    } else {
-      updateUserOrder(productId, action);
-    }
+// Delegated, so product cards loaded later by the pager are handled too.
+document.addEventListener("click", function (event) {
+  var button = event.target.closest(".update-cart");
+  if (!button) {
+    return;
+  }
+  var productId = button.dataset.product;
+  var action = button.dataset.action;
+  // Anonymous carts are kept in a signed cookie by the server, so everyone goes through cart/update/.
+  updateUserOrder(productId, action);
+});
+
+// Clicks are collected for a moment and sent as one batch; the response is the new cart,
+// so the page is updated in place instead of reloaded.
+var pendingDeltas = {};
+var flushTimer = null;
+
+function updateUserOrder(productId, action) {
+  var delta = action === "remove" ? -1 : 1;
+  pendingDeltas[productId] = (pendingDeltas[productId] || 0) + delta;
+  clearTimeout(flushTimer);
+  flushTimer = setTimeout(flushCartUpdates, 300);
+}
+
+function flushCartUpdates() {
+  var ops = Object.keys(pendingDeltas).map(function (productId) {
+    return { productId: productId, delta: pendingDeltas[productId] };
   });
+  pendingDeltas = {};
+  if (!ops.length) {
+    return;
+  }
+  withCsrfToken()
+    .then((token) => {
+      return fetch("/cart/update/", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          "X-CSRFToken": token,
+        },
+        body: JSON.stringify({ ops: ops }),
+      });
+    })
+    .then((response) => {
+      if (!response.ok) {
+        throw new Error("cart update failed: " + response.status);
+      }
+      return response.json();
+    })
+    .then((data) => {
+      renderCart(data);
+    })
+    .catch((error) => {
+      console.error(error);
+    });
 }
 
-function updateUserOrder(productId, action) {
-  console.log("user logged in, success added");
-  var url = "/update_item/";
-  fetch(url, {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-      "X-CSRFToken": csrftoken,
-    },
-    body: JSON.stringify({
-      productId: productId,
-      action: action,
-    }),
-  })
+// The cached pages don't set the csrftoken cookie, so a visitor may not have one yet: /csrf/ sets it.
+function withCsrfToken() {
+  var token = getCookie("csrftoken");
+  if (token) {
+    return Promise.resolve(token);
+  }
+  return fetch("/csrf/", { credentials: "same-origin" })
     .then((response) => {
       return response.json();
     })
     .then((data) => {
-      console.log("data", data);
-      location.reload();
+      return data.token;
     });
 }
+
+function renderCart(data) {
+  document.getElementById("cart-total").textContent = data.cartItems;
+  document.querySelectorAll("[data-cart-field]").forEach(function (element) {
+    element.textContent = data[element.dataset.cartField];
+  });
+  var lines = {};
+  data.items.forEach(function (line) {
+    lines[line.productId] = line;
+  });
+  document.querySelectorAll(".cart-row[data-line]").forEach(function (row) {
+    var line = lines[row.dataset.line];
+    if (!line) {
+      row.remove();
+      return;
+    }
+    row.querySelector("[data-line-field=quantity]").textContent = line.quantity;
+    row.querySelector("[data-line-field=total]").textContent = line.total;
+  });
+}
 for (i = 0; i < sortProducts.length; i++) {
   sortProducts[i].addEventListener("click", function () {
     var sortValue = this.dataset.value;
@@ -47,5 +101,8 @@ for (i = 0; i < sortProducts.length; i++) {
 function updateSortValue(sortValue) {
   var url = new URL(window.location.href);
   url.searchParams.set("sort", sortValue);
+  // Cursors belong to the previous ordering.
+  url.searchParams.delete("after");
+  url.searchParams.delete("before");
   window.location.href = url.href;
 }
@@ -0,0 +1,19 @@
+// Swaps in the next/previous product page from the server instead of reloading the whole listing.
+document.addEventListener("click", function (event) {
+  var link = event.target.closest(".pager-link");
+  if (!link) {
+    return;
+  }
+  event.preventDefault();
+  var query = link.getAttribute("href");
+  var endpoint = link.closest(".product-pager").dataset.endpoint;
+  fetch(endpoint + query, { headers: { Accept: "application/json" } })
+    .then((response) => {
+      return response.json();
+    })
+    .then((data) => {
+      document.getElementById("product-list").outerHTML = data.html;
+      history.replaceState(null, "", window.location.pathname + query);
+      document.getElementById("product-list").scrollIntoView();
+    });
+});
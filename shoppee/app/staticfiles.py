@@ -0,0 +1,249 @@
+import gzip
+import logging
+import mimetypes
+import os
+import re
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.xml', '.map', '.ttf', '.eot')
+# Encodings tried in order of preference: (Accept-Encoding token, file suffix).
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# Fingerprinted names (main.1a2b3c4d5e6f.css, food1-ff7ee6d81944-150.webp) never change content.
+FINGERPRINT = re.compile(r'[.-][0-9a-f]{12}[.-]')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+CHUNK_SIZE = 64 * 1024
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # """
+    # ManifestStaticFilesStorage that also writes .gz (and .br, when brotli is installed) copies
+    # of the text assets at collectstatic time, so they are never compressed per request.
+    # Missing files referenced from CSS (e.g. the Font Awesome webfonts) are left unhashed
+    # instead of failing the whole collectstatic.
+    # """
+    def url_converter(self, name, hashed_files, template=None, *args, **kwargs):
+        converter = super().url_converter(name, hashed_files, template, *args, **kwargs)
+
+        def convert(matchobj):
+            try:
+                return converter(matchobj)
+            except ValueError as error:
+                logger.warning('%s', error)
+                return matchobj.group(0)
+        return convert
+
+    def post_process(self, paths, dry_run=False, **options):
+        failed = False
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            failed = failed or isinstance(processed, Exception)
+            yield name, hashed_name, processed
+        if dry_run or failed:
+            return
+        # After all passes, so each file is compressed once in its final form.
+        for name in sorted(set(paths) | set(self.hashed_files.values())):
+            for compressed in self.compress(name):
+                yield compressed, compressed, True
+
+    def compress(self, name):
+        if not name.endswith(COMPRESSIBLE):
+            return []
+        with self.open(name) as original:
+            data = original.read()
+        written = []
+        compressors = [('.gz', lambda content: gzip.compress(content, 9, mtime=0))]
+        if brotli is not None:
+            compressors.insert(0, ('.br', lambda content: brotli.compress(content)))
+        for suffix, compress in compressors:
+            compressed = compress(data)
+            # Not worth a second request path when it saves less than 5%.
+            if len(compressed) < len(data) * 0.95:
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
+                written.append(name + suffix)
+        return written
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        token, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def parse_range(header, size):
+    # """
+    # Parses a single "bytes=start-end" range.
+
+    # Output:
+    # - (start, end) inclusive, None when the header should be ignored (multiple or malformed ranges),
+    #   or False when the range cannot be satisfied.
+    # """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, _, end = spec.strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, path, cache_control):
+    # """
+    # Serves one file with the headers a production web server would send.
+
+    # Input:
+    # - request: The HTTP request object (GET or HEAD).
+    # - path: The absolute path of the file.
+    # - cache_control: The Cache-Control header value.
+
+    # Output:
+    # - The file, its precompressed .br/.gz copy when the client accepts it, one byte range of it (206),
+    #   a 304 when the client's copy is current, or a 416 for a range past the end of the file.
+    # """
+    if request.method not in ('GET', 'HEAD'):
+        response = HttpResponse(status=405)
+        response['Allow'] = 'GET, HEAD'
+        return response
+    content_type, _ = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+    encoding = None
+    compressible = path.endswith(COMPRESSIBLE)
+    if compressible and 'Range' not in request.headers:
+        accepted = accepted_encodings(request)
+        for token, suffix in ENCODINGS:
+            if token in accepted and os.path.isfile(path + suffix):
+                path, encoding = path + suffix, token
+                break
+    stat = os.stat(path)
+    etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+    last_modified = http_date(stat.st_mtime)
+
+    headers = {'ETag': etag, 'Last-Modified': last_modified, 'Cache-Control': cache_control}
+    if compressible:
+        headers['Vary'] = 'Accept-Encoding'
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        fresh = if_none_match.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    else:
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        fresh = since is not None and int(stat.st_mtime) <= since
+    if fresh:
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    byte_range = None
+    if 'Range' in request.headers:
+        if_range = request.headers.get('If-Range')
+        if if_range is None or if_range in (etag, last_modified):
+            byte_range = parse_range(request.headers['Range'], stat.st_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % stat.st_size
+            return response
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+        length = stat.st_size if not byte_range else byte_range[1] - byte_range[0] + 1
+    elif byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        response = FileResponse(_read_range(path, start, length), content_type=content_type)
+    else:
+        length = stat.st_size
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    # FileResponse names the file inline; assets are not downloads.
+    response.headers.pop('Content-Disposition', None)
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], stat.st_size)
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+async def async_chunks(chunks):
+    # Reads a file response's chunks in a worker thread, so ASGI servers don't block on disk reads.
+    chunks = iter(chunks)
+    read = sync_to_async(next, thread_sensitive=False)
+    while (chunk := await read(chunks, None)) is not None:
+        yield chunk
+
+
+def find_static(name):
+    # Collected files in production; straight from the app directories while developing.
+    if settings.STATIC_ROOT:
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            return None
+        if os.path.isfile(path):
+            return path
+    if settings.DEBUG:
+        return finders.find(name)
+    return None
+
+
+def serve(request, name, root):
+    # """
+    # Serves a file below STATIC_URL (root='static') or MEDIA_URL (root='media').
+    # Fingerprinted files are cached for a year; the others must be revalidated after STATIC_MAX_AGE.
+    # """
+    if root == 'static':
+        path = find_static(name)
+    else:
+        try:
+            path = safe_join(settings.MEDIA_ROOT, name)
+        except SuspiciousFileOperation:
+            path = None
+    if not path or not os.path.isfile(path):
+        raise Http404(name)
+    if FINGERPRINT.search(os.path.basename(name)):
+        cache_control = IMMUTABLE
+    else:
+        cache_control = 'public, max-age=%d' % getattr(settings, 'STATIC_MAX_AGE', 3600)
+    return serve_file(request, path, cache_control)
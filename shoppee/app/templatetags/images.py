@@ -0,0 +1,28 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+from .. import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(obj, sizes='100vw', alt='', **attrs):
+    # """
+    # Renders obj's image as a lazily loaded <picture> with WebP and JPEG srcsets.
+    # Falls back to a plain lazy <img> of the original until the variants have been built.
+
+    # Usage:
+    #     {% responsive_image product sizes="25vw" class="thumbnail" style="width: 100%" %}
+    # """
+    extra = format_html(''.join(f' {name}="{{}}"' for name in attrs), *attrs.values())
+    variants = obj.image_variants or {}
+    if not variants.get('jpeg'):
+        return format_html('<img src="{}" alt="{}" loading="lazy" decoding="async"{}>', obj.ImageURL, alt, extra)
+    fallback = default_storage.url(variants['jpeg'][0][1])
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy" decoding="async"{}></picture>',
+        images.srcset(variants, 'webp'), sizes,
+        fallback, images.srcset(variants, 'jpeg'), sizes, alt, extra,
+    )
@@ -0,0 +1,13 @@
+from django import template
+from django.utils.safestring import mark_safe
+from ..categories import get_nav_html
+
+register = template.Library()
+
+
+@register.simple_tag
+def category_nav():
+    # """
+    # Renders the cached category menu; see categories.get_nav_html.
+    # """
+    return mark_safe(get_nav_html())
@@ -1,3 +1,1606 @@
-from django.test import TestCase
+import base64
+import copy
+import gzip
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import types
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from concurrent.futures import Future
+from contextvars import copy_context
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Count, F
+from django.http import HttpResponse, JsonResponse, QueryDict
+from django.template import Context, Template
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from urllib.parse import parse_qs, urlencode, urlsplit
+from django.urls import get_resolver
+from PIL import Image
+from . import (async_views, autocomplete, cart, categories, facets, images, instrumentation, pagecache, profiling, routers,
+               search, sitemaps, writequeue)
+from .categories import get_nav_html
+from . import urls as app_urls
+from .middleware import DatabaseRoutingMiddleware
+from .models import Category, Order, OrderItem, Product, Province, ShippingAddress
+from .views import MAX_CART_OPERATIONS, PRODUCT_SORTS
 
-# Create your tests here.
+# Performance regression tests: every route in app/urls.py is requested against a seeded catalog and must
+# stay within a budget of SQL queries and wall time. Run them with
+#     python manage.py test app
+# and as a benchmark, writing the measurements to a JSON file for comparing runs, with
+#     PERF_RESULTS=perf.json PERF_REPEAT=20 python manage.py test app
+# Environment variables:
+#   PERF_PRODUCTS   size of the seeded catalog (default 3000)
+#   PERF_REPEAT     timed requests per route; the median is checked against the budget (default 5)
+#   PERF_TIME_SCALE multiplies every time budget, for slow machines (default 1)
+#   PERF_RESULTS    path of the JSON results file (not written by default)
+
+PRODUCTS = int(os.environ.get('PERF_PRODUCTS', 3000))
+REPEAT = max(1, int(os.environ.get('PERF_REPEAT', 5)))
+TIME_SCALE = float(os.environ.get('PERF_TIME_SCALE', 1))
+RESULTS = os.environ.get('PERF_RESULTS')
+
+ROOT_CATEGORIES = ('Phones', 'Laptops', 'Audio', 'Cameras', 'Home', 'Toys')
+CHILDREN_PER_ROOT = 4
+PROVINCES = ('Hà Nội', 'Hồ Chí Minh', 'Đà Nẵng', 'Hải Phòng', 'Cần Thơ', 'Huế', 'Nghệ An', 'Quảng Ninh')
+WORDS = ('điện thoại', 'laptop', 'tai nghe', 'máy ảnh', 'bàn phím', 'chuột', 'loa', 'đồng hồ', 'sạc', 'ốp lưng')
+USERS = 20
+CART_LINES = 8
+PASSWORD = 'perf-test-password'
+
+
+def seed_catalog(products=PRODUCTS, seed=0):
+    # """
+    # Creates a realistic catalog: a two-level category tree, provinces, products spread over them,
+    # and users with open carts. Products are bulk inserted, then indexed like import_catalog does.
+
+    # Output:
+    #     {'leaves': [leaf categories], 'products': [product ids], 'users': [users with a cart], 'staff': staff user}
+    # """
+    rng = random.Random(seed)
+    leaves = []
+    for name in ROOT_CATEGORIES:
+        root = Category(name=name, slug=name.lower())
+        root.save()
+        for number in range(CHILDREN_PER_ROOT):
+            leaf = Category(name=f'{name} {number}', slug=f'{name.lower()}-{number}', sub_category=root, is_sub=True)
+            leaf.save()
+            leaves.append(leaf)
+    Province.objects.bulk_create([Province(name=name) for name in PROVINCES])
+    rows = []
+    for number in range(products):
+        product = Product(
+            name=f'{rng.choice(WORDS)} {rng.choice(WORDS)} {number}',
+            price=round(rng.uniform(5, 3000), 2),
+            discount=rng.choice((0, 0, 5, 10, 25, 50)),
+            detail=' '.join(rng.choice(WORDS) for _ in range(12)),
+            address=rng.choice(PROVINCES),
+            digital=rng.random() < 0.1,
+            sub_category=rng.choice(leaves),
+        )
+        rows.append(product)
+    Product.objects.bulk_create(rows, batch_size=1000)
+    through = Product.category.through
+    through.objects.bulk_create([
+        through(product_id=product.id, category_id=category.id)
+        for product in rows for category in {product.sub_category, rng.choice(leaves)}
+    ], batch_size=1000, ignore_conflicts=True)
+    search.rebuild()
+    facets.rebuild()
+    autocomplete.index.build()
+    users = []
+    for number in range(USERS):
+        user = User.objects.create_user(f'shopper{number}', password=PASSWORD)
+        order = Order.objects.create(customer=user)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=rng.randint(1, 3))
+            for product in rng.sample(rows, CART_LINES)
+        ])
+        users.append(user)
+    staff = User.objects.create_user('staff', password=PASSWORD, is_staff=True)
+    return {'leaves': leaves, 'products': [product.id for product in rows], 'users': users, 'staff': staff}
+
+
+def refill_cart(case, user):
+    # processOrder empties the cart, so every timed checkout gets a fresh one.
+    order, _ = Order.objects.get_or_create(customer=user, complete=False)
+    order.orderitem_set.all().delete()
+    OrderItem.objects.bulk_create([OrderItem(order=order, product_id=pk, quantity=1) for pk in case.catalog['products'][:CART_LINES]])
+
+
+def checkout_payload(case, run):
+    return {'key': f'perf-{run}', 'shipping': {'address': '1 Tràng Tiền', 'city': 'Hà Nội', 'state': 'HN', 'mobile': '0900000000'}}
+
+
+# Route name -> one or more scenarios. A scenario is a dict with:
+#   path: the URL, formatted with the catalog (e.g. {product} is a product id, {leaf} a leaf category slug)
+#   method: 'get' (default) or 'post'; json: a POST body, or a callable (case, run) returning one
+#   user: None (anonymous), 'shopper' or 'staff'; prepare: called before every request, outside the timing
+#   status: the expected status code (default 200)
+#   queries: most SQL queries allowed per request; ms: median wall time budget in milliseconds
+SCENARIOS = {
+    'home': [
+        {'path': '/', 'queries': 4, 'ms': 60},
+        {'path': '/?province=Hà Nội&discount=10&sort=price', 'queries': 4, 'ms': 60},
+        {'path': '/', 'user': 'shopper', 'queries': 6, 'ms': 80},
+    ],
+    'login': [
+        {'path': '/login/', 'queries': 0, 'ms': 50},
+        {'path': '/login/', 'method': 'post', 'data': {'username': 'shopper1', 'password': PASSWORD},
+         'status': 302, 'queries': 9, 'ms': 1500},
+    ],
+    'logout': [{'path': '/logout/', 'user': 'shopper', 'status': 302, 'queries': 3, 'ms': 30}],
+    'register': [{'path': '/register', 'queries': 0, 'ms': 40}],
+    'search': [
+        {'path': '/search/?searched=tai nghe', 'queries': 2, 'ms': 120},
+        {'path': '/search/?searched=laptop&sort=price_desc', 'user': 'shopper', 'queries': 4, 'ms': 120},
+    ],
+    'autocomplete': [{'path': '/autocomplete/?q=dien', 'queries': 0, 'ms': 20}],
+    'category': [
+        {'path': '/category/?category={root}', 'queries': 2, 'ms': 80},
+        {'path': '/category/?category={leaf}&sort=price', 'queries': 2, 'ms': 80},
+    ],
+    'product_page': [{'path': '/products/page/?category={root}', 'queries': 1, 'ms': 50}],
+    'browse': [{'path': '/browse/?category={leaf}&province=Huế', 'queries': 3, 'ms': 60}],
+    'product': [
+        {'path': '/product/{product}/', 'queries': 2, 'ms': 30},
+        {'path': '/product/{product}/', 'user': 'shopper', 'queries': 4, 'ms': 40},
+    ],
+    'detail': [{'path': '/detail/?id={product}', 'status': 301, 'queries': 0, 'ms': 10}],
+    'cart': [{'path': '/cart/', 'user': 'shopper', 'queries': 3, 'ms': 50}],
+    'checkout': [{'path': '/checkout/', 'user': 'shopper', 'queries': 3, 'ms': 50}],
+    'process_order': [{'path': '/process_order/', 'method': 'post', 'user': 'shopper', 'json': checkout_payload,
+                       'prepare': refill_cart, 'queries': 12, 'ms': 60}],
+    'update_item': [{'path': '/update_item/', 'method': 'post', 'user': 'shopper',
+                     'json': {'productId': '{product}', 'action': 'add'}, 'queries': 8, 'ms': 30}],
+    'cart_update': [{'path': '/cart/update/', 'method': 'post', 'user': 'shopper',
+                     'json': {'ops': [{'productId': '{product}', 'delta': 1}, {'productId': '{other}', 'delta': -1}]},
+                     'queries': 10, 'ms': 40},
+                    {'path': '/cart/update/', 'method': 'post',
+                     'json': {'ops': [{'productId': '{product}', 'delta': 2}, {'productId': '{other}', 'delta': 1}]},
+                     'queries': 2, 'ms': 30}],
+    'csrf_token': [{'path': '/csrf/', 'queries': 0, 'ms': 10}],
+    'page_cache_stats': [{'path': '/page-cache/stats/', 'user': 'staff', 'queries': 1, 'ms': 15}],
+    'instrumentation_stats': [{'path': '/instrumentation/stats/', 'user': 'staff', 'queries': 1, 'ms': 15}],
+    'profiling_token': [{'path': '/profiling/token/', 'user': 'staff', 'queries': 1, 'ms': 15}],
+    'api_products': [
+        {'path': '/api/products/?category={root}&limit=100', 'queries': 1, 'ms': 50},
+        {'path': '/api/products/?fields=id,name,url&sort=price&limit=50', 'queries': 1, 'ms': 25},
+    ],
+    'api_export_products': [{'path': '/api/products/export/?category={leaf}', 'queries': 1, 'ms': 120}],
+    'api_product': [{'path': '/api/products/{product}/', 'queries': 1, 'ms': 10}],
+    'api_categories': [{'path': '/api/categories/', 'queries': 0, 'ms': 10}],
+    'sitemap': [{'path': '/sitemap.xml', 'queries': 0, 'ms': 10}],
+    'sitemap_file': [
+        {'path': '/sitemap-products-0.xml', 'queries': 0, 'ms': 15},
+        {'path': '/feed-products-0.xml', 'queries': 0, 'ms': 20},
+    ],
+}
+
+
+# The anonymous page cache and request sampling are off, so the views themselves are measured, and the
+# templates use unhashed static URLs, as collectstatic has not run.
+TEST_SETTINGS = {
+    'PAGE_CACHE_TIMEOUT': 0,
+    'INSTRUMENTATION_SAMPLE_RATE': 0,
+    # The write queue's thread would not see the test transaction.
+    'WRITE_QUEUE': False,
+    # Reads stay on 'default' whatever SHOPPEE_REPLICA says; ReplicaRoutingTests turns the mirror on.
+    'DATABASE_REPLICAS': [],
+    'ALLOWED_HOSTS': ['*'],
+    'STORAGES': {**settings.STORAGES, 'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}},
+}
+# Saving the seeded products and categories marks the autocomplete index stale, and the next lookup would
+# rebuild it in a thread that does not see the test transaction.
+no_background_rebuild = mock.patch.object(autocomplete.PrefixIndex, '_rebuild_in_background', lambda self: None)
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class ViewBudgetTests(TestCase):
+    # """
+    # Checks every scenario in SCENARIOS. Each one gets a warm-up request first, as a running server
+    # would have warm caches.
+    # """
+    results = []
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sitemap_dir = tempfile.TemporaryDirectory()
+        cls.sitemap_settings = override_settings(SITEMAP_ROOT=cls.sitemap_dir.name)
+        cls.sitemap_settings.enable()
+        sitemaps.generate(force=True)
+        cls.started = time.time()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sitemap_settings.disable()
+        cls.sitemap_dir.cleanup()
+        if RESULTS:
+            with open(RESULTS, 'w') as f:
+                json.dump({
+                    'started': cls.started, 'products': PRODUCTS, 'repeat': REPEAT,
+                    'database': connection.vendor, 'results': cls.results,
+                }, f, indent=2, ensure_ascii=False)
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog()
+
+    def setUp(self):
+        cache.clear()
+        leaves = self.catalog['leaves']
+        self.values = {
+            'product': self.catalog['products'][len(self.catalog['products']) // 2],
+            'other': self.catalog['products'][1],
+            'leaf': leaves[-1].slug,
+            'root': leaves[0].sub_category.slug,
+        }
+
+    def format(self, value):
+        if isinstance(value, str):
+            return value.format(**self.values)
+        if isinstance(value, dict):
+            return {key: self.format(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.format(item) for item in value]
+        return value
+
+    def request(self, scenario, run):
+        method = scenario.get('method', 'get')
+        path = self.format(scenario['path'])
+        if 'json' in scenario:
+            body = scenario['json'](self, run) if callable(scenario['json']) else self.format(scenario['json'])
+            return getattr(self.client, method)(path, json.dumps(body), content_type='application/json')
+        return getattr(self.client, method)(path, self.format(scenario.get('data', {})))
+
+    def measure(self, name, scenario):
+        self.client = Client()
+        user = {'shopper': self.catalog['users'][0], 'staff': self.catalog['staff']}.get(scenario.get('user'))
+        timings = []
+        queries = []
+        for run in range(REPEAT + 1):
+            if user is not None:
+                self.client.force_login(user)
+            else:
+                self.client.logout()
+            if 'prepare' in scenario:
+                scenario['prepare'](self, user)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = self.request(scenario, run)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                elapsed = (time.perf_counter() - started) * 1000
+            self.assertEqual(response.status_code, scenario.get('status', 200), f'{name} {scenario["path"]}')
+            if run:
+                timings.append(elapsed)
+                queries.append(len(captured))
+        return {
+            'route': name,
+            'method': scenario.get('method', 'get').upper(),
+            'path': scenario['path'],
+            'user': scenario.get('user'),
+            'queries': max(queries),
+            'query_budget': scenario['queries'],
+            'p50_ms': round(statistics.median(timings), 2),
+            'max_ms': round(max(timings), 2),
+            'time_budget_ms': scenario['ms'] * TIME_SCALE,
+            'sql': [query['sql'] for query in captured.captured_queries],
+        }
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in get_resolver('app.urls').url_patterns}
+        self.assertEqual(names - set(SCENARIOS), set(), 'routes without a performance scenario')
+
+    def test_scenario_sorts_exist(self):
+        # An unknown sort falls back to the default ordering, and the scenario would not test the one it names.
+        for name, scenarios in SCENARIOS.items():
+            for scenario in scenarios:
+                for sort in parse_qs(urlsplit(scenario['path']).query).get('sort', []):
+                    self.assertIn(sort, PRODUCT_SORTS, f'{name} {scenario["path"]}')
+
+    def test_view_budgets(self):
+        for name, scenarios in SCENARIOS.items():
+            for scenario in scenarios:
+                with self.subTest(route=name, path=scenario['path'], user=scenario.get('user')):
+                    result = self.measure(name, scenario)
+                    self.results.append({key: value for key, value in result.items() if key != 'sql'})
+                    self.assertLessEqual(result['queries'], result['query_budget'],
+                                         'too many queries:\n' + '\n'.join(result['sql']))
+                    self.assertLessEqual(result['p50_ms'], result['time_budget_ms'], 'too slow')
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class QueryScalingTests(TestCase):
+    # """
+    # N+1 detectors: the number of queries must not depend on how many rows a page shows.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=200)
+
+    def setUp(self):
+        cache.clear()
+
+    def count_queries(self, client, path):
+        client.get(path)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(client.get(path).status_code, 200)
+        return len(captured)
+
+    def fill_cart(self, user, lines):
+        order = Order.objects.get(customer=user, complete=False)
+        order.orderitem_set.all().delete()
+        OrderItem.objects.bulk_create([OrderItem(order=order, product_id=pk, quantity=2) for pk in self.catalog['products'][:lines]])
+
+    def test_cart_pages_do_not_grow_with_cart_lines(self):
+        user = self.catalog['users'][0]
+        client = Client()
+        client.force_login(user)
+        for path in ('/cart/', '/checkout/', '/'):
+            with self.subTest(path=path):
+                self.fill_cart(user, 1)
+                few = self.count_queries(client, path)
+                self.fill_cart(user, 40)
+                many = self.count_queries(client, path)
+                self.assertEqual(few, many)
+
+    def test_listings_do_not_grow_with_page_size(self):
+        client = Client()
+        for path in ('/api/products/?limit=%d', '/api/products/?limit=%d&fields=id,name,image,url'):
+            with self.subTest(path=path):
+                self.assertEqual(self.count_queries(client, path % 2), self.count_queries(client, path % 100))
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class BadInputTests(TestCase):
+    # """
+    # Malformed client input is answered with 400, or ignored, never with a server error.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=50)
+
+    def setUp(self):
+        cache.clear()
+
+    def cursor(self, values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def test_bad_cursors(self):
+        leaf = self.catalog['leaves'][0].slug
+        for values in (['abc'], [{'a': 1}], [None, 5], [1.5], [2 ** 70], [True], [1, 2, 3]):
+            cursor = self.cursor(values)
+            with self.subTest(cursor=values):
+                self.assertEqual(self.client.get('/', {'after': cursor}).status_code, 200)
+                self.assertEqual(self.client.get('/', {'sort': 'price', 'after': cursor}).status_code, 200)
+                self.assertEqual(self.client.get('/category/', {'category': leaf, 'before': cursor}).status_code, 200)
+                self.assertEqual(self.client.get('/api/products/', {'after': cursor}).status_code, 400)
+        self.assertEqual(self.client.get('/api/products/', {'after': 'not base64!'}).status_code, 400)
+
+    def test_bad_keys(self):
+        self.client.force_login(self.catalog['users'][0])
+        for key in (None, 12, '', '   ', 'k' * 65, ['k1'], {'k': 1}):
+            with self.subTest(key=key):
+                body = {**checkout_payload(self, 0), 'key': key}
+                response = self.client.post('/process_order/', json.dumps(body), content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.filter(customer=self.catalog['users'][0], complete=True).exists())
+
+    def test_bad_shipping(self):
+        self.client.force_login(self.catalog['users'][0])
+        for shipping in (['a'], 'abc', 5, None):
+            with self.subTest(shipping=shipping):
+                response = self.client.post('/process_order/', json.dumps({'key': 'k1', 'shipping': shipping}),
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+
+    def test_bad_product_ids(self):
+        for pk in (10 ** 30, 2 ** 63, 0, -1, True, 'abc', None, [1]):
+            with self.subTest(productId=pk):
+                body = json.dumps({'ops': [{'productId': pk, 'delta': 1}]})
+                self.assertEqual(self.client.post('/cart/update/', body, content_type='application/json').status_code, 400)
+                body = json.dumps({'productId': pk, 'action': 'add'})
+                self.assertEqual(self.client.post('/update_item/', body, content_type='application/json').status_code, 400)
+        body = json.dumps({'ops': [{'productId': 2 ** 63 - 1, 'delta': 1}]})
+        self.assertEqual(self.client.post('/cart/update/', body, content_type='application/json').json()['cartItems'], 0)
+
+    def test_bad_deltas(self):
+        product = self.catalog['products'][0]
+        for delta in ('3', 2.9, 1.0, None, True, [1]):
+            with self.subTest(delta=delta):
+                body = json.dumps({'ops': [{'productId': product, 'delta': delta}]})
+                self.assertEqual(self.client.post('/cart/update/', body, content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post('/cart/update/', json.dumps({'ops': {'productId': product}}),
+                                          content_type='application/json').status_code, 400)
+
+    def test_oversize_batch_is_rejected(self):
+        user = self.catalog['users'][0]
+        self.client.force_login(user)
+        before = OrderItem.objects.filter(order__customer=user, order__complete=False).totals()
+        ops = [{'productId': self.catalog['products'][0], 'delta': 1}] * (MAX_CART_OPERATIONS + 1)
+        response = self.client.post('/cart/update/', json.dumps({'ops': ops}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(OrderItem.objects.filter(order__customer=user, order__complete=False).totals(), before)
+        response = self.client.post('/cart/update/', json.dumps({'ops': ops[:MAX_CART_OPERATIONS]}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['cartItems'], before['items'] + MAX_CART_OPERATIONS)
+
+    def test_good_cursor(self):
+        response = self.client.get('/api/products/', {'sort': 'price', 'limit': 2}).json()
+        following = self.client.get('/api/products/', {'sort': 'price', 'limit': 2, 'after': response['next']})
+        self.assertEqual(following.status_code, 200)
+        self.assertEqual(len(following.json()['results']), 2)
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class EffectivePriceTests(TestCase):
+    # """
+    # The discounted price is computed by the database, so it holds however a product is written.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=50)
+
+    def setUp(self):
+        cache.clear()
+
+    def assertInSync(self):
+        for product in Product.objects.all():
+            self.assertEqual(product.effective_price, product.get_total())
+
+    def test_sort_by_price_uses_the_discounted_price(self):
+        self.assertTrue(Product.objects.exclude(discount=0).exists())
+        results = self.client.get('/api/products/', {'sort': 'price', 'limit': 100,
+                                                      'fields': 'id,price,discount,effective_price'}).json()['results']
+        self.assertEqual(len(results), 50)
+        totals = [Product(price=row['price'], discount=row['discount']).get_total() for row in results]
+        self.assertEqual([row['effective_price'] for row in results], totals)
+        self.assertEqual(totals, sorted(totals))
+
+    def test_value_follows_every_write(self):
+        self.assertInSync()
+        Product.objects.filter(id__in=self.catalog['products'][:10]).update(price=F('price') * 2, discount=30)
+        Product.objects.filter(id__in=self.catalog['products'][10:20]).update(discount=0)
+        self.assertInSync()
+        product = Product.objects.get(id=self.catalog['products'][20])
+        product.discount = 15
+        product.save(update_fields=['discount'])
+        self.assertInSync()
+        Product.objects.bulk_create([Product(name='new', price=100, discount=20)])
+        self.assertEqual(Product.objects.get(name='new').effective_price, 80)
+        self.assertInSync()
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class CheckoutTests(TestCase):
+    # """
+    # A checkout is idempotent per key: a retry gets the order the first attempt completed.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=50)
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.catalog['users'][0]
+        self.client.force_login(self.user)
+
+    def checkout(self, key):
+        body = {**checkout_payload(self, 0), 'key': key}
+        return self.client.post('/process_order/', json.dumps(body), content_type='application/json')
+
+    def test_retry_returns_the_same_order(self):
+        lines = OrderItem.objects.filter(order__customer=self.user, order__complete=False).totals()
+        first = self.checkout('order-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['items'], lines['items'])
+        retry = self.checkout('order-1')
+        self.assertEqual(retry.json(), first.json())
+        order = Order.objects.get(id=first.json()['orderId'])
+        self.assertTrue(order.complete)
+        self.assertEqual(ShippingAddress.objects.filter(order=order).count(), 1)
+        self.assertEqual(Order.objects.filter(customer=self.user, complete=True).count(), 1)
+
+    def test_new_key_after_checkout_is_rejected(self):
+        self.assertEqual(self.checkout('order-1').status_code, 200)
+        response = self.checkout('order-2')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'cart is empty'})
+        self.assertEqual(Order.objects.filter(customer=self.user, complete=True).count(), 1)
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class CartSessionTests(TestCase):
+    # """
+    # A session remembers its open order; it must notice when another session checks that order out.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=50)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_order_checked_out_elsewhere(self):
+        user = self.catalog['users'][0]
+        first, other = Client(), Client()
+        first.force_login(user)
+        other.force_login(user)
+        self.assertGreater(first.get('/cart/').context['order'].get_cart_items, 0)
+        response = other.post('/process_order/', json.dumps(checkout_payload(self, 'elsewhere')), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(first.get('/cart/').context['items']), 0)
+        self.assertEqual(first.post('/process_order/', json.dumps(checkout_payload(self, 'again')),
+                                    content_type='application/json').status_code, 400)
+        product = self.catalog['products'][0]
+        other.post('/cart/update/', json.dumps({'ops': [{'productId': product, 'delta': 2}]}), content_type='application/json')
+        items = first.get('/cart/').context['items']
+        self.assertEqual([(item.product_id, item.quantity) for item in items], [(product, 2)])
+
+
+def async_urlconf():
+    # app.urls with the catalog pages served by async_views, as with settings.ASYNC_VIEWS on.
+    swapped = {'home': async_views.home, 'search': async_views.search, 'category': async_views.category,
+               'product': async_views.detail}
+    patterns = []
+    for pattern in app_urls.urlpatterns:
+        if pattern.name in swapped:
+            pattern = copy.copy(pattern)
+            pattern.callback = swapped[pattern.name]
+        patterns.append(pattern)
+    urlconf = types.ModuleType('app.async_urls')
+    urlconf.urlpatterns = patterns
+    return urlconf
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class AsyncViewTests(TransactionTestCase):
+    # """
+    # The async catalog views render the same pages as the sync ones. A TransactionTestCase, as they run
+    # their queries in worker threads, on connections that only see committed rows.
+    # """
+    def setUp(self):
+        cache.clear()
+        self.catalog = seed_catalog(products=80)
+
+    def paths(self):
+        leaf = self.catalog['leaves'][0]
+        return [
+            '/', '/?sort=price&province=Huế', '/category/?category=%s' % leaf.sub_category.slug,
+            '/category/?category=%s&sort=price_desc' % leaf.slug, '/product/%d/' % self.catalog['products'][3],
+            '/search/?searched=tai nghe', '/search/?searched=laptop&sort=price', '/product/999999/',
+        ]
+
+    urlconf = async_urlconf()
+
+    async def test_async_views_match_sync_views(self):
+        user = self.catalog['users'][0]
+        for logged_in in (False, True):
+            if logged_in:
+                await self.async_client.aforce_login(user)
+                await sync_to_async(self.client.force_login)(user)
+            for path in self.paths():
+                with self.subTest(path=path, logged_in=logged_in):
+                    expected = await sync_to_async(self.client.get)(path)
+                    with override_settings(ROOT_URLCONF=self.urlconf):
+                        response = await self.async_client.get(path)
+                        self.assertTrue(iscoroutinefunction(response.resolver_match.func))
+                    self.assertEqual(response.status_code, expected.status_code)
+                    self.assertEqual(response.content, expected.content)
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class ExportTests(TestCase):
+    # """
+    # The export streams the whole catalog, under WSGI and ASGI, a chunk at a time.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=120)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_export_streams_every_product(self):
+        response = self.client.get('/api/products/export/', {'fields': 'id,name'})
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.is_async)
+        rows = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([row['id'] for row in rows], sorted(self.catalog['products']))
+
+    async def test_export_streams_under_asgi(self):
+        response = await self.async_client.get('/api/products/export/', {'fields': 'id,name'})
+        # An async iterator is sent as it is read; a sync one would be read into a list first.
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual((chunks[0], chunks[-1]), (b'[', b']'))
+        rows = json.loads(b''.join(chunks))
+        self.assertEqual([row['id'] for row in rows], sorted(self.catalog['products']))
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class AnonymousCartTests(TestCase):
+    # """
+    # The anonymous cart is a signed cookie: filling it writes nothing, and logging in merges it
+    # into the user's open order.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=200)
+
+    def setUp(self):
+        cache.clear()
+
+    def add(self, client, deltas):
+        ops = [{'productId': pk, 'delta': delta} for pk, delta in deltas.items()]
+        return client.post('/cart/update/', json.dumps({'ops': ops}), content_type='application/json')
+
+    def test_anonymous_cart_does_not_write(self):
+        first, second = self.catalog['products'][:2]
+        client = Client()
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.add(client, {first: 2, second: 1}).json()['cartItems'], 3)
+            self.assertEqual(self.add(client, {second: -1}).json()['cartItems'], 2)
+            self.assertEqual(client.get('/cart/').status_code, 200)
+        writes = [query['sql'] for query in captured.captured_queries if not query['sql'].startswith('SELECT')]
+        self.assertEqual(writes, [])
+        self.assertNotIn('sessionid', client.cookies)
+
+    def test_anonymous_cart_with_csrf_checks(self):
+        # The browsing pages don't set the CSRF cookie; cart.js gets it from /csrf/ first.
+        client = Client(enforce_csrf_checks=True)
+        for path in ('/', '/product/%d/' % self.catalog['products'][0], '/cart/'):
+            client.get(path)
+        ops = json.dumps({'ops': [{'productId': self.catalog['products'][0], 'delta': 1}]})
+        self.assertEqual(client.post('/cart/update/', ops, content_type='application/json').status_code, 403)
+        token = client.get('/csrf/').json()['token']
+        response = client.post('/cart/update/', ops, content_type='application/json', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cartItems'], 1)
+
+    def test_login_merges_anonymous_cart(self):
+        first, second = self.catalog['products'][:2]
+        user = self.catalog['users'][0]
+        order = Order.objects.get(customer=user, complete=False)
+        order.orderitem_set.all().delete()
+        OrderItem.objects.create(order=order, product_id=first, quantity=5)
+        client = Client()
+        self.add(client, {first: 2, second: 1})
+        response = client.post('/login/', {'username': user.username, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(dict(order.orderitem_set.values_list('product_id', 'quantity')), {first: 7, second: 1})
+        self.assertEqual(client.cookies['cart'].value, '')
+
+
+def add_province(name):
+    return Province.objects.create(name=name).id
+
+
+def add_duplicate_province(name):
+    Province.objects.create(name=name + ' (kept until the error)')
+    return Province.objects.create(name=name).id
+
+
+@override_settings(**{**TEST_SETTINGS, 'WRITE_QUEUE': True})
+class WriteQueueTests(TransactionTestCase):
+    # """
+    # The single-writer queue of writequeue.py. A TransactionTestCase, as the writer thread has its own
+    # connection and must see committed rows.
+    # """
+    def batch(self, *jobs):
+        return [(copy_context(), func, args, Future()) for func, *args in jobs]
+
+    def test_batch_commits_once(self):
+        batch = self.batch((add_province, 'Huế'), (add_province, 'Hà Nội'), (add_province, 'Đà Nẵng'))
+        with CaptureQueriesContext(connection) as captured:
+            writequeue._write(batch)
+        statements = [query['sql'].split()[0] for query in captured.captured_queries]
+        self.assertEqual((statements.count('BEGIN'), statements.count('COMMIT')), (1, 1))
+        ids = [future.result(0) for _, _, _, future in batch]
+        self.assertEqual(sorted(Province.objects.values_list('id', flat=True)), sorted(ids))
+
+    def test_failed_job_rolls_back_to_its_savepoint(self):
+        Province.objects.create(name='Huế')
+        batch = self.batch((add_province, 'Hà Nội'), (add_duplicate_province, 'Huế'), (add_province, 'Đà Nẵng'))
+        writequeue._write(batch)
+        futures = [future for _, _, _, future in batch]
+        self.assertIsInstance(futures[1].exception(0), IntegrityError)
+        self.assertIsNotNone(futures[0].result(0))
+        self.assertIsNotNone(futures[2].result(0))
+        self.assertEqual(set(Province.objects.values_list('name', flat=True)), {'Huế', 'Hà Nội', 'Đà Nẵng'})
+
+    def test_results_are_delivered_after_commit(self):
+        answered_at_commit = []
+
+        def job(name):
+            transaction.on_commit(lambda: answered_at_commit.append([future.done() for _, _, _, future in batch]))
+            return add_province(name)
+
+        batch = self.batch((job, 'Huế'), (job, 'Hà Nội'))
+        writequeue._write(batch)
+        # Both jobs' callbacks ran at the commit, before any future was answered.
+        self.assertEqual(answered_at_commit, [[False, False], [False, False]])
+        self.assertTrue(all(future.done() for _, _, _, future in batch))
+
+    def test_run_from_many_threads(self):
+        results = {}
+
+        def request(index):
+            results[index] = writequeue.run(add_province, 'Tỉnh %d' % index)
+
+        threads = [threading.Thread(target=request, args=(index,)) for index in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results.values()), sorted(Province.objects.values_list('id', flat=True)))
+
+    def test_concurrent_increments_sum(self):
+        # Cart clicks from many requests at once: apply_deltas increments in SQL, so none is lost,
+        # including those racing to insert the line.
+        user = User.objects.create_user('racer', password=PASSWORD)
+        product = Product.objects.create(name='tai nghe', price=10)
+        order_id = writequeue.run(cart.open_order, user.id).id
+
+        def click():
+            for _ in range(5):
+                writequeue.run(cart.apply_deltas, user.id, order_id, {product.id: 1})
+
+        threads = [threading.Thread(target=click) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(OrderItem.objects.filter(order_id=order_id).values_list('quantity', flat=True)), [100])
+        writequeue.run(cart.apply_deltas, user.id, order_id, {product.id: -100})
+        self.assertFalse(OrderItem.objects.filter(order_id=order_id).exists())
+
+    def test_writer_restarts_after_fork(self):
+        writequeue.run(add_province, 'Huế')
+        writer = writequeue._writer
+        self.assertTrue(writer.is_alive())
+        # A forked worker inherits _writer, but not its thread.
+        forked = writequeue._pid + 1
+        with mock.patch('app.writequeue.os.getpid', return_value=forked):
+            writequeue.run(add_province, 'Hà Nội')
+            self.assertIsNot(writequeue._writer, writer)
+            self.assertEqual(writequeue._pid, forked)
+            self.assertTrue(writequeue._writer.is_alive())
+        self.assertEqual(Province.objects.count(), 2)
+
+
+@no_background_rebuild
+@override_settings(**{**TEST_SETTINGS, 'DATABASE_REPLICAS': ['replica']})
+class ReplicaRoutingTests(TransactionTestCase):
+    # """
+    # Catalog reads of GET requests go to the replica, a test mirror of 'default' (see settings.DATABASES),
+    # and a request that writes to the catalog pins its browser to the primary.
+    # A TransactionTestCase, as the mirror has its own connection and only sees committed rows.
+    # """
+    databases = {'default', 'replica'}
+
+    def request(self, view, method='get', cookies=None):
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        return DatabaseRoutingMiddleware(view)(request)
+
+    def test_routing(self):
+        seen = {}
+
+        def view(request):
+            seen['product'] = Product.objects.all().db
+            seen['order'] = Order.objects.all().db
+            with transaction.atomic():
+                seen['atomic'] = Product.objects.all().db
+            return JsonResponse({})
+
+        self.request(view)
+        self.assertEqual(seen, {'product': 'replica', 'order': 'default', 'atomic': 'default'})
+        self.request(view, 'post')
+        self.assertEqual(seen['product'], 'default')
+        # Outside a request, e.g. in management commands, everything uses the primary.
+        self.assertEqual(Product.objects.all().db, 'default')
+
+    def test_catalog_pages_read_from_replica(self):
+        catalog = seed_catalog(products=20)
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get('/product/%d/' % catalog['products'][0])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(any('"app_product"' in query['sql'] for query in replica.captured_queries))
+
+    def test_writes_pin_to_primary(self):
+        seen = []
+
+        def write(request):
+            Province.objects.create(name='Huế')
+            seen.append(Province.objects.all().db)
+            return JsonResponse({})
+
+        def read(request):
+            seen.append(Province.objects.all().db)
+            return JsonResponse({})
+
+        response = self.request(write, 'post')
+        pin = response.cookies[routers.PIN_COOKIE]
+        self.assertEqual(pin['max-age'], settings.REPLICA_PIN_SECONDS)
+        # Read-your-writes: the next requests of that browser read from the primary.
+        self.request(read, cookies={routers.PIN_COOKIE: pin.value})
+        self.request(read)
+        self.assertEqual(seen, ['default', 'default', 'replica'])
+        self.assertIsNone(routers.state.get())
+
+
+@no_background_rebuild
+@override_settings(**{**TEST_SETTINGS, 'INSTRUMENTATION_SAMPLE_RATE': 1})
+class InstrumentationTests(TestCase):
+    # """
+    # The Server-Timing header, the request log line, repeated query detection and the route percentiles.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_server_timing_and_log(self):
+        path = '/product/%d/' % self.catalog['products'][0]
+        self.client.get(path)
+        with self.assertLogs('app.requests', 'INFO') as logs, CaptureQueriesContext(connection) as captured:
+            response = self.client.get(path)
+        timings = {part.split(';')[0]: part for part in response['Server-Timing'].split(', ')}
+        self.assertEqual(set(timings), {'total', 'view', 'db', 'tpl'})
+        self.assertIn('desc="%d queries"' % len(captured), timings['db'])
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line['route'], line['status'], line['queries']), ('product', 200, len(captured)))
+
+    def test_unsampled_requests_are_not_instrumented(self):
+        with self.settings(INSTRUMENTATION_SAMPLE_RATE=0):
+            self.assertNotIn('Server-Timing', self.client.get('/'))
+
+    def test_repeated_queries(self):
+        metrics = instrumentation.Metrics()
+        for ids in ('%s, %s', '%s, %s, %s', '%s,%s,%s,%s'):
+            metrics.record_query('SELECT * FROM app_product WHERE id IN (%s)' % ids, 1.0)
+        metrics.record_query('SELECT * FROM app_category', 1.0)
+        metrics.record_query('SELECT * FROM app_category', 1.0)
+        repeated = metrics.repeated()
+        # The three IN lists are one statement; the category query ran only twice.
+        self.assertEqual([entry['count'] for entry in repeated], [3])
+        self.assertEqual(repeated[0]['sql'], 'SELECT * FROM app_product WHERE id IN (%s...)')
+        self.assertEqual(len(repeated[0]['fingerprint']), 12)
+        response = HttpResponse()
+        instrumentation.finish(metrics, RequestFactory().get('/'), response)
+        self.assertIn('repeated;desc="1 statements"', response['Server-Timing'])
+        self.assertIn('db;dur=5.0;desc="5 queries"', response['Server-Timing'])
+
+    def test_route_percentiles(self):
+        instrumentation.reset_stats()
+        for ms in range(1, 101):
+            instrumentation.observe('product', ms, 4, 2.0)
+        stats = instrumentation.stats()['routes']['product']
+        self.assertEqual((stats['requests'], stats['mean_queries'], stats['mean_sql_ms']), (100, 4, 2.0))
+        # Percentiles are bucket upper bounds, at most 25% above the true value.
+        for percentile, value in ((50, 50), (90, 90), (95, 95), (99, 99)):
+            self.assertGreaterEqual(stats['p%d_ms' % percentile], value)
+            self.assertLessEqual(stats['p%d_ms' % percentile], value * 1.25)
+        instrumentation.reset_stats()
+        self.assertEqual(instrumentation.stats()['routes'], {})
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class ProfilingTests(TestCase):
+    # """
+    # Only a valid, unexpired token of a current staff user profiles a request.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+
+    def setUp(self):
+        cache.clear()
+        self.profiles = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profiles.cleanup)
+        profile_settings = override_settings(PROFILE_ROOT=self.profiles.name)
+        profile_settings.enable()
+        self.addCleanup(profile_settings.disable)
+
+    def profiled(self, token, **extra):
+        response = self.client.get('/', HTTP_X_PROFILE=token, **extra)
+        self.assertEqual(response.status_code, 200)
+        return response['X-Profile'], sorted(os.listdir(self.profiles.name))
+
+    def test_rejected_tokens(self):
+        staff = self.catalog['staff']
+        shopper = self.catalog['users'][0]
+        token = profiling.make_token(staff)
+        issued = time.time() - settings.PROFILE_TOKEN_MAX_AGE - 60
+        with mock.patch('django.core.signing.time.time', return_value=issued):
+            expired = profiling.make_token(staff)
+        for name, token in (
+            ('forged', token[:-1] + ('A' if token[-1] != 'A' else 'B')),
+            ('other salt', signing.TimestampSigner(salt='other').sign(str(staff.pk))),
+            ('expired', expired),
+            ('not staff', profiling.make_token(shopper)),
+        ):
+            with self.subTest(token=name):
+                self.assertEqual(self.profiled(token), ('invalid or expired token', []))
+
+    def test_staff_lost_since(self):
+        staff = User.objects.create_user('former', password=PASSWORD, is_staff=True)
+        token = profiling.make_token(staff)
+        User.objects.filter(pk=staff.pk).update(is_staff=False)
+        self.assertEqual(self.profiled(token), ('invalid or expired token', []))
+
+    def test_staff_token_profiles(self):
+        token = profiling.make_token(self.catalog['staff'])
+        name, files = self.profiled(token)
+        self.assertEqual(files, [name + '.collapsed', name + '.txt'])
+        # The query parameter works too, and cprofile writes pstats data.
+        name = self.client.get('/', {profiling.PARAMETER: token, '_profile_mode': 'cprofile'})['X-Profile']
+        self.assertTrue(os.path.isfile(os.path.join(self.profiles.name, name + '.prof')))
+
+    def test_no_token(self):
+        self.assertNotIn('X-Profile', self.client.get('/'))
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class ImportCatalogTests(TestCase):
+    # """
+    # import_catalog reports and skips bad rows instead of stopping, and reuses categories whose slug
+    # a name slugifies to.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+
+    def import_lines(self, lines, *options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'products.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_catalog', path, *options, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_bad_lines_are_skipped(self):
+        stdout, stderr = self.import_lines([
+            json.dumps({'name': 'Áo thun', 'price': 100, 'categories': ['Phones 0']}),
+            '{"name": "cut short',
+            '[1, 2]',
+            json.dumps({'name': 5, 'price': 1}),
+            json.dumps({'name': 'Quần', 'price': 'abc'}),
+            json.dumps({'name': 'Mũ', 'price': 50, 'categories': ['Phụ kiện mới'], 'sub_category': 'Phones 0'}),
+        ], '--create-categories')
+        self.assertEqual(Product.objects.count(), 22)
+        self.assertEqual(Product.objects.filter(name__in=['Áo thun', 'Quần', 'Mũ']).count(), 2)
+        self.assertIn('3 malformed rows', stdout)
+        self.assertIn('4 rows skipped', stdout)
+        for line in (2, 3, 4, 5):
+            self.assertIn(f'Row {line}:', stderr)
+        phones = Category.objects.get(slug='phones-0')
+        self.assertTrue(Product.objects.filter(name='Áo thun', category=phones).exists())
+        self.assertEqual(Product.objects.get(name='Mũ').sub_category, phones)
+        self.assertEqual(Category.objects.get(slug='phu-kien-moi').name, 'Phụ kiện mới')
+
+    def test_unsafe_image_names_are_skipped(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        images_dir = os.path.join(media.name, 'incoming')
+        os.makedirs(images_dir)
+        open(os.path.join(media.name, 'secret.jpg'), 'wb').close()
+        with override_settings(MEDIA_ROOT=os.path.join(media.name, 'media')):
+            os.makedirs(settings.MEDIA_ROOT)
+            open(os.path.join(settings.MEDIA_ROOT, 'shirt.jpg'), 'wb').close()
+            stdout, stderr = self.import_lines([
+                json.dumps({'name': 'Áo', 'price': 10, 'image': 'shirt.jpg'}),
+                json.dumps({'name': 'Up', 'price': 10, 'image': '../secret.jpg'}),
+                json.dumps({'name': 'Absolute', 'price': 10, 'image': '/etc/passwd'}),
+                json.dumps({'name': 'Quần', 'price': 10, 'image': 'missing.jpg'}),
+            ], '--image-dir', images_dir)
+        self.assertEqual(set(Product.objects.filter(name__in=['Áo', 'Up', 'Absolute', 'Quần']).values_list('name', 'image')),
+                         {('Áo', 'shirt.jpg'), ('Quần', '')})
+        self.assertIn('2 rows skipped', stdout)
+        self.assertIn('1 missing images', stdout)
+        for line in (2, 3):
+            self.assertIn(f'Row {line}: unsafe image name', stderr)
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class SearchTests(TestCase):
+    # """
+    # The full-text index ignores diacritics and follows product and category writes through the signals.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+        cls.phone = Product.objects.create(name='Điện thoại Bền Vững', price=100, sub_category=cls.catalog['leaves'][0])
+
+    def test_folding(self):
+        self.assertEqual(search.fold('Điện Thoại BỀN VỮNG'), 'dien thoai ben vung')
+        for query in ('dien thoai ben vung', 'Điện thoại bền vững', 'ĐIỆN THOẠI BỀN', 'dien tho ben vu', 'vung'):
+            with self.subTest(query=query):
+                self.assertEqual(search.search_ids(query), [self.phone.id])
+        response = self.client.get('/search/', {'searched': 'dien thoai ben vung'})
+        self.assertEqual([product.id for product in response.context['keys']], [self.phone.id])
+
+    def test_product_save_and_delete_reindex(self):
+        self.phone.name = 'Máy tính bảng'
+        self.phone.save()
+        self.assertEqual(search.search_ids('ben vung'), [])
+        self.assertEqual(search.search_ids('may tinh bang'), [self.phone.id])
+        self.phone.delete()
+        self.assertEqual(search.search_ids('may tinh bang'), [])
+
+    def test_category_changes_reindex(self):
+        category = Category.objects.create(name='Phụ kiện', slug='phu-kien')
+        self.phone.category.add(category)
+        self.assertEqual(search.search_ids('phu kien'), [self.phone.id])
+        category.name = 'Đồ cũ'
+        category.save()
+        self.assertEqual(search.search_ids('phu kien'), [])
+        self.assertEqual(search.search_ids('do cu'), [self.phone.id])
+        self.phone.category.remove(category)
+        self.assertEqual(search.search_ids('do cu'), [])
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class FacetCountTests(TestCase):
+    # """
+    # The stored facet counts match a live COUNT after every kind of write the signals follow.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=40)
+
+    def live_counts(self):
+        result = {}
+        for address, count in Product.objects.exclude(address=None).values_list('address').annotate(Count('id')):
+            result.setdefault('province', {})[address] = count
+        for value, low, high in facets.PRICE_BANDS:
+            result.setdefault('price', {})[value] = facets.filter_products(
+                Product.objects.all(), QueryDict(urlencode({'price': value}))).count()
+        for step in facets.DISCOUNT_STEPS:
+            result.setdefault('discount', {})[str(step)] = Product.objects.filter(discount__gte=step).count()
+        for category in Category.objects.all():
+            result.setdefault('category', {})[str(category.id)] = Product.objects.in_category(category.path).count()
+        return {facet: {value: count for value, count in values.items() if count}
+                for facet, values in result.items()}
+
+    def assertCountsMatch(self):
+        self.assertEqual(facets.counts(), self.live_counts())
+
+    def test_counts_follow_writes(self):
+        self.assertCountsMatch()
+        leaves = self.catalog['leaves']
+        product = Product.objects.get(id=self.catalog['products'][0])
+        with self.subTest('product save'):
+            product.price, product.discount, product.address = 2500, 50, 'Huế'
+            product.sub_category = leaves[-1]
+            product.save()
+            self.assertCountsMatch()
+        with self.subTest('product create'):
+            Product.objects.create(name='new', price=20, discount=10, address='Huế', sub_category=leaves[1])
+            self.assertCountsMatch()
+        with self.subTest('product delete'):
+            Product.objects.get(id=self.catalog['products'][1]).delete()
+            self.assertCountsMatch()
+        with self.subTest('category add'):
+            product.category.add(leaves[2], leaves[3])
+            self.assertCountsMatch()
+        with self.subTest('category remove'):
+            product.category.remove(leaves[2])
+            self.assertCountsMatch()
+        with self.subTest('category reverse add'):
+            leaves[4].product.add(*self.catalog['products'][2:6])
+            self.assertCountsMatch()
+        with self.subTest('category clear'):
+            product.category.clear()
+            self.assertCountsMatch()
+        with self.subTest('category move'):
+            leaf = Category.objects.get(id=leaves[0].id)
+            other_root = Category.objects.exclude(id=leaf.sub_category_id).filter(is_sub=False).first()
+            before = facets.counts()
+            with self.captureOnCommitCallbacks(execute=True):
+                leaf.sub_category = other_root
+                leaf.save()
+            self.assertNotEqual(facets.counts(), before)
+            self.assertCountsMatch()
+
+
+@no_background_rebuild
+@override_settings(**{**TEST_SETTINGS, 'PAGE_CACHE_TIMEOUT': 300})
+class PageCacheTests(TestCase):
+    # """
+    # Anonymous pages are served from the cache until a write bumps their scope's version;
+    # personal pages always bypass it.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+
+    def setUp(self):
+        cache.clear()
+
+    def assertState(self, path, state, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Page-Cache'], state)
+        return response
+
+    def test_anonymous_hit(self):
+        first = self.assertState('/', 'MISS')
+        second = self.assertState('/', 'HIT')
+        self.assertEqual(second.content, first.content)
+        self.assertState('/', 'HIT', utm_source='mail')
+        self.assertState('/', 'MISS', sort='price')
+        self.assertEqual(pagecache.stats()['hit'], 2)
+
+    def test_logged_in_bypass(self):
+        self.assertState('/', 'MISS')
+        self.client.force_login(self.catalog['users'][0])
+        self.assertState('/', 'BYPASS')
+        self.assertState('/', 'BYPASS')
+
+    def test_cart_bypass(self):
+        self.assertState('/', 'MISS')
+        self.client.cookies['cart'] = json.dumps({str(self.catalog['products'][0]): 1})
+        self.assertState('/', 'BYPASS')
+        del self.client.cookies['cart']
+        self.assertState('/', 'HIT')
+
+    def test_product_save_invalidates(self):
+        product = Product.objects.get(id=self.catalog['products'][0])
+        other = self.catalog['products'][1]
+        path = '/product/%s/' % product.id
+        for page in (path, '/product/%s/' % other, '/'):
+            self.assertState(page, 'MISS')
+            self.assertState(page, 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = 'Renamed product'
+            product.save()
+        self.assertContains(self.assertState(path, 'MISS'), 'Renamed product')
+        self.assertState(path, 'HIT')
+        self.assertState('/', 'MISS')
+        self.assertState('/product/%s/' % other, 'HIT')
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class ConditionalTests(TestCase):
+    # """
+    # Unchanged pages are answered with 304 from their ETag or Last-Modified, and a change gives a new ETag.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_not_modified(self):
+        for path in ('/product/%s/' % self.catalog['products'][0], '/'):
+            with self.subTest(path=path):
+                response = self.client.get(path)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('no-cache', response['Cache-Control'])
+                etag, last_modified = response['ETag'], response['Last-Modified']
+                response = self.client.get(path, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etag)
+                self.assertEqual(self.client.get(path, headers={'If-Modified-Since': last_modified}).status_code, 304)
+                self.assertEqual(self.client.get(path, headers={'If-None-Match': '"other"'}).status_code, 200)
+
+    def test_etag_follows_updated_at(self):
+        pk = self.catalog['products'][0]
+        path = '/product/%s/' % pk
+        response = self.client.get(path)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        Product.objects.filter(pk=pk).update(updated_at=F('updated_at') + timedelta(hours=1))
+        response = self.client.get(path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(path, headers={'If-Modified-Since': last_modified}).status_code, 200)
+        self.assertEqual(self.client.get(path, headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+    def test_logged_in_pages_are_private(self):
+        path = '/product/%s/' % self.catalog['products'][0]
+        anonymous = self.client.get(path)['ETag']
+        self.client.force_login(self.catalog['users'][0])
+        response = self.client.get(path)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotEqual(response['ETag'], anonymous)
+        self.assertEqual(self.client.get(path, headers={'If-None-Match': anonymous}).status_code, 200)
+
+
+@override_settings(**TEST_SETTINGS)
+class StaticFilesTests(SimpleTestCase):
+    # """
+    # StaticFilesMiddleware answers like a production web server: precompressed copies, byte ranges,
+    # long caching for fingerprinted names, and nothing outside STATIC_ROOT and MEDIA_ROOT.
+    # """
+    css = b'body { color: red; }\n' * 200
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.static_root = os.path.join(directory.name, 'static')
+        self.media_root = os.path.join(directory.name, 'media')
+        os.makedirs(self.media_root)
+        os.makedirs(os.path.join(self.static_root, 'css'))
+        self.write(self.static_root, 'css/main.1a2b3c4d5e6f.css', self.css)
+        self.write(self.static_root, 'css/main.1a2b3c4d5e6f.css.gz', gzip.compress(self.css))
+        self.write(self.static_root, 'css/main.1a2b3c4d5e6f.css.br', b'brotli bytes')
+        self.write(self.static_root, 'css/plain.css', self.css)
+        self.write(directory.name, 'secret.txt', b'secret')
+        self.write(self.media_root, 'photo.jpg', bytes(range(256)) * 4)
+        override = override_settings(STATIC_ROOT=self.static_root, MEDIA_ROOT=self.media_root, DEBUG=False)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def write(self, root, name, data):
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(data)
+
+    def get(self, path, **headers):
+        response = self.client.get(path, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_encoding_negotiation(self):
+        path = '/static/css/main.1a2b3c4d5e6f.css'
+        response, body = self.get(path)
+        self.assertEqual(body, self.css)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        response, body = self.get(path, **{'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual((response['Content-Encoding'], body), ('br', b'brotli bytes'))
+        response, body = self.get(path, **{'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), self.css)
+        self.assertEqual(response['Content-Length'], str(len(body)))
+        response, body = self.get('/static/css/plain.css', **{'Accept-Encoding': 'gzip, br'})
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(body, self.css)
+
+    def test_caching(self):
+        response, _ = self.get('/static/css/main.1a2b3c4d5e6f.css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(self.get('/static/css/plain.css')[0]['Cache-Control'], 'public, max-age=3600')
+        self.assertEqual(self.get('/images/photo.jpg')[0]['Cache-Control'], 'public, max-age=3600')
+        response, body = self.get('/static/css/main.1a2b3c4d5e6f.css', **{'If-None-Match': response['ETag']})
+        self.assertEqual((response.status_code, body), (304, b''))
+        response, _ = self.get('/static/css/plain.css', **{'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_ranges(self):
+        data = bytes(range(256)) * 4
+        response, body = self.get('/images/photo.jpg', Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, data[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(response['Content-Length'], '10')
+        response, body = self.get('/images/photo.jpg', Range='bytes=-4')
+        self.assertEqual((response.status_code, body), (206, data[-4:]))
+        response, body = self.get('/images/photo.jpg', Range='bytes=1000-')
+        self.assertEqual((response.status_code, body), (206, data[1000:]))
+        for header in ('bytes=1024-', 'bytes=-0', 'bytes=20-10'):
+            with self.subTest(range=header):
+                response, _ = self.get('/images/photo.jpg', Range=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], 'bytes */1024')
+        for header in ('bytes=0-1,5-6', 'lines=1-2', 'bytes=a-b'):
+            with self.subTest(range=header):
+                response, body = self.get('/images/photo.jpg', Range=header)
+                self.assertEqual((response.status_code, body), (200, data))
+        response, body = self.get('/images/photo.jpg', Range='bytes=0-9', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, body), (200, data))
+        # A range of the compressed copy would not be a range of the file.
+        response, body = self.get('/static/css/plain.css', Range='bytes=0-3', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual((response.status_code, body), (206, self.css[:4]))
+
+    def test_path_traversal(self):
+        for path in ('/static/../secret.txt', '/static/css/../../secret.txt', '/images/../secret.txt',
+                     '/images/%2e%2e/secret.txt', '/static//etc/passwd', '/images/missing.jpg', '/static/css/'):
+            with self.subTest(path=path):
+                response, body = self.get(path)
+                self.assertEqual(response.status_code, 404)
+                self.assertNotEqual(body, b'secret')
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class CategoryListingTests(TestCase):
+    # """
+    # A category page lists the products of the category and of every category below it.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=10)
+        leaf = cls.catalog['leaves'][0]
+        cls.root = leaf.sub_category
+        cls.grandchild = Category.objects.create(name='Grandchild', slug='grandchild', sub_category=leaf, is_sub=True)
+        cls.below = Product.objects.create(name='below', price=10, sub_category=cls.grandchild)
+        cls.linked = Product.objects.create(name='linked', price=10)
+        cls.linked.category.add(cls.grandchild)
+        cls.outside = Product.objects.create(name='outside', price=10, sub_category=cls.catalog['leaves'][-1])
+
+    def setUp(self):
+        cache.clear()
+
+    def listed(self, slug):
+        response = self.client.get('/category/', {'category': slug})
+        self.assertEqual(response.status_code, 200)
+        return {product.id for product in response.context['page']}
+
+    def test_parent_lists_descendants(self):
+        leaves = [leaf for leaf in self.catalog['leaves'] if leaf.sub_category_id == self.root.id]
+        expected = set(Product.objects.filter(sub_category__in=leaves).values_list('id', flat=True))
+        expected |= set(Product.objects.filter(category__in=leaves).values_list('id', flat=True))
+        expected |= {self.below.id, self.linked.id}
+        self.assertLessEqual(len(expected), 20)
+        self.assertEqual(self.listed(self.root.slug), expected)
+        self.assertEqual(self.listed(self.grandchild.slug), {self.below.id, self.linked.id})
+        self.assertNotIn(self.outside.id, self.listed(self.root.slug))
+        self.assertIn(self.below.id, self.listed(self.catalog['leaves'][0].slug))
+
+    def test_no_category_is_not_found(self):
+        self.assertEqual(self.client.get('/category/').status_code, 404)
+        self.assertEqual(self.client.get('/category/', {'category': ''}).status_code, 404)
+        self.assertEqual(self.listed('no-such-category'), set())
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class CategoryNavTests(TestCase):
+    # """
+    # The cached category menu is rendered once and dropped when a category is saved, renamed or deleted.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=10)
+
+    def setUp(self):
+        cache.clear()
+
+    def nav(self):
+        with self.assertNumQueries(0):
+            return get_nav_html()
+
+    def test_nav_follows_category_writes(self):
+        get_nav_html()
+        self.assertEqual(cache.get(categories.NAV_CACHE_KEY), self.nav())
+        with self.subTest('save'), self.captureOnCommitCallbacks(execute=True):
+            category = Category.objects.create(name='Gardening', slug='gardening')
+        self.assertIsNone(cache.get(categories.NAV_CACHE_KEY))
+        self.assertContains(self.client.get('/'), '?category=gardening')
+        self.assertIn('>Gardening</a', self.nav())
+        with self.subTest('rename'), self.captureOnCommitCallbacks(execute=True):
+            category.name = 'Garden tools'
+            category.save()
+        self.assertIn('>Garden tools</a', get_nav_html())
+        self.assertNotIn('Gardening', self.nav())
+        with self.subTest('delete'), self.captureOnCommitCallbacks(execute=True):
+            category.delete()
+        self.assertNotIn('gardening', get_nav_html())
+        self.assertNotIn('Garden tools', self.client.get('/').content.decode())
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class AutocompleteTests(TestCase):
+    # """
+    # Suggestions match any word of a name as a prefix, ignore diacritics, and follow product renames.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+        cls.phone = Product.objects.create(name='Điện thoại Xiaomi Redmi', price=100)
+        Category.objects.create(name='Đồ gia dụng', slug='do-gia-dung')
+
+    def setUp(self):
+        autocomplete.index.build()
+
+    def labels(self, prefix):
+        return [result['label'] for result in autocomplete.index.lookup(prefix)]
+
+    def test_prefix_matching(self):
+        for prefix in ('xiaomi', 'xiao', 'redm', 'r', 'Điện thoại xi', 'dien thoai xiaomi red'):
+            with self.subTest(prefix=prefix):
+                self.assertIn('Điện thoại Xiaomi Redmi', self.labels(prefix))
+        self.assertNotIn('Điện thoại Xiaomi Redmi', self.labels('omi'))
+        self.assertEqual(self.labels('zzz'), [])
+        self.assertEqual(self.labels('   '), [])
+        self.assertLessEqual(len(self.labels('d')), autocomplete.SUGGESTION_LIMIT)
+        results = self.client.get('/autocomplete/', {'q': 'gia dung'}).json()['results']
+        self.assertEqual(results, [{'type': 'category', 'label': 'Đồ gia dụng', 'url': '/category/?category=do-gia-dung'}])
+
+    def test_diacritic_folding(self):
+        for prefix in ('do gia', 'Đồ gia', 'ĐỒ GIA DỤNG', 'đo gia dung'):
+            with self.subTest(prefix=prefix):
+                self.assertEqual(self.labels(prefix), ['Đồ gia dụng'])
+        self.assertEqual(self.labels('dien thoai xia'), self.labels('Điện Thoại XIA'))
+
+    def test_refresh_after_rename(self):
+        self.phone.name = 'Máy tính bảng Lenovo'
+        self.phone.save()
+        # Stale until rebuilt: the lookup that notices serves the old index and rebuilds in the background.
+        with mock.patch.object(autocomplete.PrefixIndex, '_rebuild_in_background', autocomplete.PrefixIndex.build):
+            self.labels('lenovo')
+        self.assertEqual(self.labels('lenovo'), ['Máy tính bảng Lenovo'])
+        self.assertEqual(self.labels('xiaomi'), [])
+        self.phone.delete()
+        with mock.patch.object(autocomplete.PrefixIndex, '_rebuild_in_background', autocomplete.PrefixIndex.build):
+            self.labels('lenovo')
+        self.assertEqual(self.labels('lenovo'), [])
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+class ImageVariantTests(TestCase):
+    # """
+    # Uploaded images get resized WebP and JPEG variants, rendered as a lazy <picture> with srcsets.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=10)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, name, size, mode='RGBA'):
+        buffer = io.BytesIO()
+        Image.new(mode, size, (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)).save(buffer, 'PNG')
+        with self.captureOnCommitCallbacks() as callbacks:
+            product = Product.objects.create(name=name, price=10, image=ContentFile(buffer.getvalue(), name=f'{name}.png'))
+        self.assertEqual(len(callbacks), 2)
+        return product
+
+    def test_variants_are_built(self):
+        product = self.upload('wide', (800, 400))
+        self.assertTrue(images.needs_variants(product))
+        with self.captureOnCommitCallbacks(execute=True):
+            images.generate(Product, product.id)
+        product.refresh_from_db()
+        self.assertFalse(images.needs_variants(product))
+        variants = product.image_variants
+        self.assertEqual(variants['source'], 'wide.png')
+        self.assertEqual(variants['width'], 800)
+        for key, fmt in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+            self.assertEqual([width for width, _ in variants[key]], [150, 300, 600])
+            for width, name in variants[key]:
+                self.assertIn(variants['hash'], name)
+                with Image.open(os.path.join(self.media_root, name)) as variant:
+                    self.assertEqual((variant.format, variant.size), (fmt, (width, width // 2)))
+        # A smaller image keeps its own width rather than being enlarged.
+        small = self.upload('small', (100, 80), mode='RGB')
+        images.generate(Product, small.id)
+        small.refresh_from_db()
+        self.assertEqual([width for width, _ in small.image_variants['jpeg']], [100])
+
+    def test_picture_markup(self):
+        product = self.upload('photo', (800, 400))
+        html = Template('{% load images %}{% responsive_image product sizes="25vw" alt="A photo" class="thumbnail" %}')
+        fallback = html.render(Context({'product': product}))
+        self.assertHTMLEqual(fallback, '<img src="/images/photo.png" alt="A photo" loading="lazy" decoding="async" '
+                                       'class="thumbnail">')
+        images.generate(Product, product.id)
+        product.refresh_from_db()
+        digest = product.image_variants['hash']
+
+        def srcset(extension):
+            return ', '.join(f'/images/derivatives/photo-{digest}-{width}.{extension} {width}w' for width in (150, 300, 600))
+
+        self.assertHTMLEqual(html.render(Context({'product': product})), (
+            '<picture><source type="image/webp" srcset="%s" sizes="25vw">'
+            '<img src="/images/derivatives/photo-%s-150.jpg" srcset="%s" sizes="25vw" alt="A photo" loading="lazy" '
+            'decoding="async" class="thumbnail"></picture>') % (srcset('webp'), digest, srcset('jpg')))
+        response = self.client.get('/product/%s/' % product.id)
+        self.assertContains(response, '<picture>')
+        self.assertContains(response, 'srcset="%s"' % srcset('webp'))
+
+
+@no_background_rebuild
+@override_settings(**TEST_SETTINGS)
+@mock.patch.object(sitemaps, 'SEGMENT_SIZE', 5)
+class SitemapTests(TestCase):
+    # """
+    # generate() only rewrites the segments whose products changed, and removes the files of segments
+    # that no longer have products.
+    # """
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = seed_catalog(products=20)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        override = override_settings(SITEMAP_ROOT=self.root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.segments = sorted({(pk - 1) // 5 for pk in self.catalog['products']})
+
+    def files(self):
+        # Rewritten files are renamed into place, so they get a new inode even within the mtime resolution.
+        stats = {name: os.stat(os.path.join(self.root, name)) for name in os.listdir(self.root)}
+        return {name: (stat.st_ino, stat.st_mtime_ns) for name, stat in stats.items()}
+
+    def test_incremental(self):
+        self.assertEqual(sitemaps.generate(), {'written': self.segments, 'unchanged': [], 'removed': []})
+        before = self.files()
+        self.assertEqual(sitemaps.generate(), {'written': [], 'unchanged': self.segments, 'removed': []})
+        changed = {name for name, stat in self.files().items() if before.get(name) != stat}
+        self.assertFalse(changed - {'sitemap.xml', 'sitemap.xml.gz', 'sitemap-pages.xml', 'sitemap-pages.xml.gz',
+                                    'feed.json', 'manifest.json'})
+        pk = self.catalog['products'][7]
+        segment = (pk - 1) // 5
+        product = Product.objects.get(pk=pk)
+        product.name = 'Renamed for the feed'
+        product.save()
+        before = self.files()
+        result = sitemaps.generate()
+        self.assertEqual(result['written'], [segment])
+        self.assertEqual(result['unchanged'], [other for other in self.segments if other != segment])
+        changed = {name for name, stat in self.files().items() if before.get(name) != stat}
+        for name in ('sitemap-products-%d.xml', 'feed-products-%d.xml'):
+            self.assertIn(name % segment, changed)
+            self.assertFalse({name % other for other in self.segments if other != segment} & changed)
+        with open(os.path.join(self.root, 'feed-products-%d.xml' % segment), encoding='utf-8') as f:
+            self.assertIn('Renamed for the feed', f.read())
+
+    def test_empty_segments_are_removed(self):
+        sitemaps.generate()
+        last = self.segments[-1]
+        Product.objects.filter(id__gt=last * 5).delete()
+        self.assertEqual(sitemaps.generate()['removed'], [last])
+        self.assertFalse({'sitemap-products-%d.xml' % last, 'feed-products-%d.xml.gz' % last} & set(self.files()))
+
+    def test_force_removes_stale_files(self):
+        sitemaps.generate()
+        for name in ('sitemap-products-999.xml', 'sitemap-products-999.xml.gz', 'feed-products-999.xml'):
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write('stale')
+        result = sitemaps.generate(force=True)
+        self.assertEqual(result, {'written': self.segments, 'unchanged': [], 'removed': [999]})
+        self.assertFalse([name for name in self.files() if '999' in name])
+        # Without a manifest too.
+        open(os.path.join(self.root, 'feed-products-998.xml.gz'), 'w').close()
+        os.remove(os.path.join(self.root, 'manifest.json'))
+        self.assertEqual(sitemaps.generate()['removed'], [998])
@@ -1,16 +1,36 @@
 from django.contrib import admin
-from django.urls import path
-from . import views
+from django.conf import settings
+from django.urls import path, re_path
+from . import api, async_views, views
+
+# The catalog pages have async versions for ASGI servers; see settings.ASYNC_VIEWS.
+catalog = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path('', views.home,name='home'),
+    path('', catalog.home,name='home'),
     path('login/', views.loginPage,name='login'),
     path('logout/', views.logoutPage,name='logout'),
     path('register', views.register,name='register'),
-    path('search/', views.search,name='search'),
-    path('category/', views.category,name='category'),
-    path('detail/', views.detail,name='detail'),
+    path('search/', catalog.search,name='search'),
+    path('autocomplete/', views.autocomplete,name='autocomplete'),
+    path('category/', catalog.category,name='category'),
+    path('products/page/', views.product_page,name='product_page'),
+    path('browse/', views.browse,name='browse'),
+    path('product/<int:pk>/', catalog.detail,name='product'),
+    path('detail/', views.detailRedirect,name='detail'),
     path('cart/', views.cart,name='cart'),
     path('checkout/', views.checkout,name='checkout'),
+    path('process_order/', views.processOrder,name='process_order'),
     path('update_item/', views.updateItem,name='update_item'),
+    path('cart/update/', views.cartUpdate,name='cart_update'),
+    path('csrf/', views.csrfToken,name='csrf_token'),
+    path('page-cache/stats/', views.pageCacheStats,name='page_cache_stats'),
+    path('instrumentation/stats/', views.instrumentationStats,name='instrumentation_stats'),
+    path('profiling/token/', views.profilingToken,name='profiling_token'),
+    path('api/products/', api.products,name='api_products'),
+    path('api/products/export/', api.export_products,name='api_export_products'),
+    path('api/products/<int:pk>/', api.product,name='api_product'),
+    path('api/categories/', api.categories,name='api_categories'),
+    path('sitemap.xml', views.sitemapFile,name='sitemap'),
+    re_path(r'^(?P<name>(?:sitemap|feed)-[\w-]+\.xml|feed\.json)$', views.sitemapFile,name='sitemap_file'),
 ]
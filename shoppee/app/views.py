@@ -1,10 +1,27 @@
-from django.shortcuts import render,redirect
-from django.http import HttpResponse,JsonResponse
+from django.shortcuts import render,redirect,get_object_or_404
+from django.http import HttpResponse,JsonResponse,Http404
 from .models import *
 import json
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import authenticate,login,logout
 from django.contrib import messages
+from django.template.loader import render_to_string
+from .pagination import keyset_paginate, plan_page
+from .search import search_products
+from .categories import get_tree
+from . import facets
+from . import autocomplete as suggestions
+from . import instrumentation
+from . import profiling
+from . import pagecache
+from .pagecache import anonymous_page_cache
+from .conditional import conditional_page, make_etag, viewer_key
+from .staticfiles import serve_file
+from django.conf import settings
+from django.utils._os import safe_join
+from django.middleware.csrf import get_token
+from django.views.decorators.cache import never_cache
+import os
 
 
 def register(request):
@@ -18,12 +35,14 @@ def register(request):
     # - HttpResponse: Renders the registration page or redirects to the login page upon successful registration.
     
     # This function authenticates the user's credentials and logs the user in if the credentials are valid. If the credentials are invalid, it displays an error message.
+    # An anonymous cart is moved into the new user's order.
     # """
     form = CreateUserForm()
     if request.method == "POST":
         form = CreateUserForm(request.POST)
         if form.is_valid():
-            form.save()
+            user = form.save()
+            request.cart.merge_into(user)
             return redirect('login')
     context={'form': form}
     return render(request, 'app/register.html',context)
@@ -36,6 +55,7 @@ def loginPage(request):
 
     # Output:
     # - HttpResponse: Renders the login page or redirects to the home page upon successful login.
+    #   The anonymous cart is merged into the user's open order.
     # """
     if request.user.is_authenticated:
         return redirect('home')
@@ -45,6 +65,7 @@ def loginPage(request):
         user = authenticate(request, username = username, password = password)
         if user is not None:
             login(request,user)
+            request.cart.merge_into(user)
             return redirect('home')
         else:
             messages.info(request,'user or password incorrect')
@@ -63,92 +84,155 @@ def logoutPage(request):
     return redirect('login')
 def search(request):
     # Input:
-    # - request (HttpRequest): The HTTP request object.
+    # - request (HttpRequest): The HTTP request object, with the query in 'searched' (GET or POST).
 
     # Output:
     # - render(request, 'app/search.html', context): Renders the search page with the search results.
 
-    # This function processes the search query, retrieves the matching products, and passes the necessary data to the search page template for rendering.
+    # This function looks the query up in the full-text product index (see search.py), which ignores
+    # Vietnamese diacritics and ranks the matching products by relevance, or by the 'sort' parameter.
     # """
-    if request.method == 'POST':
-        searched = request.POST['searched']
-        keys = Product.objects.filter(name__contains=searched)
-    if request.user.is_authenticated:
-        customer = request.user
-        order, created = Order.objects.get_or_create(customer=customer, complete = False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
-    else:
-        items = []
-        order = {'get_cart_items': 0,'get_cart_total_items': 0}
-        cartItems = order['get_cart_items']
-    products = Product.objects.all()
-    return render(request, 'app/search.html',{'searched':searched,'keys':keys,'products': products,'cartItems': cartItems})
+    searched = request.POST.get('searched') or request.GET.get('searched', '')
+    keys = search_products(searched, ordering=PRODUCT_SORTS.get(request.GET.get('sort')))
+    return render(request, 'app/search.html',{'searched':searched,'keys':keys,'sort':request.GET.get('sort', '')})
+# Orderings for the ?sort= parameter of the listings. Each one ends with the primary key so it is a
+# total order for keyset pagination, and matches one of the Product indexes.
+PRODUCT_SORTS = {
+    'newest': ['-id'],
+    'price': ['effective_price', 'id'],
+    'price_desc': ['-effective_price', '-id'],
+    'discount': ['-discount', '-id'],
+}
+def autocomplete(request):
+    # """
+    # Returns search-as-you-type suggestions for the header search box.
+
+    # Input:
+    # - request: The HTTP request object, with the typed text in 'q'.
+
+    # Output:
+    # - A JSON response with up to 8 product/category suggestions ({type, label, url}), most popular first.
+    #   They come from the in-memory prefix index in autocomplete.py, so no query runs per keystroke.
+    # """
+    results = suggestions.index.lookup(request.GET.get('q', ''))
+    return JsonResponse({'results': results})
+def product_listing(request):
+    # """
+    # Returns one keyset-paginated page of product cards for the listing pages.
+
+    # Input:
+    # - request: The HTTP request object. 'category' filters by category slug (including its sub-categories),
+    #   'province'/'price'/'discount' are facet filters (see facets.py), 'sort' is a key of PRODUCT_SORTS,
+    #   'after'/'before' are page cursors.
+
+    # Output:
+    # - A KeysetPage of products loaded with only the columns a product card needs.
+    # """
+    products, ordering = listing_query(request.GET, get_tree())
+    return keyset_paginate(products, ordering, after=request.GET.get('after'), before=request.GET.get('before'), params=request.GET)
+def listing_query(params, tree):
+    # Builds (without running) the product query and ordering of product_listing, for the sync and async views.
+    products = Product.objects.cards()
+    if 'category' in params:
+        node = tree['by_slug'].get(params['category'])
+        products = products.in_category(node['path']) if node else products.none()
+    products = facets.filter_products(products, params)
+    return products, PRODUCT_SORTS.get(params.get('sort'), PRODUCT_SORTS['newest'])
+def listing_validators(request):
+    # """
+    # ETag and Last-Modified of a listing page: the products it shows and their latest updated_at,
+    # plus everything else on the page (facet counts, category menu, query string, the viewer's cart).
+    # """
+    products, ordering = listing_query(request.GET, get_tree())
+    query, _ = plan_page(products, ordering, after=request.GET.get('after'), before=request.GET.get('before'))
+    rows = list(query.values_list('id', 'updated_at'))
+    last_modified = max((updated_at for _, updated_at in rows), default=None)
+    etag = make_etag('listing', request.path, pagecache.normalized_query(request.GET), rows,
+                     pagecache.versions('site', 'listings'), viewer_key(request))
+    return etag, last_modified
+def product_validators(request, pk):
+    # ETag and Last-Modified of a product page; None (no validators) when the product does not exist.
+    updated_at = Product.objects.filter(pk=pk).values_list('updated_at', flat=True).first()
+    if updated_at is None:
+        return None
+    return make_etag('product', pk, updated_at, pagecache.versions('site'), viewer_key(request)), updated_at
+@conditional_page(listing_validators)
+@anonymous_page_cache('listings')
 def category(request):
     # """
-    # Retrieves the categories and subcategories, and the products for the selected category.
+    # Retrieves the categories and one page of products for the selected category.
 
     # Input:
     # - request: The HTTP request object.
 
     # Output:
     # - A rendered template 'app/category.html' with the following context:
-    #     - categories: A queryset of all categories where 'is_sub' is False.
     #     - active_category: The selected category slug from the request.
-    #     - products: A queryset of products filtered by the selected category slug.
-    #     - seen_values: An empty list.
-    #     - subcategories: A queryset of all subcategories.
+    #     - page: A page of products in the selected category or any of its sub-categories.
+    #     - sort: The selected sort order.
+    #   The category menu comes from the cached {% category_nav %} fragment in base.html.
+    #   Without a 'category' it is a 404; the whole catalog is listed on the home page.
     # """
-    categories = Category.objects.filter(is_sub=False)
     active_category = request.GET.get('category', '')
-    
-    subcategories = SubCategory.objects.all()
-    seen_values = []
-    action = request.GET.get('action', '')
-    products = Product.objects.filter(category__slug=active_category)
+    if not active_category:
+        raise Http404('No category given.')
     context = {
-        'categories': categories,
         'active_category': active_category,
-        'products': products,
-        'seen_values': seen_values,
-        'subcategories': subcategories
+        'page': product_listing(request),
+        'sort': request.GET.get('sort', ''),
     }
     return render(request, 'app/category.html', context)
+def product_page(request):
+    # """
+    # Returns the next/previous page of a product listing, so the pager can swap it in without a reload.
+
+    # Input:
+    # - request: The HTTP request object, with the same query parameters as the listing page.
+
+    # Output:
+    # - A JSON response with the rendered 'app/product_list.html' partial and the next/prev query strings.
+    # """
+    page = product_listing(request)
+    html = render_to_string('app/product_list.html', {'page': page}, request)
+    return JsonResponse({'html': html, 'next': page.next_query, 'prev': page.prev_query})
+def browse(request):
+    # """
+    # Faceted browsing: the filtered page of products plus the product count of every facet value.
+
+    # Input:
+    # - request: The HTTP request object, with the category, facet filters and cursors of product_listing.
+
+    # Output:
+    # - A JSON response with the rendered product list, the next/prev query strings and the facets.
+    #   Facet counts come from the FacetCount table, not from counting products.
+    # """
+    page = product_listing(request)
+    html = render_to_string('app/product_list.html', {'page': page}, request)
+    return JsonResponse({
+        'html': html,
+        'next': page.next_query,
+        'prev': page.prev_query,
+        'facets': facets.summary(request.GET),
+    })
+@conditional_page(listing_validators)
+@anonymous_page_cache('listings')
 def home(request):
     # """
-    # Retrieves the products, cart items, and categories, and renders the 'app/home.html' template.
+    # Retrieves the products and categories, and renders the 'app/home.html' template.
+    # The cart count and login flags come from the request's lazy cart (see context_processors.cart).
 
     # Input:
     # - request: The HTTP request object.
 
     # Output:
     # - A rendered template 'app/home.html' with the following context:
-    #     - products: A queryset of all products.
-    #     - cartItems: The number of items in the cart.
-    #     - user_login: A string indicating whether the user is logged in or not.
-    #     - user_not_login: A string indicating whether the user is not logged in or not.
-    #     - categories: A queryset of all categories where 'is_sub' is False.
-    #     - items: A queryset of all order items for the current user's cart.
+    #     - page: The current page of products, narrowed by the selected facets.
+    #     - categories: The top-level categories from the cached category tree.
+    #     - facets: The province, price and discount filters with their product counts.
+    #     - sort: The selected sort order.
     # """
-    if request.user.is_authenticated:
-        customer = request.user
-        order, created = Order.objects.get_or_create(customer=customer, complete = False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
-        user_not_login="hidden"
-        user_login = "show"
-    else :
-        items = []
-        order = {'get_cart_items': 0,'get_cart_total_items': 0}
-        cartItems = order['get_cart_items']
-        user_not_login="show"
-        user_login = "hidden"
-    if user_not_login == "show":
-        user_login = "hidden"
-        
-    categories = Category.objects.filter(is_sub=False)
-    products = Product.objects.all()
-    context={'products': products,'cartItems': cartItems,'user_login': user_login,'user_not_login': user_not_login,'categories': categories,'items':items}
+    categories = get_tree()['roots']
+    context={'page': product_listing(request),'categories': categories,'facets': facets.summary(request.GET),'sort': request.GET.get('sort', '')}
     return render(request,'app/home.html',context)
 
 def cart(request):
@@ -161,64 +245,36 @@ def cart(request):
     # Output:
     # - Renders the 'app/cart.html' template with the following context:
     #     - items: The order items in the cart.
-    #     - order: The order object.
-    #     - cartItems: The number of items in the cart.
-    #     - user_login: A flag indicating whether the user is logged in.
-    #     - user_not_login: A flag indicating whether the user is not logged in.
-    #     - categories: The categories without sub-categories.
+    #     - order: The request's cart, which exposes the same totals as the Order.
     # """
-    if request.user.is_authenticated:
-        customer = request.user
-        order, created = Order.objects.get_or_create(customer=customer, complete = False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items        
-        user_not_login="hidden"
-        user_login = "show"
-    else:
-        items = []
-        order = {'get_cart_items': 0,'get_cart_total_items': 0}
-        cartItems = order['get_cart_items']
-        user_not_login="show"
-        user_login = "hidden"
-    categories = Category.objects.filter(is_sub=False)
-    context={'items':items,'order':order,'cartItems': cartItems,'user_login': user_login,'user_not_login': user_not_login,'categories': categories}
+    context={'items':request.cart.items,'order':request.cart}
     return render(request,'app/cart.html',context)
-def detail(request):
+@conditional_page(product_validators)
+@anonymous_page_cache(lambda request, pk: 'product:%s' % pk)
+def detail(request, pk):
     # """
-    # Handles the detail page for a product.
+    # Handles the detail page for a product, at its canonical URL product/<pk>/.
+    # Unchanged pages are answered with 304 before this runs (see product_validators).
 
     # Input:
     # - request: The HTTP request object.
+    # - pk: The product ID.
 
     # Output:
     # - Renders the 'app/detail.html' template with the following context:
-    #     - categories: The categories without sub-categories.
     #     - products: The product details.
-    #     - items: The order items in the cart.
-    #     - order: The order object.
-    #     - cartItems: The number of items in the cart.
-    #     - user_login: A flag indicating whether the user is logged in.
-    #     - user_not_login: A flag indicating whether the user is not logged in.
     # """
-    if request.user.is_authenticated:
-        customer = request.user
-        order, created = Order.objects.get_or_create(customer=customer, complete = False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items        
-        user_not_login="hidden"
-        user_login = "show"
-    else:
-        items = []
-        order = {'get_cart_items': 0,'get_cart_total_items': 0}
-        cartItems = order['get_cart_items']
-        user_not_login="show"
-        user_login = "hidden"
-    id = request.GET.get('id','')    
-    
-    products = Product.objects.filter(id=id)
-    categories = Category.objects.filter(is_sub=False)
-    context={'categories':categories,'products':products,'items':items,'order':order,'cartItems': cartItems,'user_login': user_login,'user_not_login': user_not_login,'categories': categories}
+    products = [get_object_or_404(Product, id=pk)]
+    context={'products':products}
     return render(request,'app/detail.html',context)
+def detailRedirect(request):
+    # """
+    # Permanently redirects the old detail/?id=<pk> links to product/<pk>/.
+    # """
+    id = request.GET.get('id','')
+    if not id.isdigit():
+        raise Http404('No product id')
+    return redirect('product', pk=int(id), permanent=True)
 def checkout(request):
     # """
     # Handles the checkout functionality for authenticated and non-authenticated users.
@@ -229,31 +285,107 @@ def checkout(request):
     # Output:
     # - Renders the 'app/checkout.html' template with the following context:
     #     - items: The order items in the cart.
-    #     - order: The order object.
-    #     - cartItems: The number of items in the cart.
-    #     - user_login: A flag indicating whether the user is logged in.
-    #     - user_not_login: A flag indicating whether the user is not logged in.
-    #     - categories: The categories without sub-categories.
+    #     - order: The request's cart, which exposes the same totals as the Order.
     # """
-    if request.user.is_authenticated:
-        customer = request.user
-        order, created = Order.objects.get_or_create(customer=customer, complete = False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
-        user_not_login="hidden"
-        user_login = "show"
-    else:
-        items = []
-        order = {'get_cart_items': 0,'get_cart_total_items': 0}
-        cartItems = order['get_cart_items']
-        user_not_login="show"
-        user_login = "hidden"
-    categories = Category.objects.filter(is_sub=False)
-    context={'items':items,'order':order,'cartItems': cartItems,'user_login': user_login,'user_not_login': user_not_login,'categories': categories}
+    context={'items':request.cart.items,'order':request.cart}
     return render(request,'app/checkout.html',context)
+# Limits for one cart/update/ request.
+MAX_CART_OPERATIONS = 100
+MAX_CART_DELTA = 1000
+# Product ids are positive SQLite integers; a larger id would fail when bound to the query.
+MAX_PRODUCT_ID = 2 ** 63 - 1
+def product_id(value):
+    # Reads a client-supplied product id, raising ValueError unless it is a positive 64-bit integer.
+    if isinstance(value, bool):
+        raise ValueError('invalid product id')
+    pk = int(value)
+    if not 1 <= pk <= MAX_PRODUCT_ID:
+        raise ValueError('invalid product id')
+    return pk
+def cartUpdate(request):
+    # """
+    # Applies a batch of cart changes in one transaction and returns the new cart.
+
+    # Input:
+    # - request: A POST whose JSON body is {"ops": [{"productId": 1, "delta": 2}, ...]}, with at most
+    #   MAX_CART_OPERATIONS integer deltas. Anonymous carts are kept in a signed cookie instead of an order.
+
+    # Output:
+    # - A JSON response with the cart lines ({productId, name, price, quantity, total}), cartItems and cartTotal.
+    # """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    try:
+        ops = json.loads(request.body)['ops']
+        if not isinstance(ops, list):
+            raise TypeError('ops must be a list')
+        if len(ops) > MAX_CART_OPERATIONS:
+            # Rather than applying part of the batch.
+            return JsonResponse({'error': 'at most %d operations' % MAX_CART_OPERATIONS}, status=400)
+        deltas = {}
+        for op in ops:
+            productId, delta = product_id(op['productId']), op['delta']
+            # Not int(): "3" or 2.9 would be applied as something the client did not send.
+            if type(delta) is not int:
+                raise TypeError('delta must be an integer')
+            deltas[productId] = deltas.get(productId, 0) + delta
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'expected {"ops": [{"productId": ..., "delta": ...}]}'}, status=400)
+    deltas = {pk: max(-MAX_CART_DELTA, min(MAX_CART_DELTA, delta)) for pk, delta in deltas.items()}
+    request.cart.apply(deltas)
+    return JsonResponse(request.cart.state())
+def processOrder(request):
+    # """
+    # Completes the checkout of the current cart.
+
+    # Input:
+    # - request: A POST whose JSON body is {"key": <idempotency key>, "shipping": {address, city, state, mobile}}.
+    #   Retrying with the same key returns the same order instead of placing a second one.
+
+    # Output:
+    # - A JSON response with orderId, transactionId, items and total of the completed order.
+    # """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'login required'}, status=403)
+    try:
+        data = json.loads(request.body)
+        key = data['key']
+        # Only a string: str() would turn every missing key into the same "None".
+        if not isinstance(key, str):
+            raise TypeError('key must be a string')
+        key = key.strip()
+        shipping = data.get('shipping', {})
+        if not isinstance(shipping, dict):
+            raise TypeError('shipping must be an object')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return JsonResponse({'error': 'expected {"key": ..., "shipping": {...}}'}, status=400)
+    if not key or len(key) > 64:
+        return JsonResponse({'error': 'key must be 1 to 64 characters'}, status=400)
+    form = ShippingAddressForm(shipping)
+    if not form.is_valid():
+        return JsonResponse({'error': 'invalid shipping address', 'fields': form.errors}, status=400)
+    order = request.cart.checkout(key, form.cleaned_data)
+    if order is None:
+        return JsonResponse({'error': 'cart is empty'}, status=400)
+    return JsonResponse({
+        'orderId': order.id,
+        'transactionId': order.transaction_id,
+        'items': order.total_items,
+        'total': order.total,
+    })
+@never_cache
+def csrfToken(request):
+    # """
+    # Returns the CSRF token and sets the csrftoken cookie. The cached catalog pages don't embed the token,
+    # so an anonymous visitor has no cookie yet when cart.js sends its first cart/update/.
+    # """
+    return JsonResponse({'token': get_token(request)})
 def updateItem(request):
     # """
-    # Updates the quantity of an item in the cart.
+    # Updates the quantity of an item in the cart by one.
+    # Kept for older clients; cart/update/ takes a batch of changes and returns the new cart.
 
     # Input:
     # - request: The HTTP request object, containing the product ID and the action (add or remove).
@@ -261,18 +393,68 @@ def updateItem(request):
     # Output:
     # - A JSON response indicating that the item was added.
     # """
-    data = json.loads(request.body)
-    productId = data['productId']
-    action = data['action']
-    customer = request.user
-    product = Product.objects.get(id=productId)
-    order, created = Order.objects.get_or_create(customer=customer, complete = False)
-    orderItem, created = OrderItem.objects.get_or_create(order=order, product = product)
+    try:
+        data = json.loads(request.body)
+        productId = product_id(data['productId'])
+        action = data['action']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'expected {"productId": ..., "action": ...}'}, status=400)
     if action == 'add':
-        orderItem.quantity +=1
+        request.cart.apply({productId: 1})
     elif action == 'remove':
-        orderItem.quantity -=1
-    orderItem.save()
-    if orderItem.quantity <= 0:
-        orderItem.delete()
-    return JsonResponse('added',safe=False)
\ No newline at end of file
+        request.cart.apply({productId: -1})
+    return JsonResponse('added',safe=False)
+def pageCacheStats(request):
+    # """
+    # Returns the hit/miss/bypass counters of the anonymous page cache (see pagecache.py), for staff only.
+    # POST resets them, e.g. before a load test.
+    # """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'staff only'}, status=403)
+    if request.method == 'POST':
+        pagecache.reset_stats()
+    return JsonResponse(pagecache.stats())
+def instrumentationStats(request):
+    # """
+    # Returns the per-route latency percentiles, mean query count and SQL time of the sampled requests
+    # (see instrumentation.py), for staff only. POST resets them.
+    # """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'staff only'}, status=403)
+    if request.method == 'POST':
+        instrumentation.reset_stats()
+    return JsonResponse(instrumentation.stats())
+def profilingToken(request):
+    # """
+    # Returns a signed token that profiles any request sending it (see profiling.py), for staff only.
+    # It expires after PROFILE_TOKEN_MAX_AGE seconds, or as soon as the user loses staff status.
+    # """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'staff only'}, status=403)
+    return JsonResponse({
+        'token': profiling.make_token(request.user),
+        'header': 'X-Profile',
+        'parameter': profiling.PARAMETER,
+        'expires_in': settings.PROFILE_TOKEN_MAX_AGE,
+    })
+
+def sitemapFile(request, name='sitemap.xml'):
+    # """
+    # Serves the sitemap index, the sitemap segments and the product feed written by build_sitemaps.
+
+    # Input:
+    # - request: The HTTP request object.
+    # - name: A file name in SITEMAP_ROOT, e.g. 'sitemap-products-0.xml'.
+
+    # Output:
+    # - The file (gzipped when the client accepts it), or 404 until build_sitemaps has run.
+    # """
+    if not name.endswith(('.xml', '.json')):
+        raise Http404(name)
+    try:
+        path = safe_join(settings.SITEMAP_ROOT, name)
+    except ValueError:
+        raise Http404(name)
+    if not os.path.isfile(path):
+        raise Http404(name)
+    return serve_file(request, path, 'public, max-age=%d' % settings.STATIC_MAX_AGE)
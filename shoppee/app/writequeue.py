@@ -0,0 +1,95 @@
+import contextvars
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+# A single writer thread per process that runs the cart and order writes of every request thread.
+# SQLite takes one writer at a time, so request threads that write concurrently wait on each other's
+# locks and eventually fail with "database is locked". Through the queue they never contend: the writer
+# takes every job waiting at that moment (up to MAX_BATCH) and runs them in one transaction, each in its
+# own savepoint, so the commit (the expensive fsync) is shared by the whole batch. Nothing waits for
+# a batch to fill up, so a lone write commits straight away.
+# Turned on by settings.WRITE_QUEUE; otherwise jobs run in the calling thread, each in a transaction.
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = 64
+# Jobs waiting beyond this many make run() wait for room instead of piling up.
+MAX_PENDING = 1000
+TIMEOUT = 30
+
+_queue = queue.Queue(maxsize=MAX_PENDING)
+_lock = threading.Lock()
+_writer = None
+_pid = None
+
+
+def run(func, *args):
+    # """
+    # Runs func(*args) in a transaction, on the writer thread when the queue is on, and returns its result
+    # or raises its exception. func must only touch the database and its arguments.
+    # """
+    if not getattr(settings, 'WRITE_QUEUE', False):
+        with transaction.atomic():
+            return func(*args)
+    _ensure_writer()
+    future = Future()
+    # The job runs in the caller's context, so the request instrumentation still counts its queries.
+    _queue.put((contextvars.copy_context(), func, args, future), timeout=TIMEOUT)
+    return future.result(timeout=TIMEOUT)
+
+
+def _ensure_writer():
+    global _writer, _pid
+    # Threads do not survive a fork, so a forked worker starts its own writer.
+    if _writer is not None and _pid == os.getpid() and _writer.is_alive():
+        return
+    with _lock:
+        if _writer is None or _pid != os.getpid() or not _writer.is_alive():
+            _pid = os.getpid()
+            _writer = threading.Thread(target=_write_forever, name='write-queue', daemon=True)
+            _writer.start()
+
+
+def _next_batch():
+    batch = [_queue.get()]
+    while len(batch) < MAX_BATCH:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _write_forever():
+    while True:
+        batch = _next_batch()
+        try:
+            _write(batch)
+        except Exception as error:
+            logger.exception('Write batch of %d jobs failed', len(batch))
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            close_old_connections()
+
+
+def _write(batch):
+    results = []
+    with transaction.atomic():
+        for context, func, args, future in batch:
+            try:
+                with transaction.atomic():
+                    results.append((future, context.run(func, *args), None))
+            except Exception as error:
+                results.append((future, None, error))
+    # Only answer once the batch is committed, so a caller never reads a result that could be rolled back.
+    for future, result, error in results:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
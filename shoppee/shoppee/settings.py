@@ -42,19 +42,26 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'app.middleware.StaticFilesMiddleware',
+    'app.middleware.ProfilingMiddleware',
+    'app.middleware.InstrumentationMiddleware',
+    'app.middleware.DatabaseRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.middleware.CartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.middleware.ViewTimingMiddleware',
 ]
 
 ROOT_URLCONF = 'shoppee.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # The stock Django backend, with render times for the request instrumentation.
+        'BACKEND': 'app.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -63,6 +70,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'app.context_processors.cart',
             ],
         },
     },
@@ -70,6 +78,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'shoppee.wsgi.application'
 
+# Serve home, category, detail and search with the async views in app/async_views.py. Off by default,
+# under ASGI too: with SQLite the extra thread hops cost more than the concurrency saves.
+ASYNC_VIEWS = os.environ.get('SHOPPEE_ASYNC_VIEWS', '0') == '1'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -80,6 +92,75 @@ DATABASES = {
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+# Read replicas of 'default' for the catalog pages (see app/routers.py). Locally, SHOPPEE_REPLICA=1 reads
+# from a second SQLite file, which `manage.py sync_replica` copies the primary into. The alias is always
+# defined, as a mirror of the test database under any test runner, but only used when listed in
+# DATABASE_REPLICAS; the routing tests list it with override_settings.
+REPLICA = os.environ.get('SHOPPEE_REPLICA') == '1'
+DATABASES['replica'] = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.environ.get('SHOPPEE_REPLICA_NAME', BASE_DIR / 'db-replica.sqlite3'),
+    'TEST': {'MIRROR': 'default'},
+}
+# Production SQLite profile (on by default when DEBUG is off): write-ahead logging so readers never block
+# the writer, transactions that take the write lock up front instead of failing halfway with "database is
+# locked", and a wait of up to SQLITE_TIMEOUT seconds for that lock. Cart and order writes also go through
+# the single-writer queue in app/writequeue.py.
+SQLITE_PRODUCTION = os.environ.get('SHOPPEE_SQLITE_PRODUCTION', '0' if DEBUG else '1') == '1'
+SQLITE_TIMEOUT = 20
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # Durable at every checkpoint rather than every commit; with WAL a crash never corrupts the file.
+    'synchronous': 'NORMAL',
+    'busy_timeout': SQLITE_TIMEOUT * 1000,
+    'mmap_size': 256 * 1024 * 1024,
+    # Negative sizes are in KiB: 64 MiB of page cache per connection.
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+}
+if SQLITE_PRODUCTION:
+    for database in DATABASES.values():
+        if database['ENGINE'] == 'django.db.backends.sqlite3':
+            database['OPTIONS'] = {
+                'init_command': ';'.join('PRAGMA %s=%s' % item for item in SQLITE_PRAGMAS.items()),
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': SQLITE_TIMEOUT,
+            }
+WRITE_QUEUE = os.environ.get('SHOPPEE_WRITE_QUEUE', '1' if SQLITE_PRODUCTION else '0') == '1'
+DATABASE_REPLICAS = ['replica'] if REPLICA else []
+DATABASE_ROUTERS = ['app.routers.PrimaryReplicaRouter']
+# How long a browser keeps reading from the primary after it changed the catalog, in seconds.
+REPLICA_PIN_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# The category tree and menu fragment live here, so workers should share it: set REDIS_URL
+# (needs the redis package) in production. Without it each process keeps its own copy.
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+            'KEY_PREFIX': 'shoppee',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds an anonymous page stays in the page cache (see app/pagecache.py). Changes to products,
+# categories and provinces drop the affected pages earlier.
+PAGE_CACHE_TIMEOUT = 300
+
+# Sessions are read from the cache and only written to the database when they change, so logged-in
+# page views cost no session query. Anonymous visitors get no session at all: their cart is a signed
+# cookie (see app/cart.py).
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
 
 # Password validation
@@ -117,6 +198,19 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
 STATIC_URL = 'static/'
+# collectstatic copies the assets here, fingerprinted and precompressed (see app/staticfiles.py).
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+# Cache lifetime, in seconds, of static and media files whose names are not fingerprinted.
+STATIC_MAX_AGE = 60 * 60
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'app.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -127,3 +221,27 @@ STATICFILES_DIRS = [
 ]
 MEDIA_URL = '/images/'
 MEDIA_ROOT = os.path.join(BASE_DIR,'app/static/images')
+# Threads that build the resized image variants after an upload (see app/images.py).
+IMAGE_VARIANT_WORKERS = 2
+# Absolute base URL used in the sitemaps and the product feed, and where build_sitemaps writes them.
+SITE_URL = os.environ.get('SITE_URL', 'http://localhost:8000')
+SITEMAP_ROOT = BASE_DIR / 'sitemaps'
+
+# Share of requests timed by app.middleware.InstrumentationMiddleware (0 to 1). Sampled requests get a
+# Server-Timing header and a JSON line on the 'app.requests' logger, written to REQUEST_LOG or stdout.
+INSTRUMENTATION_SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', 1 if DEBUG else 0.05))
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {'message': {'format': '%(message)s'}},
+    'handlers': {
+        'requests': {'class': 'logging.FileHandler', 'filename': os.environ['REQUEST_LOG'], 'formatter': 'message'}
+        if os.environ.get('REQUEST_LOG') else {'class': 'logging.StreamHandler', 'formatter': 'message'},
+    },
+    'loggers': {'app.requests': {'handlers': ['requests'], 'level': 'INFO', 'propagate': False}},
+}
+# Profiles of the requests sent with a staff profiling token (see app/profiling.py): where they are
+# written, the sampling interval in seconds and how long a token stays valid.
+PROFILE_ROOT = BASE_DIR / 'profiles'
+PROFILE_INTERVAL = 0.001
+PROFILE_TOKEN_MAX_AGE = 60 * 60
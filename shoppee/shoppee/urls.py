@@ -16,13 +16,9 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-#Load images
-from django.conf.urls.static import static
-from django.conf import settings
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('app.urls')),
 ]
-
-urlpatterns +=static(settings.MEDIA_URL, document_root = settings.MEDIA_ROOT)
\ No newline at end of file
+# Static files and images (MEDIA_URL) are served by app.middleware.StaticFilesMiddleware.
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shoppee.settings')
 
 application = get_wsgi_application()
+
+# Build the in-memory search suggestions before the first keystroke arrives.
+from app.autocomplete import index as autocomplete_index
+
+autocomplete_index.warm()